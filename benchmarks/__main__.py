@@ -0,0 +1,164 @@
+"""
+Runs the micro-benchmark suite from `benchmarks.suite`, and compares runs.
+
+    python -m benchmarks run [--filter render] [--repeat 5]
+    python -m benchmarks compare <base> [<head>] [--threshold 0.1]
+
+Every run is saved as benchmarks/results/<commit>.json (with a -dirty suffix if the
+tree has uncommitted changes). `compare` takes commits (or paths to result files),
+`head` defaults to the latest run. It exits with status 1 if anything got slower by
+more than `threshold`, so it can be used in CI.
+"""
+import argparse
+import asyncio
+from datetime import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Optional
+
+from benchmarks.suite import load_app, measure, setup
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def git(*args: str) -> str:
+    try:
+        return subprocess.run(
+            ["git", *args], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def current_commit() -> str:
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    if git("status", "--porcelain", "--untracked-files=no"):
+        commit += "-dirty"
+    return commit
+
+
+async def run(filter: Optional[str], repeat: int, budget: float) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        app = load_app(directory)
+        benchmarks = await setup(app)
+        results = {}
+        try:
+            for name, benchmark in benchmarks.items():
+                if filter and filter not in name:
+                    continue
+                iterations, rounds = await measure(
+                    benchmark, repeat=repeat, budget=budget
+                )
+                results[name] = {
+                    "iterations": iterations,
+                    "min": min(rounds),
+                    "median": statistics.median(rounds),
+                    "rounds": rounds,
+                }
+                print(
+                    f"{name:40} {statistics.median(rounds) * 10 ** 6:10.2f}us "
+                    f"(min {min(rounds) * 10 ** 6:.2f}us, {iterations} iterations)"
+                )
+        finally:
+            await app.ctx.db.disconnect()
+    return results
+
+
+def load(name: str) -> dict:
+    path = name if os.path.exists(name) else os.path.join(RESULTS_DIR, f"{name}.json")
+    if not os.path.exists(path):
+        # a longer commit hash than the one the file was saved with
+        matches = [
+            file for file in os.listdir(RESULTS_DIR) if name.startswith(file[:-5])
+        ]
+        if not matches:
+            raise SystemExit(f"No results for {name}.")
+        path = os.path.join(RESULTS_DIR, matches[0])
+    with open(path) as f:
+        return json.load(f)
+
+
+def latest() -> str:
+    files = sorted(
+        (file for file in os.listdir(RESULTS_DIR) if file.endswith(".json")),
+        key=lambda file: os.path.getmtime(os.path.join(RESULTS_DIR, file)),
+    )
+    if not files:
+        raise SystemExit("There are no results yet, run the benchmarks first.")
+    return os.path.join(RESULTS_DIR, files[-1])
+
+
+def compare(base: dict, head: dict, threshold: float) -> bool:
+    """Prints the change of every benchmark, returns whether any of them regressed."""
+    print(f"{'':40} {base['commit']:>12} {head['commit']:>12}")
+    regressed = False
+    for name, result in head["results"].items():
+        before = base["results"].get(name)
+        after = result["median"] * 10 ** 6
+        if before is None:
+            print(f"{name:40} {'':>12} {after:10.2f}us")
+            continue
+
+        before = before["median"] * 10 ** 6
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  SLOWER"
+            regressed = True
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:40} {before:10.2f}us {after:10.2f}us {change:+7.1%}{flag}")
+    return regressed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run", help="run and save the benchmarks")
+    run_parser.add_argument("--filter", help="only run the benchmarks matching this")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument(
+        "--budget", type=float, default=0.2, help="seconds per round of each benchmark"
+    )
+    run_parser.add_argument("--output", help="file to save the results to")
+
+    compare_parser = commands.add_parser("compare", help="compare two saved runs")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head", nargs="?")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="slowdown reported as a regression"
+    )
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        base, head = load(args.base), load(args.head or latest())
+        sys.exit(1 if compare(base, head, args.threshold) else 0)
+
+    if args.command is None:
+        args = run_parser.parse_args([])
+    commit = current_commit()
+    results = asyncio.run(run(args.filter, args.repeat, args.budget))
+    report = {
+        "commit": commit,
+        "date": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    path = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark of `src.chat.Chat` in a bursty room, and of it's batched writes.
+
+A room gets thousands of idle connections, each a task forwarding what it receives
+like the chat WebSocket does, then bursts of messages are posted in the same
+iteration of the event loop, like when many members talk at once. The time until
+every connection has the burst is reported, along with the number of connections
+dropped for falling behind (there should be none).
+
+Then the messages are written to a throwaway SQLite database, once with the
+batched `executemany` of `Chat.flush` and once with one insert per message.
+
+    python -m benchmarks.chat --connections 5000 --bursts 50 --burst-size 100
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+from time import perf_counter
+from typing import List
+
+from sanic import Sanic
+
+from src.chat import INSERT_MESSAGE, Chat, ChatRoom, chat_topic
+from src.database import Database
+from src.pubsub import Hub, Subscription
+from src.utils import IDGenerator
+
+
+EVENT_ID = "1"
+
+
+async def connection(
+    subscription: Subscription, counts: List[int], done: asyncio.Event
+) -> None:
+    # the WebSocket sends the frames as they are
+    async for _ in subscription:
+        counts[0] += 1
+        if counts[0] == counts[1]:
+            done.set()
+
+
+async def fan_out(app: Sanic, room: ChatRoom, connections: int, bursts: int, size: int):
+    chat: Chat = app.ctx.chat
+    # (frames received so far, expected) of the current burst, shared by everyone.
+    # the messages of a burst are posted in the same iteration, so they are one frame
+    counts = [0, 0]
+    done = asyncio.Event()
+    subscriptions = [
+        app.ctx.hub.subscribe(chat_topic(EVENT_ID)) for _ in range(connections)
+    ]
+    tasks = [
+        asyncio.create_task(connection(subscription, counts, done))
+        for subscription in subscriptions
+    ]
+    await asyncio.sleep(0)
+
+    post_times, delivery_times = [], []
+    for burst in range(bursts):
+        counts[:] = [0, connections]
+        done.clear()
+        start = perf_counter()
+        for i in range(size):
+            chat.post(app, room, "benchmark-user", "someone", f"message {burst} {i}")
+        post_times.append((perf_counter() - start) / size)
+        await done.wait()
+        delivery_times.append(perf_counter() - start)
+
+    for subscription in subscriptions:
+        app.ctx.hub.evict(subscription)
+    await asyncio.gather(*tasks)
+    return post_times, delivery_times
+
+
+async def persistence(app: Sanic, messages: int) -> None:
+    chat: Chat = app.ctx.chat
+    room = await chat.room(app, EVENT_ID)
+    for i in range(messages):
+        chat.post(app, room, "benchmark-user", "someone", f"message {i}")
+    batch = list(chat.pending)
+
+    start = perf_counter()
+    await chat.flush(app)
+    batched = perf_counter() - start
+
+    await app.ctx.db.execute("DELETE FROM chat_messages")
+    start = perf_counter()
+    for values in batch:
+        await app.ctx.db.execute(INSERT_MESSAGE, **values)
+    single = perf_counter() - start
+
+    print(f"writing {messages} messages:")
+    print(f"  executemany: {batched * 1000:8.1f}ms, {messages / batched:8.0f}/s")
+    print(f"  one by one:  {single * 1000:8.1f}ms, {messages / single:8.0f}/s")
+
+
+async def main(connections: int, bursts: int, size: int, messages: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        app = Sanic("benchmark")
+        app.config.DB_URI = f"sqlite:///{os.path.join(directory, 'chat.db')}"
+        # the inserts one by one would all be logged as slow
+        app.config.SLOW_QUERY_THRESHOLD = 10
+        app.ctx.db = Database(app)
+        app.ctx.snowflake = IDGenerator()
+        app.ctx.hub = Hub(max_queue=64)
+        app.ctx.chat = Chat()
+        await app.ctx.db.connect()
+        await app.ctx.db.migrate()
+        try:
+            room = await app.ctx.chat.room(app, EVENT_ID)
+            post_times, delivery_times = await fan_out(
+                app, room, connections, bursts, size
+            )
+            app.ctx.chat.pending.clear()
+
+            p50 = statistics.median(delivery_times) * 1000
+            p95 = statistics.quantiles(delivery_times, n=100)[94] * 1000
+            post = statistics.median(post_times) * 10 ** 6
+            print(f"{connections} connections, bursts of {size} messages")
+            print(f"post:     {post:.1f}us per message")
+            print(f"delivery: p50 {p50:.1f}ms, p95 {p95:.1f}ms per burst")
+            print(f"dropped:  {app.ctx.hub.evictions - connections} connections")
+
+            await persistence(app, messages)
+        finally:
+            await app.ctx.db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--bursts", type=int, default=50)
+    parser.add_argument("--burst-size", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument(
+        "--uvloop", action="store_true", help="run on uvloop, like Sanic does"
+    )
+    args = parser.parse_args()
+    if args.uvloop:
+        import uvloop
+
+        uvloop.install()
+    asyncio.run(main(args.connections, args.bursts, args.burst_size, args.messages))
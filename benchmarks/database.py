@@ -0,0 +1,112 @@
+"""
+Benchmark of the Postgres fast path, `src.database.PostgresDatabase`,
+against the `databases` wrapper, `src.database.Database`.
+
+Needs a scratch Postgres database, the tables are migrated and a few rows are
+inserted into it (and deleted afterwards). Each backend runs the same lookups
+the app runs on every request, and the time per call is reported.
+
+    python -m benchmarks.database --uri postgresql://localhost/scratch --calls 10000
+"""
+import argparse
+import asyncio
+from datetime import datetime
+import os
+from time import perf_counter
+from typing import Awaitable, Callable
+
+from sanic import Sanic
+
+from src.database import Database, PostgresDatabase
+from src.events import EVENT_COLUMNS, Event
+
+
+UID = "benchmark-user"
+EVENT_ID = "1"
+
+
+async def seed(app: Sanic) -> None:
+    await app.ctx.db.execute(
+        "INSERT INTO users(uid, username) VALUES(:uid, 'benchmark')", uid=UID
+    )
+    await Event(
+        event_id=EVENT_ID,
+        event_name="benchmark",
+        event_owner=UID,
+        start_time=datetime(2021, 1, 1),
+        end_time=datetime(2021, 1, 2),
+        long_desc="",
+        short_desc="",
+    ).create(app)
+
+
+async def clean(app: Sanic) -> None:
+    await app.ctx.db.execute("DELETE FROM events WHERE event_id = :id", id=EVENT_ID)
+    await app.ctx.db.execute("DELETE FROM users WHERE uid = :uid", uid=UID)
+
+
+async def measure(calls: int, call: Callable[[], Awaitable]) -> float:
+    """Returns the mean time of `call`, in microseconds."""
+    await call()  # the first call prepares the statement
+    start = perf_counter()
+    for _ in range(calls):
+        await call()
+    return (perf_counter() - start) / calls * 10 ** 6
+
+
+async def run(app: Sanic, calls: int) -> dict:
+    async def by_id_with_dict() -> Event:
+        # how rows were decoded before, for comparison
+        record = await app.ctx.db.fetchrow(
+            f"SELECT {EVENT_COLUMNS} FROM events WHERE event_id = :event_id",
+            event_id=EVENT_ID,
+        )
+        return Event(**dict(record))
+
+    lookups = {
+        "Event.by_id": lambda: Event.by_id(app, EVENT_ID),
+        "by_id with dict": by_id_with_dict,
+        "members_page": lambda: Event.members_page(app, EVENT_ID, limit=100),
+        "fetchval": lambda: app.ctx.db.fetchval(
+            "SELECT COUNT(*) FROM users_events WHERE event_id = :id", id=EVENT_ID
+        ),
+    }
+    return {name: await measure(calls, call) for name, call in lookups.items()}
+
+
+async def main(uri: str, calls: int) -> None:
+    app = Sanic("benchmark")
+    app.config.DB_URI = uri
+    app.config.DB_POOL_MIN_SIZE = 1
+    app.config.DB_POOL_MAX_SIZE = 1
+    app.config.DB_STATEMENT_CACHE_SIZE = 256
+
+    results = {}
+    for backend in (Database, PostgresDatabase):
+        app.ctx.db = backend(app)
+        await app.ctx.db.connect()
+        await app.ctx.db.migrate()
+        await seed(app)
+        try:
+            results[backend.__name__] = await run(app, calls)
+        finally:
+            await clean(app)
+            await app.ctx.db.disconnect()
+
+    wrapper, fast = results["Database"], results["PostgresDatabase"]
+    print(f"{'':16} {'Database':>12} {'PostgresDatabase':>18}")
+    for name in wrapper:
+        print(
+            f"{name:16} {wrapper[name]:10.0f}us {fast[name]:16.0f}us "
+            f"({wrapper[name] / fast[name]:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--uri", default=os.environ.get("DB_URI"))
+    parser.add_argument("--calls", type=int, default=10000)
+    args = parser.parse_args()
+    if not args.uri or not args.uri.startswith("postgres"):
+        parser.error("a postgres URI is needed, pass --uri or set DB_URI")
+    asyncio.run(main(args.uri, args.calls))
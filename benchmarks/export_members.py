@@ -0,0 +1,86 @@
+"""
+Benchmark for the streaming member export, `src.events.Event.export_members`.
+
+Seeds a throwaway SQLite database with one event and N members, exports them,
+and reports the throughput and the peak memory allocated during the export.
+The peak should stay the same whatever the number of rows.
+
+    python -m benchmarks.export_members --rows 1000000
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+from time import perf_counter
+import tracemalloc
+
+from sanic import Sanic
+
+from src.database import Database
+from src.events import Event
+
+
+EVENT_ID = "1"
+
+
+async def export(app: Sanic, format: str) -> dict:
+    tracemalloc.start()
+    start = perf_counter()
+    size = 0
+    async for chunk in Event.export_members(app, EVENT_ID, format=format):
+        size += len(chunk)
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": elapsed, "bytes": size, "peak_memory": peak}
+
+
+def seed(path: str, rows: int) -> None:
+    # seeding goes through sqlite3 directly, it's not what's being measured
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        "INSERT INTO users(uid, username) VALUES(?, ?)",
+        ((f"{i:020d}", f"user{i}") for i in range(rows)),
+    )
+    connection.execute(
+        "INSERT INTO events(event_id, event_name, event_owner, start_time, end_time, "
+        "long_desc) VALUES(?, 'benchmark', ?, '2021-01-01', '2021-01-02', '')",
+        (EVENT_ID, f"{0:020d}"),
+    )
+    connection.executemany(
+        "INSERT INTO users_events(event_id, uid) VALUES(?, ?)",
+        ((EVENT_ID, f"{i:020d}") for i in range(rows)),
+    )
+    connection.commit()
+    connection.close()
+
+
+async def main(rows: int, format: str) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        app = Sanic("benchmark")
+        app.config.DB_URI = f"sqlite:///{path}"
+        app.ctx.db = Database(app)
+
+        await app.ctx.db.connect()
+        await app.ctx.db.migrate()
+        seed(path, rows)
+
+        result = await export(app, format)
+        await app.ctx.db.disconnect()
+
+    print(
+        f"{rows} rows as {format}: {result['seconds']:.2f}s "
+        f"({rows / result['seconds']:.0f} rows/s), "
+        f"{result['bytes'] / 2 ** 20:.1f} MiB written, "
+        f"peak memory {result['peak_memory'] / 2 ** 10:.0f} KiB"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--format", choices=("csv", "ndjson"), default="csv")
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.format))
@@ -0,0 +1,100 @@
+"""
+Benchmark of the fan-out of `src.pubsub.Hub`, to idle subscribers of one topic.
+
+Every subscriber is a task waiting on it's subscription, like the live member list
+connections are. Each message is published once, and the time until every
+subscriber has received it is reported, along with the time of the `publish` call
+itself and the memory kept per subscriber.
+
+    python -m benchmarks.pubsub --subscribers 10000 --messages 100
+"""
+import argparse
+import asyncio
+import statistics
+from time import perf_counter
+import tracemalloc
+from typing import List
+
+from src.pubsub import EVICTED, Hub, Subscription
+
+
+TOPIC = "event:1:members"
+MESSAGE = '{"action": "join", "uid": "benchmark-user", "username": "someone"}'
+
+
+async def consume(subscription: Subscription, received: List[int], done: asyncio.Event):
+    while True:
+        message = await subscription.get()
+        if message is EVICTED:
+            return
+        received[0] += 1
+        if received[0] == received[1]:
+            done.set()
+
+
+async def main(subscribers: int, messages: int) -> None:
+    hub = Hub(max_queue=64)
+    # (received so far, expected) of the current message, shared by the consumers
+    received = [0, subscribers]
+    done = asyncio.Event()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    subscriptions = [hub.subscribe(TOPIC) for _ in range(subscribers)]
+    tasks = [
+        asyncio.create_task(consume(subscription, received, done))
+        for subscription in subscriptions
+    ]
+    await asyncio.sleep(0)  # every consumer is now waiting
+    per_subscriber = (tracemalloc.get_traced_memory()[0] - before) / subscribers
+    tracemalloc.stop()
+
+    publish_times, delivery_times = [], []
+    for _ in range(messages):
+        received[0] = 0
+        done.clear()
+        start = perf_counter()
+        hub.publish(TOPIC, MESSAGE)
+        publish_times.append(perf_counter() - start)
+        await done.wait()
+        delivery_times.append(perf_counter() - start)
+
+    # a subscriber that stops reading is evicted once it's queue is full,
+    # without slowing down the others
+    slow = hub.subscribe(TOPIC)
+    for _ in range(hub.max_queue + 1):
+        received[0] = 0
+        done.clear()
+        hub.publish(TOPIC, MESSAGE)
+        await done.wait()
+    assert slow.evicted and hub.evictions == 1
+
+    for subscription in subscriptions:
+        hub.evict(subscription)
+    await asyncio.gather(*tasks)
+
+    def ms(times: List[float]) -> str:
+        p50 = statistics.median(times) * 1000
+        p95 = statistics.quantiles(times, n=100)[94] * 1000
+        return f"p50 {p50:.2f}ms, p95 {p95:.2f}ms"
+
+    print(f"{subscribers} subscribers, {per_subscriber / 1024:.1f}KiB each")
+    print(f"publish:  {ms(publish_times)}")
+    print(f"delivery: {ms(delivery_times)}")
+    per_message = statistics.median(delivery_times) / subscribers * 10 ** 6
+    print(f"          {per_message:.2f}us per subscriber")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--subscribers", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument(
+        "--uvloop", action="store_true", help="run on uvloop, like Sanic does"
+    )
+    args = parser.parse_args()
+    if args.uvloop:
+        import uvloop
+
+        uvloop.install()
+    asyncio.run(main(args.subscribers, args.messages))
@@ -0,0 +1,114 @@
+"""
+Benchmark for template loading and rendering, `src.utils.render_page`.
+
+For dashboard.html and event-display.html, measures:
+    compile -> loading the template with no bytecode cache (a cold worker before this change)
+    cached compile -> loading it from a warm on-disk bytecode cache (a cold worker now)
+    render -> rendering the already loaded template
+
+    python -m benchmarks.render --renders 1000
+"""
+import argparse
+import asyncio
+from datetime import datetime
+from functools import partial
+import tempfile
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+from jinja2 import Environment
+
+from src.assets import asset_url, load_manifest
+from src.events import Event
+from src.utils import Page, make_environment, render_page
+
+
+def contexts() -> Dict[str, Dict[str, Any]]:
+    form = SimpleNamespace(csrf_token='<input name="csrf_token" value="x">')
+    user = SimpleNamespace(uid="1", username="someone")
+    event = Event(
+        event_id="1234567890123456",
+        event_name="Benchmark",
+        event_owner="2",
+        start_time=datetime(2021, 1, 1),
+        end_time=datetime(2021, 1, 2),
+        long_desc="A long description. " * 100,
+        short_desc="A short description.",
+        member_count=100,
+    )
+    dashboard_event = {
+        "event_id": event.event_id,
+        "event_name": event.event_name,
+        "start_time": event.start_time,
+        "end_time": event.end_time,
+        "short_desc": event.short_desc,
+        "member_count": 100,
+    }
+    return {
+        "dashboard.html": dict(
+            dashboard_form=form,
+            delete_event_form=form,
+            from_discord=False,
+            all_events=Page(items=[dashboard_event] * 30, next_cursor="1"),
+            owned_events=Page(items=[dashboard_event] * 30, next_cursor="1"),
+            joined_cursor=None,
+            owned_cursor=None,
+            username=user.username,
+            tz="Etc/GMT-5",
+        ),
+        "event-display.html": dict(
+            event=event,
+            event_members=[f"user{i}" for i in range(100)],
+            members_cursor="100",
+            is_member=True,
+            user=user,
+            owner=SimpleNamespace(uid="2", username="owner"),
+            leave_form=form,
+            join_form=form,
+        ),
+    }
+
+
+def server_environment(*, debug: bool, cache_dir: Optional[str] = None) -> Environment:
+    # set up the same way as the one in src/server.py
+    environment = make_environment(debug=debug, cache_dir=cache_dir)
+    environment.globals["asset_url"] = partial(asset_url, load_manifest())
+    return environment
+
+
+def compile_time(file: str, cache_dir: Optional[str] = None) -> float:
+    environment = server_environment(debug=cache_dir is None, cache_dir=cache_dir)
+    start = perf_counter()
+    environment.get_template(file)
+    return perf_counter() - start
+
+
+async def render_time(file: str, context: Dict[str, Any], renders: int) -> float:
+    environment = server_environment(debug=False)
+    await render_page(environment, file=file, **context)
+    start = perf_counter()
+    for _ in range(renders):
+        await render_page(environment, file=file, **context)
+    return (perf_counter() - start) / renders
+
+
+def main(renders: int) -> None:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for file, context in contexts().items():
+            compiled = compile_time(file)
+            compile_time(file, cache_dir)  # fills the bytecode cache
+            cached = compile_time(file, cache_dir)
+            rendered = asyncio.run(render_time(file, context, renders))
+            print(
+                f"{file}: compile {compiled * 1000:.2f}ms, "
+                f"cached compile {cached * 1000:.2f}ms, "
+                f"render {rendered * 1000:.3f}ms"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--renders", type=int, default=1000)
+    args = parser.parse_args()
+    main(args.renders)
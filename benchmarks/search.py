@@ -0,0 +1,127 @@
+"""
+Latency of `Event.search` on a seeded dataset.
+
+Events with random names and descriptions (made up words, with a realistic
+distribution) are bulk imported into a throwaway SQLite database (or into a scratch
+Postgres database with --uri, they are deleted afterwards), then a mix of one word, two word and prefix searches is run, and the latency
+percentiles of each kind are reported.
+
+    python -m benchmarks.search --events 100000 --searches 1000
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+import os
+import random
+import statistics
+import tempfile
+from time import perf_counter
+from typing import Dict, List, Optional
+
+from sanic import Sanic
+
+from src.database import Database
+from src.events import Event
+from src.importer import import_events
+from src.utils import IDGenerator
+
+
+UID = "benchmark-user"
+SYLLABLES = "ka to mi re su na lo pe vi da ru ko be ta ni".split()
+
+
+class Vocabulary:
+    """Made up words, picked with a Zipf distribution like the words of real text."""
+
+    def __init__(self, rng: random.Random, size: int) -> None:
+        self.rng = rng
+        self.words = list(
+            {
+                "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+                for _ in range(size)
+            }
+        )
+        self.weights = [1 / rank for rank in range(1, len(self.words) + 1)]
+
+    def text(self, words: int) -> str:
+        return " ".join(self.rng.choices(self.words, self.weights, k=words))
+
+
+def dataset(vocabulary: Vocabulary, size: int) -> List[Dict]:
+    start = datetime(2021, 1, 1)
+    return [
+        {
+            "event_name": vocabulary.text(2)[:25],
+            "start_time": start + timedelta(hours=i),
+            "end_time": start + timedelta(hours=i + 2),
+            "short_desc": vocabulary.text(6)[:75],
+            "long_desc": vocabulary.text(60),
+            "passcode": None,
+            "members": [],
+        }
+        for i in range(size)
+    ]
+
+
+async def measure(app: Sanic, queries: List[str], limit: int) -> List[float]:
+    """Returns the latency of every search, in milliseconds."""
+    await Event.search(app, queries[0], limit=limit)  # warm up
+    latencies = []
+    for query in queries:
+        start = perf_counter()
+        await Event.search(app, query, limit=limit)
+        latencies.append((perf_counter() - start) * 1000)
+    return latencies
+
+
+async def main(uri: Optional[str], events: int, searches: int, limit: int) -> None:
+    vocabulary = Vocabulary(random.Random(42), 5000)
+    with tempfile.TemporaryDirectory() as directory:
+        app = Sanic("benchmark")
+        app.config.DB_URI = uri or f"sqlite:///{os.path.join(directory, 'search.db')}"
+        # the seeding batches would all be logged as slow
+        app.config.SLOW_QUERY_THRESHOLD = 10
+        app.ctx.db = Database(app)
+        app.ctx.snowflake = IDGenerator()
+        await app.ctx.db.connect()
+        await app.ctx.db.migrate()
+        try:
+            await app.ctx.db.execute(
+                "INSERT INTO users(uid, username) VALUES(:uid, 'benchmark')", uid=UID
+            )
+            report = await import_events(app, UID, dataset(vocabulary, events))
+            print(f"Seeded {report.events} events in {report.seconds:.1f}s")
+
+            kinds = {
+                "one word": lambda: vocabulary.text(1),
+                "two words": lambda: vocabulary.text(2),
+                "prefix": lambda: vocabulary.text(1)[:3],
+            }
+            print(f"{'':10} {'p50':>9} {'p95':>9} {'p99':>9}")
+            for name, make_query in kinds.items():
+                queries = [make_query() for _ in range(searches)]
+                latencies = await measure(app, queries, limit)
+                p50, p95, p99 = (
+                    statistics.quantiles(latencies, n=100)[i] for i in (49, 94, 98)
+                )
+                print(f"{name:10} {p50:7.2f}ms {p95:7.2f}ms {p99:7.2f}ms")
+        finally:
+            if uri:
+                await app.ctx.db.execute(
+                    "DELETE FROM users_events WHERE uid = :uid", uid=UID
+                )
+                await app.ctx.db.execute(
+                    "DELETE FROM events WHERE event_owner = :uid", uid=UID
+                )
+                await app.ctx.db.execute("DELETE FROM users WHERE uid = :uid", uid=UID)
+            await app.ctx.db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--uri", help="a scratch database, defaults to SQLite")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--searches", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.uri, args.events, args.searches, args.limit))
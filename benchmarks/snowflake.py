@@ -0,0 +1,57 @@
+"""
+Benchmark for the snowflake generator, `src.utils.IDGenerator`.
+
+Measures the throughput of `next()` and of block allocation with `take()`,
+then generates IDs in several processes at once (each claiming it's own worker ID
+through `claim_worker_id`) and checks that no ID was handed out twice.
+
+    python -m benchmarks.snowflake --ids 1000000 --processes 4
+"""
+import argparse
+from multiprocessing import Pool
+from time import perf_counter
+from typing import List, Tuple
+
+from src.utils import IDGenerator, claim_worker_id
+
+
+def generate(args: Tuple[int, int]) -> List[int]:
+    count, processes = args
+    generator = IDGenerator(claim_worker_id(0, processes))
+    return [next(generator) for _ in range(count)]
+
+
+def throughput(count: int) -> None:
+    generator = IDGenerator()
+    start = perf_counter()
+    for _ in range(count):
+        next(generator)
+    elapsed = perf_counter() - start
+    print(f"next(): {count / elapsed:,.0f} IDs/s")
+
+    for size in (100, 10_000):
+        start = perf_counter()
+        for _ in range(count // size):
+            generator.take(size)
+        elapsed = perf_counter() - start
+        print(f"take({size}): {count / elapsed:,.0f} IDs/s")
+
+
+def uniqueness(count: int, processes: int) -> None:
+    with Pool(processes) as pool:
+        results = pool.map(generate, [(count, processes)] * processes)
+
+    ids = [i for result in results for i in result]
+    duplicates = len(ids) - len(set(ids))
+    print(f"{len(ids):,} IDs from {processes} processes, {duplicates} duplicates")
+    if duplicates:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--ids", type=int, default=1_000_000)
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+    throughput(args.ids)
+    uniqueness(args.ids, args.processes)
@@ -0,0 +1,176 @@
+"""
+Micro-benchmarks of the helpers every request goes through, run by `python -m benchmarks`.
+
+The app from `src.server` is used as is, except that Firebase is never contacted
+(the Admin SDK is initialized with mocks, and verified session cookies are cached up front)
+and neither is Discord (identities are cached up front, `fetch_identity` is mocked).
+The database is a throwaway SQLite database.
+"""
+import asyncio
+from datetime import datetime
+import os
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, Tuple
+from unittest import mock
+
+from sanic import Sanic
+from sanic.compat import Header
+from sanic.request import Request
+from sanic.response import HTTPResponse, text
+
+# a benchmark returns the coroutine function to time, it is called once per iteration
+Benchmark = Callable[[], Awaitable[Any]]
+
+UID = "benchmark-user"
+DISCORD_ID = "4242424242"
+EVENT_ID = "1234567890123456"
+SESSION_COOKIE = "benchmark-session-cookie"
+ACCESS_TOKEN = "benchmark-access-token"
+
+
+def load_app(directory: str) -> Sanic:
+    """Imports `src.server` with it's database and template cache in `directory`."""
+    os.environ["DB_URI"] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+    os.environ["DB_FAST_PATH"] = ""
+    os.environ["TEMPLATE_CACHE_DIR"] = os.path.join(directory, "templates")
+    os.environ["SESSION_BACKEND"] = "memory"
+    os.environ.setdefault("CSRF_TOKEN", "benchmark")
+    # templates are compiled once and never reloaded, like in production
+    os.environ["DEBUG"] = "0"
+
+    with mock.patch("firebase_admin.credentials.Certificate"), mock.patch(
+        "firebase_admin.initialize_app"
+    ):
+        from src.server import app
+
+    return app
+
+
+def make_request(app: Sanic, *, cookies: str = "", session: dict = None) -> Request:
+    headers = {"cookie": cookies} if cookies else {}
+    request = Request(b"/", Header(headers), "1.1", "GET", None, app)
+    request.ctx.session = session or {}
+    return request
+
+
+async def setup(app: Sanic) -> Dict[str, Benchmark]:
+    """Prepares the app and the database, and returns every benchmark by name."""
+    from benchmarks.render import contexts
+    from src.auth import User, authorized, discord, firebase, guest_or_authorized
+    from src.events import Event
+    from src.forms import (
+        DashboardForm,
+        EventActionForm,
+        EventCreationForm,
+        LoginForm,
+        SignUpForm,
+    )
+    from src.utils import IDGenerator, preload_templates, render_page
+
+    app.ctx.snowflake = IDGenerator()
+    preload_templates(app.ctx.env)
+    await app.ctx.db.connect()
+    await app.ctx.db.migrate()
+    await app.ctx.db.execute(
+        "INSERT INTO users(uid, username, discord_id) VALUES(:uid, 'someone', :did)",
+        uid=UID,
+        did=DISCORD_ID,
+    )
+    await Event(
+        event_id=EVENT_ID,
+        event_name="Benchmark",
+        event_owner=UID,
+        start_time=datetime(2021, 1, 1),
+        end_time=datetime(2021, 1, 2),
+        long_desc="A long description. " * 100,
+        short_desc="A short description.",
+    ).create(app)
+
+    # what Firebase and Discord would have answered, cached like after a first request
+    firebase.verified_cookies.set(SESSION_COOKIE, {"uid": UID}, ttl=10 ** 6)
+    firebase.revocation_checked.set(UID, True, ttl=10 ** 6)
+    discord.identities.set(ACCESS_TOKEN, discord.Identity(DISCORD_ID, "someone"))
+    # left patched for the rest of the run
+    mock.patch.object(
+        discord, "fetch_identity", return_value=discord.Identity(DISCORD_ID, "someone")
+    ).start()
+
+    async def handler(request: Request, user: Any, platform: Any) -> HTTPResponse:
+        return text("")
+
+    protected = authorized()(handler)
+    optional = guest_or_authorized()(handler)
+    firebase_request = make_request(app, cookies=f"session={SESSION_COOKIE}")
+    discord_request = make_request(
+        app, session={"discord_oauth2_token": {"access_token": ACCESS_TOKEN}}
+    )
+    guest_request = make_request(app)
+
+    form = EventActionForm(guest_request)
+    templates = {
+        **contexts(),
+        "index.html": dict(
+            login_form=LoginForm(guest_request), signup_form=SignUpForm(guest_request)
+        ),
+        "event-creation.html": dict(form=EventCreationForm(guest_request)),
+        "not-logged-in.html": {},
+        "error.html": dict(exception="This event does not exist."),
+    }
+    templates["dashboard.html"].update(dashboard_form=form, delete_event_form=form)
+    templates["event-display.html"].update(leave_form=form, join_form=form)
+
+    benchmarks: Dict[str, Benchmark] = {}
+    for file, context in sorted(templates.items()):
+        benchmarks[f"render_page[{file}]"] = lambda file=file, context=context: (
+            render_page(app.ctx.env, file=file, **context)
+        )
+
+    async def next_id() -> int:
+        return next(app.ctx.snowflake)
+
+    async def event_action_form() -> Any:
+        return EventActionForm(guest_request)
+
+    async def dashboard_form() -> Any:
+        return DashboardForm(guest_request)
+
+    benchmarks.update(
+        {
+            "IDGenerator.__next__": next_id,
+            "authorized[firebase]": lambda: protected(firebase_request),
+            "authorized[discord]": lambda: protected(discord_request),
+            "guest_or_authorized[guest]": lambda: optional(guest_request),
+            "Event.by_id": lambda: Event.by_id(app, EVENT_ID),
+            "User.from_db": lambda: User.from_db(app, UID),
+            "EventActionForm()": event_action_form,
+            "DashboardForm()": dashboard_form,
+        }
+    )
+    return benchmarks
+
+
+async def measure(benchmark: Benchmark, *, repeat: int, budget: float) -> Tuple:
+    """
+    Times `benchmark`, returns (iterations per round, seconds per call of every round).
+    The number of iterations is picked so that one round takes about `budget` seconds.
+    """
+    for _ in range(10):  # warm up
+        await benchmark()
+
+    iterations, elapsed = 1, 0.0
+    while elapsed < budget / 10:
+        iterations *= 2
+        start = perf_counter()
+        for _ in range(iterations):
+            await benchmark()
+        elapsed = perf_counter() - start
+    iterations = max(1, int(iterations * budget / elapsed))
+
+    rounds = []
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(iterations):
+            await benchmark()
+        rounds.append((perf_counter() - start) / iterations)
+        await asyncio.sleep(0)
+    return iterations, rounds
@@ -1,7 +1,7 @@
 import os
 
 from dotenv import find_dotenv, load_dotenv
-from src.server import app
+from src.server import DEBUG, app
 
 load_dotenv(find_dotenv())
 
@@ -12,8 +12,9 @@ PORT = os.environ.get("PORT")
 if PORT:
     PORT = int(PORT)
 
-# if debug env var is not set, assume it is True
-DEBUG = False if os.environ.get("DEBUG") else True
+# more than one worker needs a shared session backend, see src/sessions.py
+WORKERS = app.config.WORKERS
+
 # if DEBUG is false, don't display access_logs either
 ACCESS_LOG = DEBUG
 
@@ -21,4 +22,4 @@ ACCESS_LOG = DEBUG
 # so to register the routes defined there, we import it here
 import src.views
 
-app.run(host=HOST, port=PORT, debug=DEBUG, access_log=ACCESS_LOG)
+app.run(host=HOST, port=PORT, debug=DEBUG, access_log=ACCESS_LOG, workers=WORKERS)
@@ -0,0 +1,136 @@
+"""
+Static asset pipeline.
+
+The build step, to be run on every deploy:
+    python -m src.assets
+copies every file in src/static to src/static/dist, with a hash of it's content in the name,
+writes gzip (and brotli, if it is installed) compressed copies of the text files next to them,
+and writes a manifest of it all to src/static/dist/manifest.json.
+
+At runtime templates link to assets with `asset_url`, which points to the hashed files
+when there is a manifest, and to the plain files in /static otherwise.
+Hashed files are served by `src.views.assets`, with immutable caching.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, List, Set
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST = os.path.join(DIST_DIR, "manifest.json")
+
+# scss sources and source maps are not served
+SKIPPED = {".scss", ".map"}
+# images (other than svg) are compressed already, compressing them again gains nothing
+COMPRESSIBLE = {".css", ".js", ".json", ".svg", ".txt", ".html"}
+
+# encoding -> file suffix, in order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+
+def hashed_name(path: str, content: bytes) -> str:
+    """css/stylesheet.css -> css/stylesheet.<hash>.css"""
+    root, extension = os.path.splitext(path)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return f"{root}.{digest}{extension}"
+
+
+def compress(path: str, content: bytes) -> List[str]:
+    """Writes the precompressed copies of a file, returns the encodings written."""
+    encodings = []
+
+    with open(path + ENCODINGS["gzip"], "wb") as f:
+        f.write(gzip.compress(content, compresslevel=9))
+    encodings.append("gzip")
+
+    if brotli is not None:
+        with open(path + ENCODINGS["br"], "wb") as f:
+            f.write(brotli.compress(content, quality=11))
+        encodings.append("br")
+
+    return encodings
+
+
+def build() -> dict:
+    """Builds src/static/dist and it's manifest from src/static."""
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    manifest: dict = {"files": {}, "encodings": {}}
+
+    for directory, subdirectories, files in os.walk(STATIC_DIR):
+        if os.path.abspath(directory).startswith(os.path.abspath(DIST_DIR)):
+            continue
+
+        for file in files:
+            source = os.path.join(directory, file)
+            path = os.path.relpath(source, STATIC_DIR).replace(os.sep, "/")
+            extension = os.path.splitext(file)[1].lower()
+            if extension in SKIPPED:
+                continue
+
+            with open(source, "rb") as f:
+                content = f.read()
+
+            hashed = hashed_name(path, content)
+            destination = os.path.join(DIST_DIR, hashed)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, "wb") as f:
+                f.write(content)
+
+            manifest["files"][path] = hashed
+            if extension in COMPRESSIBLE:
+                manifest["encodings"][hashed] = compress(destination, content)
+
+    with open(MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest() -> dict:
+    """Loads the manifest written by `build`. Empty if the build step hasn't been run."""
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": {}, "encodings": {}}
+
+
+def asset_url(manifest: dict, path: str) -> str:
+    """Returns the URL of a static file, given it's path relative to src/static."""
+    hashed = manifest["files"].get(path)
+    if hashed is None:
+        return f"/static/{path}"
+    return f"/assets/{hashed}"
+
+
+def accepted_encodings(header: str) -> Set[str]:
+    """Parses an Accept-Encoding header, leaving out the encodings refused with q=0."""
+    accepted = set()
+    for part in header.split(","):
+        encoding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+if __name__ == "__main__":
+    manifest = build()
+    compressed: Dict[str, int] = {}
+    for encodings in manifest["encodings"].values():
+        for encoding in encodings:
+            compressed[encoding] = compressed.get(encoding, 0) + 1
+
+    print(f"{len(manifest['files'])} files written to {DIST_DIR}")
+    for encoding, count in compressed.items():
+        print(f"{count} files precompressed with {encoding}")
+    if brotli is None:
+        print("brotli is not installed, skipped brotli compression")
@@ -1,16 +1,48 @@
 from dataclasses import dataclass
+from datetime import datetime
 from functools import partial, wraps
+import json
 
-from src.events import Event
-from typing import Any, Callable, List, Mapping, Optional
+from src.events import Event, TOUCH_USER, members_topic
+from typing import Any, Callable, List, Mapping, Optional, Tuple
 
-import requests
 from sanic import Sanic
 from sanic.exceptions import SanicException
 from sanic.request import Request
 from sanic.response import HTTPResponse
 
 from src.auth import discord, firebase
+from src.database import to_record
+from src.utils import Page
+
+
+# columns of the users table, in the order of the fields of `User`
+USER_COLUMNS = "uid, username, email, tz, discord_id"
+# columns shown on the dashboard, leaving out long_desc
+DASHBOARD_COLUMNS = (
+    "event_id, event_name, start_time, end_time, short_desc, member_count"
+)
+# largest BIGINT, used as the cursor for the first page
+MAX_CURSOR = 2 ** 63 - 1
+# `User.delete` in one statement on postgres, returns the IDs of the deleted events.
+# every part of it sees the tables as they were before the statement, and two parts
+# changing the same row would make one of them a no-op, so the updates leave out the
+# user's own events and row, which are deleted anyway
+DELETE_USER_POSTGRESQL = """WITH
+    owned AS (SELECT event_id FROM events WHERE event_owner = :id),
+    counts AS (UPDATE events SET member_count = member_count - 1
+        WHERE event_owner <> :id
+        AND event_id IN (SELECT event_id FROM users_events WHERE uid = :id)),
+    touched AS (UPDATE users SET memberships_updated_at = :now
+        WHERE uid <> :id AND uid IN (SELECT uid FROM users_events
+        WHERE event_id IN (SELECT event_id FROM owned))),
+    memberships AS (DELETE FROM users_events
+        WHERE uid = :id OR event_id IN (SELECT event_id FROM owned)),
+    messages AS (DELETE FROM chat_messages
+        WHERE event_id IN (SELECT event_id FROM owned)),
+    deleted AS (DELETE FROM events WHERE event_owner = :id RETURNING event_id),
+    removed AS (DELETE FROM users WHERE uid = :id)
+    SELECT event_id FROM deleted"""
 
 
 class UnauthenticatedError(SanicException):
@@ -45,24 +77,36 @@ class User:
     async def from_discord(cls, app: Sanic, request: Request) -> "User":
         """Fetches a user's data from discord and our database.
         This function is meant to be used after a user has finished authentication only.
-        It will register the user in the database if they aren't already."""
+        It will register the user in the database if they aren't already.
+        The identity returned by Discord is cached per access token, see `src.auth.discord.Identity`."""
         token = discord.check_logged_in(request)
-        if token:
-            token = {"Authorization": f"Bearer {token['access_token']}"}  # type: ignore
-            get = partial(requests.get, headers=token)
-            response = await app.loop.run_in_executor(
-                None, get, discord.API_BASE_URL + "/users/@me"
-            )
-        else:
+        if not token:
             raise UnauthenticatedError("User has not been logged in.")
+        access_token = token["access_token"]  # type: ignore
 
-        data = response.json()
+        identity = discord.identities.get(access_token)
+        if identity is None:
+            identity = await discord.fetch_identity(app, access_token)
+            if identity is None:
+                raise UnauthenticatedError("Discord did not accept the access token.")
+            return await cls._sync_discord(app, identity)
 
-        _id = str(data.get("id"))
-        username = data.get("username")
+        if identity.stale:
+            # serve the cached identity for now, the stored username is updated
+            # once the refreshed identity comes back
+            discord.refresh_identity(app, access_token, partial(cls._sync_discord, app))
 
         try:
-            record = await cls.from_db(app, _id, discord=True)
+            return await cls.from_db(app, identity.id, discord=True)
+        except TypeError:
+            # query returned None, user doesn't exist in db
+            return await cls._sync_discord(app, identity)
+
+    @classmethod
+    async def _sync_discord(cls, app: Sanic, identity: discord.Identity) -> "User":
+        """Registers a Discord user in the database, or updates their stored username."""
+        try:
+            record = await cls.from_db(app, identity.id, discord=True)
 
         except TypeError:
             # query returned None, user doesn't exist in db
@@ -70,21 +114,21 @@ class User:
             await app.ctx.db.execute(
                 "INSERT INTO users(uid, username, discord_id) VALUES(:uid, :username, :discord_id)",
                 uid=uid,
-                username=data.get("username"),
-                discord_id=_id,
+                username=identity.username,
+                discord_id=identity.id,
             )
-            return cls(uid=uid, username=username, discord_id=_id)
+            return cls(uid=uid, username=identity.username, discord_id=identity.id)
         else:
             # if the username from the api is different than the one we've stored, update it
-            if username != record.username:
+            if identity.username != record.username:
                 await app.ctx.db.execute(
                     "UPDATE users SET username = :username WHERE uid = :uid",
-                    username=username,
+                    username=identity.username,
                     uid=record.uid,
                 )
             return cls(
                 uid=record.uid,
-                username=username,
+                username=identity.username,
                 discord_id=record.discord_id,
                 tz=record.tz,
             )
@@ -134,22 +178,11 @@ class User:
     async def from_db(cls, app: Sanic, _id: str, *, discord: bool = False) -> "User":
         """Fetches a user's record from the database.
         If `discord` is set to True, the matching row with provided discord ID will be returned."""
-        if discord:
-            return cls(
-                **(
-                    await app.ctx.db.fetchrow(
-                        "SELECT * FROM users WHERE discord_id = :_id", _id=_id
-                    )
-                )
-            )
-        else:
-            return cls(
-                **(
-                    await app.ctx.db.fetchrow(
-                        "SELECT * FROM users WHERE uid = :_id", _id=_id
-                    )
-                )
-            )
+        column = "discord_id" if discord else "uid"
+        record = await app.ctx.db.fetchrow(
+            f"SELECT {USER_COLUMNS} FROM users WHERE {column} = :_id", _id=_id
+        )
+        return to_record(cls, record)
 
     async def get_events(self, app: Sanic) -> List[Mapping]:
         """Gets a user's events from the database."""
@@ -159,6 +192,67 @@ class User:
             uid=self.uid,
         )
 
+    async def get_dashboard(
+        self,
+        app: Sanic,
+        *,
+        limit: int,
+        joined_before: Optional[int] = None,
+        owned_before: Optional[int] = None,
+    ) -> Tuple[Page, Page]:
+        """
+        Gets one page of the user's joined events, and one page of their owned events,
+        in a single query.
+        Both lists are ordered newest first, by event snowflake.
+
+        Arguments ::
+            app: Sanic -> The running Sanic instance.
+            limit: int -> Number of events per page.
+            joined_before: Optional[int] -> Cursor of the joined events page.
+            owned_before: Optional[int] -> Cursor of the owned events page.
+
+        Returns ::
+            Tuple of (joined events, owned events) pages, with the raw records as items.
+        """
+        # each side fetches one extra row to find out if there's a next page.
+        # the sqlite backend of `databases` can't bind the same parameter twice,
+        # hence the duplicated values. both sides walk an index on
+        # (user, CAST(event_id AS BIGINT)), see DASHBOARD_INDEXES in src/migrations.py
+        columns = ", ".join(f"e.{column}" for column in DASHBOARD_COLUMNS.split(", "))
+        records = await app.ctx.db.fetch(
+            f"""SELECT * FROM (
+                SELECT 'joined' AS list, {columns} FROM users_events ue
+                JOIN events e ON e.event_id = ue.event_id
+                WHERE ue.uid = :joined_uid
+                AND CAST(ue.event_id AS BIGINT) < :joined_before
+                ORDER BY CAST(ue.event_id AS BIGINT) DESC LIMIT :joined_limit
+            ) AS joined
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'owned' AS list, {DASHBOARD_COLUMNS} FROM events
+                WHERE event_owner = :owned_uid
+                AND CAST(event_id AS BIGINT) < :owned_before
+                ORDER BY CAST(event_id AS BIGINT) DESC LIMIT :owned_limit
+            ) AS owned""",
+            joined_uid=self.uid,
+            joined_before=joined_before or MAX_CURSOR,
+            joined_limit=limit + 1,
+            owned_uid=self.uid,
+            owned_before=owned_before or MAX_CURSOR,
+            owned_limit=limit + 1,
+        )
+
+        pages = []
+        for name in ("joined", "owned"):
+            items = [i for i in records if i["list"] == name]
+            page = Page(items=items[:limit])
+            if len(items) > limit:
+                page.next_cursor = str(page.items[-1]["event_id"]).strip()
+            pages.append(page)
+
+        joined, owned = pages
+        return joined, owned
+
     async def set_tz(self, app: Sanic, tz: str) -> None:
         """Sets the user's timezone."""
         self.tz = tz
@@ -167,20 +261,74 @@ class User:
         )
 
     async def join_event(self, app: Sanic, event: Event) -> None:
-        """Adds the user to specified event."""
-        await app.ctx.db.execute(
-            "INSERT INTO users_events(uid, event_id) VALUES(:uid, :eid)",
-            uid=self.uid,
-            eid=event.event_id,
-        )
+        """Adds the user to specified event, and counts them in it's `member_count`."""
+        async with app.ctx.db.transaction():
+            if await self._lock_membership(app, event):
+                return
+            await app.ctx.db.execute(
+                "INSERT INTO users_events(uid, event_id) VALUES(:uid, :eid)",
+                uid=self.uid,
+                eid=event.event_id,
+            )
+            await app.ctx.db.execute(TOUCH_USER, now=datetime.utcnow(), uid=self.uid)
+            await app.ctx.db.execute(
+                "UPDATE events SET member_count = member_count + 1 "
+                "WHERE event_id = :id",
+                id=event.event_id,
+            )
+        app.ctx.page_cache.invalidate(int(event.event_id))
+        self._publish_membership(app, event, "join")
 
     async def leave_event(self, app: Sanic, event: Event) -> None:
-        """Removes the user from the specified event."""
+        """Removes the user from the specified event, and from it's `member_count`."""
+        async with app.ctx.db.transaction():
+            if not await self._lock_membership(app, event):
+                return
+            await app.ctx.db.execute(
+                "DELETE FROM users_events WHERE uid=:uid AND event_id=:eid",
+                uid=self.uid,
+                eid=event.event_id,
+            )
+            await app.ctx.db.execute(TOUCH_USER, now=datetime.utcnow(), uid=self.uid)
+            await app.ctx.db.execute(
+                "UPDATE events SET member_count = member_count - 1 "
+                "WHERE event_id = :id",
+                id=event.event_id,
+            )
+        app.ctx.page_cache.invalidate(int(event.event_id))
+        self._publish_membership(app, event, "leave")
+        app.ctx.chat.remove_member(app, event.event_id, self.uid)
+
+    async def _lock_membership(self, app: Sanic, event: Event) -> bool:
+        """
+        Locks the event's row for the rest of the transaction, so that concurrent joins
+        and leaves of the same event can't both change the count, then returns
+        whether this user is a member of it.
+        """
+        # a no-op update takes the row lock on postgres, and the write lock on sqlite
         await app.ctx.db.execute(
-            "DELETE FROM users_events WHERE uid=:uid AND event_id=:eid",
-            uid=self.uid,
-            eid=event.event_id,
+            "UPDATE events SET member_count = member_count WHERE event_id = :id",
+            id=event.event_id,
         )
+        return await self.is_member(app, event.event_id)
+
+    async def is_member(self, app: Sanic, event_id: str) -> bool:
+        """Whether this user is a member of the event."""
+        return bool(
+            await app.ctx.db.fetchval(
+                "SELECT 1 FROM users_events WHERE event_id = :eid AND uid = :uid",
+                eid=event_id,
+                uid=self.uid,
+            )
+        )
+
+    def _publish_membership(self, app: Sanic, event: Event, action: str) -> None:
+        """Tells the live member lists of the event, see `members_topic`."""
+        # serialized once, whatever the number of subscribers
+        delta = json.dumps(
+            {"action": action, "uid": self.uid.strip(), "username": self.username}
+        )
+        app.ctx.hub.publish(members_topic(event.event_id), delta)
 
     async def get_owned_events(self, app: Sanic) -> List[Mapping]:
         """Get all events owned by this user."""
@@ -192,12 +340,54 @@ class User:
         """
         Deletes a user and the events they own.
         """
-        # same TODO as src/events.py
-        await app.ctx.db.execute(
-            "DELETE FROM users_events WHERE uid = :id", id=self.uid
-        )
-        await app.ctx.db.execute("DELETE FROM events WHERE owner_id = :id", id=self.uid)
-        await app.ctx.db.execute("DELETE FROM users WHERE uid = :id", id=self.uid)
+        now = datetime.utcnow()
+        if app.ctx.db.dialect == "postgresql":
+            # one statement is atomic by itself, and one round trip
+            owned = await app.ctx.db.fetch(DELETE_USER_POSTGRESQL, now=now, id=self.uid)
+        else:
+            # same note as in src/events.py, delete from every table explicitly
+            async with app.ctx.db.unit_of_work() as work:
+                owned = await work.fetch(
+                    "SELECT event_id FROM events WHERE event_owner = :id", id=self.uid
+                )
+                work.execute(
+                    """UPDATE events SET member_count = member_count - 1
+                        WHERE event_id IN
+                        (SELECT event_id FROM users_events WHERE uid = :id)""",
+                    id=self.uid,
+                )
+                work.execute("DELETE FROM users_events WHERE uid = :id", id=self.uid)
+                # other members of the events this user owns
+                work.execute(
+                    """UPDATE users SET memberships_updated_at = :now WHERE uid IN
+                        (SELECT uid FROM users_events WHERE event_id IN
+                        (SELECT event_id FROM events WHERE event_owner = :id))""",
+                    now=now,
+                    id=self.uid,
+                )
+                work.execute(
+                    """DELETE FROM users_events WHERE event_id IN
+                        (SELECT event_id FROM events WHERE event_owner = :id)""",
+                    id=self.uid,
+                )
+                work.execute(
+                    """DELETE FROM events_fts WHERE rowid IN
+                        (SELECT CAST(event_id AS INTEGER) FROM events
+                        WHERE event_owner = :id)""",
+                    id=self.uid,
+                )
+                work.execute(
+                    """DELETE FROM chat_messages WHERE event_id IN
+                        (SELECT event_id FROM events WHERE event_owner = :id)""",
+                    id=self.uid,
+                )
+                work.execute("DELETE FROM events WHERE event_owner = :id", id=self.uid)
+                work.execute("DELETE FROM users WHERE uid = :id", id=self.uid)
+
+        for record in owned:
+            app.ctx.page_cache.invalidate(int(record["event_id"]))
+            app.ctx.chat.forget(app, record["event_id"])
+        app.ctx.chat.remove_user(app, self.uid)
 
 
 def authorized():
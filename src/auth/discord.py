@@ -1,12 +1,20 @@
+import asyncio
 import os
+from dataclasses import dataclass, field
 from functools import partial
-from typing import Callable, Union
+from time import monotonic
+from typing import Awaitable, Callable, Optional, Set, Union
 
+import aiohttp
 from async_oauthlib import OAuth2Session
 from dotenv import find_dotenv, load_dotenv
 from sanic import Sanic
+from sanic.exceptions import SanicException
+from sanic.log import logger
 from sanic.request import Request
 
+from src.cache import TTLCache
+
 load_dotenv(find_dotenv())
 
 
@@ -18,6 +26,37 @@ API_BASE_URL = "https://discord.com/api"
 AUTHORIZATION_BASE_URL = API_BASE_URL + "/oauth2/authorize"
 TOKEN_URL = API_BASE_URL + "/oauth2/token"
 
+# a cached identity is served as is for IDENTITY_TTL seconds,
+# and refreshed in the background until it is IDENTITY_MAX_AGE seconds old
+IDENTITY_TTL = float(os.environ.get("DISCORD_IDENTITY_TTL", 300))
+IDENTITY_MAX_AGE = float(os.environ.get("DISCORD_IDENTITY_MAX_AGE", 3600))
+IDENTITY_CACHE_SIZE = int(os.environ.get("DISCORD_IDENTITY_CACHE_SIZE", 10000))
+
+
+class DiscordUnavailableError(SanicException):
+    """Exception raised when Discord can't be reached, or is rate limiting us."""
+
+    status_code = 503
+
+
+@dataclass
+class Identity:
+    """A user's identity, as returned by the /users/@me endpoint."""
+
+    id: str
+    username: str
+    fetched_at: float = field(default_factory=monotonic)
+
+    @property
+    def stale(self) -> bool:
+        return monotonic() - self.fetched_at > IDENTITY_TTL
+
+
+# resolved identities, keyed by access token
+identities = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_MAX_AGE)
+# access tokens which are being refreshed in the background right now
+_refreshing: Set[str] = set()
+
 
 def make_session(
     *, token: dict = None, state: dict = None, token_updater: Callable = None
@@ -35,9 +74,18 @@ def make_session(
     )
 
 
+def compact_token(token: dict) -> dict:
+    """Keeps only the parts of an OAuth2 token we use, so that the session stays small."""
+    return {
+        key: token[key]
+        for key in ("access_token", "refresh_token", "token_type", "expires_at")
+        if key in token
+    }
+
+
 def token_updater(request: Request, token: dict) -> None:
     # has to be made into a partial function before use
-    request.ctx.session["discord_oauth2_token"] = token
+    request.ctx.session["discord_oauth2_token"] = compact_token(token)
 
 
 async def redirect_to_oauth2(request: Request) -> str:
@@ -72,10 +120,70 @@ async def handle_callback(request: Request) -> bool:
     token = await discord.fetch_token(
         TOKEN_URL, client_secret=CLIENT_SECRET, authorization_response=request.url
     )
-    request.ctx.session["discord_oauth2_token"] = token
+    request.ctx.session.pop("discord_oauth2_state", None)
+    request.ctx.session["discord_oauth2_token"] = compact_token(token)
     return True
 
 
+async def fetch_identity(app: Sanic, access_token: str) -> Optional[Identity]:
+    """
+    Fetches the user's identity from Discord, and caches it.
+    Returns None if Discord did not accept the access token.
+
+    Raises ::
+        DiscordUnavailableError, if Discord is rate limiting us, failing or can't be
+        reached. The cached identity is kept then.
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    url = API_BASE_URL + "/users/@me"
+    try:
+        async with app.ctx.http.get(url, headers=headers) as response:
+            if response.status == 401:
+                # the token expired or was revoked
+                identities.pop(access_token)
+                return None
+            if response.status != 200:
+                raise DiscordUnavailableError(
+                    f"Discord answered {response.status}, try again later."
+                )
+            data = await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # ContentTypeError, when the body isn't JSON, is a ClientError too
+        raise DiscordUnavailableError("Discord is unavailable, try again later.") from e
+
+    if not data.get("id"):
+        raise DiscordUnavailableError("Discord sent an identity without an id.")
+
+    identity = Identity(id=str(data["id"]), username=data.get("username"))
+    identities.set(access_token, identity)
+    return identity
+
+
+def refresh_identity(
+    app: Sanic, access_token: str, callback: Callable[[Identity], Awaitable[None]]
+) -> None:
+    """
+    Refreshes a cached identity in the background.
+    `callback` is awaited with the new identity once it has been fetched. If Discord
+    is unavailable, the cached identity keeps being served until it's max age.
+    """
+    if access_token in _refreshing:
+        return
+    _refreshing.add(access_token)
+
+    async def refresh() -> None:
+        try:
+            identity = await fetch_identity(app, access_token)
+            if identity:
+                await callback(identity)
+        except DiscordUnavailableError as e:
+            logger.warning(f"Refreshing a Discord identity failed: {e}")
+        finally:
+            _refreshing.discard(access_token)
+
+    app.add_task(refresh())
+
+
 def check_logged_in(request: Request) -> Union[dict, bool]:
     """Returns the user's token if they finished authentication with discord, else return False."""
     token = request.ctx.session.get("discord_oauth2_token")
@@ -2,22 +2,31 @@
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from functools import partial
-import json
+from time import time
 from typing import Literal, Optional, Union
 
 from firebase_admin import auth, exceptions
 from firebase_admin.auth import UserRecord
 from firebase_admin._auth_utils import UserNotFoundError
-import requests
 from sanic import Sanic
 from sanic.request import Request
 from sanic.exceptions import ServerError
 
+from src.cache import TTLCache
 from src.server import app
 
 
 API_URL = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword"
 
+# claims of session cookies whose signature was already verified, keyed by the cookie
+verified_cookies = TTLCache(
+    maxsize=app.config.SESSION_CACHE_SIZE, ttl=app.config.SESSION_CACHE_TTL
+)
+# uids whose refresh tokens were checked for revocation recently
+revocation_checked = TTLCache(
+    maxsize=app.config.SESSION_CACHE_SIZE, ttl=app.config.FIREBASE_REVOCATION_INTERVAL
+)
+
 
 @dataclass
 class TypedUserRecord:
@@ -79,17 +88,11 @@ async def authenticate_user(app: Sanic, email: str, password: str) -> Optional[d
         Raw response dictionary from the API if the user passed authentication.
         This dictionary will be added to the user's `session` (request.ctx.session) to retrieve user ID later.
     """
-    payload = json.dumps(
-        {"email": email, "password": password, "returnSecureToken": True}
-    )
-    post = partial(
-        requests.post,
-        API_URL,
-        params={"key": app.config.FIREBASE_API_KEY},
-        data=payload,
-    )
-    response = await app.loop.run_in_executor(None, post)
-    response_data = response.json()
+    payload = {"email": email, "password": password, "returnSecureToken": True}
+    async with app.ctx.http.post(
+        API_URL, params={"key": app.config.FIREBASE_API_KEY}, json=payload
+    ) as response:
+        response_data = await response.json()
 
     if not response_data.get("idToken"):
         # the API didn't give back a regenerate token, so the authentication was a failure
@@ -168,6 +171,54 @@ async def delete_session_cookie(app: Sanic, request: Request) -> None:
     except auth.InvalidSessionCookieError:
         raise ServerError("Tried to revoke an invalid session cookie", quiet=True)
 
+    verified_cookies.pop(session_cookie)
+    revocation_checked.pop(decoded_claims["sub"])
+
+
+async def verify_session_cookie(session_cookie: str) -> Union[dict, Literal[False]]:
+    """
+    Verifies a session cookie, and returns it's decoded claims.
+    The signature is checked locally against Google's public keys (which firebase-admin caches),
+    and the claims are cached for `SESSION_CACHE_TTL` seconds.
+    The revocation check needs an API call, so it is done at most once
+    every `FIREBASE_REVOCATION_INTERVAL` seconds per user.
+
+    Returns ::
+        The decoded claims if the cookie is valid, else `bool` False.
+    """
+    claims = verified_cookies.get(session_cookie)
+    if claims is None:
+        verify = partial(
+            auth.verify_session_cookie, session_cookie, check_revoked=False
+        )
+        try:
+            claims = await app.loop.run_in_executor(None, verify)
+        except auth.InvalidSessionCookieError:
+            return False
+        # never keep the claims around for longer than the cookie itself is valid
+        ttl = min(verified_cookies.ttl, claims["exp"] - time())
+        verified_cookies.set(session_cookie, claims, ttl=ttl)
+
+    if revocation_checked.get(claims["uid"]) is None:
+        verify = partial(auth.verify_session_cookie, session_cookie, check_revoked=True)
+        try:
+            await app.loop.run_in_executor(None, verify)
+        except (auth.InvalidSessionCookieError, UserNotFoundError):
+            # RevokedSessionCookieError is a subclass of InvalidSessionCookieError
+            verified_cookies.pop(session_cookie)
+            return False
+        revocation_checked.set(claims["uid"], True)
+
+    return claims
+
+
+def session_cache_stats() -> dict:
+    """Hit/miss counters of the session cookie caches."""
+    return {
+        "verified_cookies": verified_cookies.stats(),
+        "revocation_checked": revocation_checked.stats(),
+    }
+
 
 async def check_logged_in(request: Request) -> Union[dict, Literal[False]]:
     """Checks whether a user is signed in (on Firebase, with email and password).
@@ -178,14 +229,7 @@ async def check_logged_in(request: Request) -> Union[dict, Literal[False]]:
     if not session_cookie:
         return False
 
-    try:
-        verify_session_cookie = partial(
-            auth.verify_session_cookie, session_cookie, check_revoked=True
-        )
-        val = await app.loop.run_in_executor(None, verify_session_cookie)
-        return val
-    except (auth.InvalidSessionCookieError, UserNotFoundError):
-        return False
+    return await verify_session_cookie(session_cookie)
 
 
 # TODO: make delete, update user functions
@@ -0,0 +1,140 @@
+"""Small in-process caches used on the hot paths of the app."""
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+from time import monotonic
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    A bounded mapping whose entries expire after `ttl` seconds.
+    Once `maxsize` entries are stored, the least recently used one is evicted.
+
+    Hit/miss counters are kept so they can be exposed for monitoring.
+    This is NOT thread-safe, it is meant to be used from the event loop only.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, count=False) is not None
+
+    def get(self, key: Hashable, default: Any = None, *, count: bool = True) -> Any:
+        """Returns the value stored for `key`, or `default` if it is missing or has expired."""
+        item = self._data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires > monotonic():
+                self._data.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            del self._data[key]
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Stores `value` under `key`.
+        `ttl` overrides the cache-wide TTL for this entry only.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._data[key] = (monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: str
+    expires: float
+
+
+class ResponseCache:
+    """
+    Caches rendered response bodies, with an ETag for each of them.
+    The cache is bounded by the total size of the bodies, in bytes,
+    and the least recently used bodies are evicted first.
+
+    Entries also expire after `ttl` seconds, as `invalidate` only reaches the
+    cache of the worker it was called in.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        response = self._data.get(key)
+        if response is not None and response.expires > monotonic():
+            self._data.move_to_end(key)
+            self.hits += 1
+            return response
+
+        if response is not None:
+            self.invalidate(key)
+        self.misses += 1
+        return None
+
+    def set(self, key: Hashable, body: bytes) -> CachedResponse:
+        """Caches `body` under `key`, and returns it with it's ETag."""
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        response = CachedResponse(body=body, etag=etag, expires=monotonic() + self.ttl)
+        if len(body) > self.max_bytes:
+            # too big to ever be cached, but the ETag is still useful
+            return response
+
+        self.invalidate(key)
+        self._data[key] = response
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.size -= len(evicted.body)
+        return response
+
+    def invalidate(self, key: Hashable) -> None:
+        response = self._data.pop(key, None)
+        if response is not None:
+            self.size -= len(response.body)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,499 @@
+"""
+Chat between the members of an event, over a WebSocket at /event/<id>/chat.
+
+Messages are serialized once, and fanned out to the connections of the room through
+the pub/sub hub (see src/pubsub.py), which drops connections that can't keep up. The
+messages posted to a room during one iteration of the event loop are published as
+one frame, so that a burst of them takes one slot of each connection's queue, and one
+send per connection, instead of one per message.
+Every room keeps it's latest CHAT_RECENT messages in a ring buffer, so joining a room
+and reading recent history don't touch the database.
+
+Messages are persisted in batches: they are queued, and written with one
+`executemany` every CHAT_FLUSH_INTERVAL seconds, or as soon as CHAT_FLUSH_SIZE of
+them are queued. Until then they are only kept in memory, and lost if the worker
+dies.
+
+Rooms, their connections and the hub are per worker process. With several workers
+(or nodes), the messages and the changes to the rooms are passed on to the other
+workers through Redis pub/sub (CHAT_REDIS_URL), which put them in their rooms too.
+Messages of other workers that may not be written yet are kept for a while, and
+merged into the rooms loaded and the history read meanwhile, like the messages
+queued by this worker.
+"""
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+import json
+from time import monotonic
+from typing import Any, Deque, Dict, List, Mapping, NamedTuple, Optional, Set, Tuple
+from uuid import uuid4
+
+import aioredis
+from sanic import Sanic
+from sanic.log import logger
+
+from src.utils import to_datetime
+
+
+# matches the body column of the chat_messages table
+CHAT_MESSAGE_LENGTH = 1000
+# queued messages are dropped past this many flushes worth of them,
+# if the database is down
+CHAT_MAX_PENDING_FLUSHES = 10
+# largest BIGINT, used as the cursor for the first page of history
+MAX_CURSOR = 2 ** 63 - 1
+# the Redis channel the workers pass messages and room changes on
+CHAT_CHANNEL = "eventinator:chat"
+# seconds between attempts to resubscribe to CHAT_CHANNEL
+CHAT_RECONNECT_DELAY = 1.0
+
+CHAT_COLUMNS = "message_id, uid, username, body, sent_at"
+INSERT_MESSAGE = f"""INSERT INTO chat_messages(event_id, {CHAT_COLUMNS})
+    VALUES(:event_id, :message_id, :uid, :username, :body, :sent_at)"""
+
+
+def chat_topic(event_id: str) -> str:
+    """The pub/sub topic of an event's chat, messages are published as JSON."""
+    return f"event:{event_id.strip()}:chat"
+
+
+def serialize(record: Mapping) -> str:
+    """A chat message as sent to the clients, from a row of chat_messages."""
+    return json.dumps(
+        {
+            "type": "message",
+            # as a string, snowflakes don't fit in a javascript number
+            "message_id": str(record["message_id"]),
+            "uid": record["uid"].strip(),
+            "username": record["username"],
+            "body": record["body"],
+            "sent_at": to_datetime(record["sent_at"]).isoformat(),
+        }
+    )
+
+
+def history_json(messages: List[str], cursor: Optional[str]) -> str:
+    """
+    A page of history as sent to the clients, from the serialized messages,
+    which are joined as they are instead of being parsed and dumped again.
+    """
+    return (
+        f'{{"type": "history", "messages": [{", ".join(messages)}], '
+        f'"next": {json.dumps(cursor)}}}'
+    )
+
+
+class ChatMessage(NamedTuple):
+    message_id: int
+    payload: str  # see `serialize`
+
+
+class RateLimit:
+    """Allows up to `count` messages in any `period` seconds."""
+
+    __slots__ = ("period", "times")
+
+    def __init__(self, count: int, period: float) -> None:
+        self.period = period
+        self.times: Deque[float] = deque(maxlen=count)
+
+    def allow(self) -> bool:
+        now = monotonic()
+        if len(self.times) == self.times.maxlen and now - self.times[0] < self.period:
+            return False
+        self.times.append(now)
+        return True
+
+
+@dataclass
+class ChatRoom:
+    """The chat of one event, in this worker."""
+
+    event_id: str
+    # the latest messages, oldest first
+    recent: Deque[ChatMessage]
+    # whether `recent` holds every message of the event
+    complete: bool = False
+    # open WebSockets, by (stripped) uid
+    connections: Dict[str, Set[Any]] = field(default_factory=dict)
+    loaded: Optional[asyncio.Future] = None
+    # the messages received since the last publish, they are in `recent` already
+    outbox: List[ChatMessage] = field(default_factory=list)
+
+    def remember(self, message: ChatMessage) -> None:
+        """Adds a message to `recent`, in the order of the message IDs."""
+        if len(self.recent) == self.recent.maxlen:
+            self.complete = False
+        if not self.recent or self.recent[-1].message_id < message.message_id:
+            self.recent.append(message)
+            return
+        # a message of another worker, that was posted before the latest one
+        messages = sorted({*self.recent, message})[-self.recent.maxlen :]
+        self.recent.clear()
+        self.recent.extend(messages)
+
+    def connect(self, uid: str, ws: Any) -> None:
+        self.connections.setdefault(uid, set()).add(ws)
+
+    def disconnect(self, uid: str, ws: Any) -> None:
+        sockets = self.connections.get(uid)
+        if sockets is not None:
+            sockets.discard(ws)
+            if not sockets:
+                del self.connections[uid]
+
+    def close(self, uid: Optional[str] = None, reason: str = "") -> None:
+        """Closes the connections of `uid`, or all of them."""
+        uids = list(self.connections) if uid is None else [uid]
+        for i in uids:
+            for ws in self.connections.pop(i, ()):
+                asyncio.ensure_future(ws.close(code=4003, reason=reason))
+
+
+class Chat:
+    """
+    The chat rooms of this worker, and the messages waiting to be written.
+    This is NOT thread-safe, it is meant to be used from the event loop only.
+    """
+
+    def __init__(
+        self,
+        *,
+        recent: int = 100,
+        max_rooms: int = 1000,
+        flush_size: int = 500,
+        flush_interval: float = 1.0,
+        redis_url: Optional[str] = None,
+    ) -> None:
+        self.recent = recent
+        self.max_rooms = max_rooms
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.redis_url = redis_url
+        self.rooms: Dict[str, ChatRoom] = {}
+        self.pending: List[Dict[str, Any]] = []
+        # messages of the other workers, as sent on CHAT_CHANNEL, that may not be
+        # written yet
+        self.received: Deque[Dict[str, Any]] = deque(
+            maxlen=flush_size * CHAT_MAX_PENDING_FLUSHES
+        )
+        self.flushed = 0
+        self.dropped = 0
+        self._flush_now: Optional[asyncio.Event] = None
+        self.redis: Optional[aioredis.Redis] = None
+        # set in `connect`, the workers are forked after this is created
+        self.origin = ""
+        # changes to send to the other workers, see `_broadcast`
+        self.outgoing: List[Dict[str, Any]] = []
+
+    async def connect(self) -> None:
+        """Connects to Redis, if the chat is shared with other workers."""
+        self.origin = uuid4().hex
+        if self.redis_url:
+            # one connection, so that changes are published in order
+            self.redis = await aioredis.create_redis(self.redis_url)
+
+    async def disconnect(self) -> None:
+        if self.redis is not None:
+            self.redis.close()
+            await self.redis.wait_closed()
+            self.redis = None
+
+    async def room(self, app: Sanic, event_id: str) -> ChatRoom:
+        """The room of an event, with it's latest messages loaded."""
+        event_id = event_id.strip()
+        room = self.rooms.pop(event_id, None)
+        if room is None:
+            room = ChatRoom(event_id, deque(maxlen=self.recent))
+            room.loaded = asyncio.ensure_future(self._load(app, room))
+            self._evict_idle_rooms()
+        self.rooms[event_id] = room  # most recently used last
+
+        try:
+            await asyncio.shield(room.loaded)
+        except Exception:
+            if self.rooms.get(event_id) is room:
+                del self.rooms[event_id]
+            raise
+        return room
+
+    async def _load(self, app: Sanic, room: ChatRoom) -> None:
+        records = await app.ctx.db.fetch(
+            f"""SELECT {CHAT_COLUMNS} FROM chat_messages
+                WHERE event_id = :event_id
+                ORDER BY message_id DESC LIMIT :limit""",
+            event_id=room.event_id,
+            limit=self.recent,
+        )
+        messages = {int(i["message_id"]): serialize(i) for i in records}
+        messages.update(self._unwritten(room.event_id))
+        # and the messages received while loading
+        messages.update(room.recent)
+
+        latest = sorted(messages.items())[-self.recent :]
+        room.recent.clear()
+        room.recent.extend(ChatMessage(*i) for i in latest)
+        room.complete = len(messages) < self.recent
+
+    def _unwritten(self, event_id: str, before: int = MAX_CURSOR) -> Dict[int, str]:
+        """
+        The messages of an event that may not be written yet, by this worker or by
+        the others, as {message ID: payload}.
+        """
+        messages = {
+            i["message_id"]: serialize(i)
+            for i in self.pending
+            if i["event_id"] == event_id and i["message_id"] < before
+        }
+        for i in self.received:
+            if i["event_id"] == event_id and i["message_id"] < before:
+                messages[i["message_id"]] = i["payload"]
+        return messages
+
+    def _evict_idle_rooms(self) -> None:
+        # least recently used first
+        for event_id in list(self.rooms):
+            if len(self.rooms) < self.max_rooms:
+                return
+            if not self.rooms[event_id].connections:
+                del self.rooms[event_id]
+
+    def post(
+        self, app: Sanic, room: ChatRoom, uid: str, username: str, body: str
+    ) -> None:
+        """Sends a message to the room, and queues it to be written."""
+        record = {
+            "event_id": room.event_id,
+            "message_id": next(app.ctx.snowflake),
+            "uid": uid,
+            "username": username,
+            "body": body,
+            "sent_at": datetime.utcnow(),
+        }
+        self.pending.append(record)
+        if len(self.pending) >= self.flush_size and self._flush_now is not None:
+            self._flush_now.set()
+
+        self._broadcast(
+            app,
+            {
+                "type": "message",
+                "event_id": room.event_id,
+                "message_id": record["message_id"],
+                "payload": serialize(record),
+            },
+        )
+
+    def _broadcast(self, app: Sanic, change: Dict[str, Any]) -> None:
+        """
+        Applies a change to the rooms of this worker, and sends it to the other
+        workers. The changes made during one iteration of the event loop are sent
+        as one message.
+        """
+        self._apply(app, change)
+        if self.redis is None:
+            return
+        self.outgoing.append(change)
+        if len(self.outgoing) == 1:
+            asyncio.get_event_loop().call_soon(self._send)
+
+    def _send(self) -> None:
+        changes, self.outgoing = self.outgoing, []
+        if self.redis is None:
+            return
+        message = json.dumps({"origin": self.origin, "changes": changes})
+        asyncio.ensure_future(self._send_message(self.redis, message))
+
+    @staticmethod
+    async def _send_message(redis: aioredis.Redis, message: str) -> None:
+        try:
+            await redis.publish(CHAT_CHANNEL, message)
+        except Exception:
+            logger.exception("Sending chat changes to the other workers failed")
+
+    async def run_receiver(self, app: Sanic) -> None:
+        """
+        Applies the changes sent by the other workers forever, meant to be run as a
+        background task. The changes sent while it is not subscribed are lost, the
+        messages among them are only read from the database.
+        """
+        while True:
+            try:
+                redis = await aioredis.create_redis(self.redis_url)
+                try:
+                    [channel] = await redis.subscribe(CHAT_CHANNEL)
+                    async for message in channel.iter(encoding="utf-8"):
+                        self._receive(app, json.loads(message))
+                finally:
+                    redis.close()
+                    await redis.wait_closed()
+            except Exception:
+                logger.exception("Receiving chat changes from the other workers failed")
+            await asyncio.sleep(CHAT_RECONNECT_DELAY)
+
+    def _receive(self, app: Sanic, message: Dict[str, Any]) -> None:
+        if message["origin"] == self.origin:
+            return
+        for change in message["changes"]:
+            if change["type"] == "message":
+                self.received.append(change)
+            self._apply(app, change)
+
+    def _apply(self, app: Sanic, change: Dict[str, Any]) -> None:
+        """Applies a change sent by `_broadcast`, to the rooms of this worker."""
+        kind = change["type"]
+        if kind == "message":
+            room = self.rooms.get(change["event_id"])
+            if room is None:
+                # it is loaded with the messages when someone joins
+                return
+            message = ChatMessage(change["message_id"], change["payload"])
+            room.remember(message)
+            room.outbox.append(message)
+            if len(room.outbox) == 1:
+                asyncio.get_event_loop().call_soon(self._publish, app, room)
+        elif kind == "forget":
+            event_id = change["event_id"]
+            room = self.rooms.pop(event_id, None)
+            if room is not None:
+                room.close(reason="This event was deleted.")
+            self.pending = [i for i in self.pending if i["event_id"] != event_id]
+            self.received = deque(
+                (i for i in self.received if i["event_id"] != event_id),
+                maxlen=self.received.maxlen,
+            )
+        elif kind == "remove_member":
+            room = self.rooms.get(change["event_id"])
+            if room is not None:
+                room.close(change["uid"], reason="You left this event.")
+        elif kind == "remove_user":
+            for room in self.rooms.values():
+                room.close(change["uid"], reason="Your account was deleted.")
+
+    def _publish(self, app: Sanic, room: ChatRoom) -> None:
+        messages, room.outbox = room.outbox, []
+        app.ctx.hub.publish(
+            chat_topic(room.event_id),
+            f'{{"type": "messages", "messages": '
+            f'[{", ".join(i.payload for i in messages)}]}}',
+        )
+
+    def snapshot(self, room: ChatRoom) -> Tuple[List[str], Optional[str]]:
+        """
+        The ring buffer of the room, like a page of `history`, for a connection
+        subscribed just now. The messages in the outbox are left out, the connection
+        gets them when they are published.
+        """
+        unpublished = {i.message_id for i in room.outbox}
+        messages = [
+            i.payload for i in reversed(room.recent) if i.message_id not in unpublished
+        ]
+        complete = room.complete or not room.recent
+        return messages, None if complete else str(room.recent[0].message_id)
+
+    def history(
+        self, room: Optional[ChatRoom], before: Optional[int], limit: int
+    ) -> Optional[Tuple[List[str], Optional[str]]]:
+        """
+        Serves a page of history from the ring buffer of the room, if it has it.
+
+        Returns ::
+            (messages newest first, cursor of the next page),
+            or None if the page has to be read with `read_history`.
+        """
+        if room is None or room.loaded is None or not room.loaded.done():
+            return None
+        older = [i for i in room.recent if before is None or i.message_id < before]
+        if len(older) <= limit and not room.complete:
+            return None
+
+        page = older[-limit:]
+        cursor = str(page[0].message_id) if len(older) > limit else None
+        return [i.payload for i in reversed(page)], cursor
+
+    async def read_history(
+        self, app: Sanic, event_id: str, before: Optional[int], limit: int
+    ) -> Tuple[List[str], Optional[str]]:
+        """Reads a page of history from the database, see `history`."""
+        # one extra row to find out if there's a next page
+        records = await app.ctx.db.fetch(
+            f"""SELECT {CHAT_COLUMNS} FROM chat_messages
+                WHERE event_id = :event_id AND message_id < :before
+                ORDER BY message_id DESC LIMIT :limit""",
+            event_id=event_id,
+            before=before or MAX_CURSOR,
+            limit=limit + 1,
+        )
+        messages = {int(i["message_id"]): serialize(i) for i in records}
+        messages.update(self._unwritten(event_id, before or MAX_CURSOR))
+
+        ids = sorted(messages, reverse=True)
+        page = ids[:limit]
+        cursor = str(page[-1]) if len(ids) > limit else None
+        return [messages[i] for i in page], cursor
+
+    def forget(self, app: Sanic, event_id: str) -> None:
+        """
+        Closes the room of a deleted event, and drops it's unwritten messages,
+        in every worker.
+        """
+        self._broadcast(app, {"type": "forget", "event_id": event_id.strip()})
+
+    def remove_member(self, app: Sanic, event_id: str, uid: str) -> None:
+        """Closes the connections of a user who left the event, in every worker."""
+        self._broadcast(
+            app,
+            {"type": "remove_member", "event_id": event_id.strip(), "uid": uid.strip()},
+        )
+
+    def remove_user(self, app: Sanic, uid: str) -> None:
+        """Closes every connection of a deleted user, in every worker."""
+        self._broadcast(app, {"type": "remove_user", "uid": uid.strip()})
+
+    async def flush(self, app: Sanic) -> int:
+        """Writes the queued messages, returns how many were written."""
+        batch, self.pending = self.pending, []
+        if not batch:
+            return 0
+        try:
+            await app.ctx.db.executemany(INSERT_MESSAGE, *batch)
+        except Exception:
+            # tried again with the next batch, within limits
+            self.pending = batch + self.pending
+            excess = len(self.pending) - self.flush_size * CHAT_MAX_PENDING_FLUSHES
+            if excess > 0:
+                del self.pending[:excess]
+                self.dropped += excess
+            raise
+        self.flushed += len(batch)
+        return len(batch)
+
+    async def run_flusher(self, app: Sanic) -> None:
+        """Flushes the queued messages forever, meant to be run as a background task."""
+        self._flush_now = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush(app)
+            except Exception:
+                logger.exception(f"Writing {len(self.pending)} chat messages failed")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "rooms": len(self.rooms),
+            "connections": sum(
+                len(sockets)
+                for room in self.rooms.values()
+                for sockets in room.connections.values()
+            ),
+            "pending": len(self.pending),
+            "received": len(self.received),
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+        }
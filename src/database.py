@@ -1,8 +1,36 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
 from functools import wraps
-from typing import Any, AsyncGenerator, List, Mapping, Optional
+import inspect
+import re
+from time import perf_counter
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncGenerator,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
 
+import asyncpg
 from databases import Database as _Database
 from sanic import Sanic
+from sanic.log import logger
+
+from src import metrics
+from src.migrations import MIGRATIONS, SCHEMA_MIGRATIONS
+
+
+T = TypeVar("T")
+
+# `:name` placeholders, but not postgres `::type` casts
+PLACEHOLDER = re.compile(r"(?<![:\w]):(\w+)")
 
 
 class DatabaseNotConnectedError(Exception):
@@ -19,15 +47,76 @@ def is_connected(func: Any) -> Any:
         DatabaseNotConnectedError`
     """
 
-    @wraps(func)
-    async def wrapper(ref, *args, **kwargs):
+    def check(ref) -> None:
         if not ref.is_connected:
             raise DatabaseNotConnectedError(
                 "No database operation can take place without connecting "
                 "to the database first. Has the app started up normally?"
             )
-        else:
-            return await func(ref, *args, **kwargs)
+
+    if inspect.isasyncgenfunction(func):
+        # async generators (`Database.iterate`) can't be awaited, they have to be iterated
+        @wraps(func)
+        async def generator_wrapper(ref, *args, **kwargs):
+            check(ref)
+            items = func(ref, *args, **kwargs)
+            try:
+                async for item in items:
+                    yield item
+            finally:
+                # when the iteration is stopped early, the cursor is closed now
+                # instead of whenever the event loop finalizes the generator
+                await items.aclose()
+
+        return generator_wrapper
+
+    @wraps(func)
+    async def wrapper(ref, *args, **kwargs):
+        check(ref)
+        return await func(ref, *args, **kwargs)
+
+    return wrapper
+
+
+def timed(func: Any) -> Any:
+    """
+    A decorator which records how long each query took, see `Database.record`.
+    For `Database.iterate`, only the time spent waiting for rows is counted.
+    """
+
+    if inspect.isasyncgenfunction(func):
+
+        @wraps(func)
+        async def generator_wrapper(ref, query, **kwargs):
+            elapsed = 0.0
+            rows = func(ref, query, **kwargs).__aiter__()
+            ref.in_flight += 1
+            try:
+                while True:
+                    start = perf_counter()
+                    try:
+                        record = await rows.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        elapsed += perf_counter() - start
+                    yield record
+            finally:
+                ref.in_flight -= 1
+                await rows.aclose()
+                ref.record(query, elapsed, kwargs)
+
+        return generator_wrapper
+
+    @wraps(func)
+    async def wrapper(ref, query, *args, **kwargs):
+        start = perf_counter()
+        ref.in_flight += 1
+        try:
+            return await func(ref, query, *args, **kwargs)
+        finally:
+            ref.in_flight -= 1
+            ref.record(query, perf_counter() - start, args or kwargs)
 
     return wrapper
 
@@ -48,6 +137,13 @@ class Database:
         self.db = _Database(app.config.DB_URI)
         self.is_connected = False
         self.app = app
+        # either "sqlite" or "postgresql", for the few queries that differ between them
+        self.dialect = (
+            "postgresql" if self.db.url.dialect.startswith("postgres") else "sqlite"
+        )
+        self.slow_query_threshold = app.config.get("SLOW_QUERY_THRESHOLD", 0.1)
+        # queries running right now
+        self.in_flight = 0
 
     async def connect(self) -> None:
         """Establishes the connection with the database."""
@@ -61,58 +157,391 @@ class Database:
         self.is_connected = False
 
     @is_connected
-    async def initialize_tables(self) -> None:
+    async def migrate(self) -> List[Tuple[int, str, float]]:
+        """
+        Applies the migrations from `src.migrations` that haven't been applied yet.
+        Each migration runs in it's own transaction. Safe to call on every startup.
+
+        Returns ::
+            List of (version, name, seconds taken) for the migrations that were applied.
+        """
+        await self.execute(SCHEMA_MIGRATIONS)
+        applied = {
+            record["version"]
+            for record in await self.fetch("SELECT version FROM schema_migrations")
+        }
+
+        report = []
+        for migration in MIGRATIONS:
+            if migration.version in applied:
+                continue
+
+            start = perf_counter()
+            async with self.transaction():
+                if self.dialect == "postgresql":
+                    # another worker might be migrating at the same time
+                    await self.execute("SELECT pg_advisory_xact_lock(4120)")
+                    if await self.fetchval(
+                        "SELECT 1 FROM schema_migrations WHERE version = :version",
+                        version=migration.version,
+                    ):
+                        continue
+
+                for statement in migration.statements(self.dialect):
+                    await self.execute(statement)
+                await self.execute(
+                    "INSERT INTO schema_migrations(version, name, applied_at) "
+                    "VALUES(:version, :name, :applied_at)",
+                    version=migration.version,
+                    name=migration.name,
+                    applied_at=datetime.utcnow(),
+                )
+            elapsed = perf_counter() - start
+
+            logger.info(
+                f"Applied migration {migration.version} ({migration.name}) "
+                f"in {elapsed * 1000:.1f}ms"
+            )
+            report.append((migration.version, migration.name, elapsed))
+
+        return report
+
+    def transaction(self) -> AsyncContextManager:
         """
-        Creates the tables in the database if they haven't been made already.
+        Runs the queries made inside it (from the same task) in one transaction.
+        Nested transactions become savepoints.
+
+            async with app.ctx.db.transaction():
+                ...
         """
-        users = """CREATE TABLE IF NOT EXISTS users(
-            uid CHAR(20) PRIMARY KEY,
-            email TEXT UNIQUE,
-            username VARCHAR(25) NOT NULL,
-            tz VARCHAR(50),
-            discord_id CHAR(20) UNIQUE
-        )"""
-        events = """CREATE TABLE IF NOT EXISTS events(
-            event_id CHAR(20) PRIMARY KEY,
-            event_name VARCHAR(25) NOT NULL,
-            event_owner CHAR(20) REFERENCES users(uid),
-            start_time TIMESTAMP NOT NULL,
-            end_time TIMESTAMP NOT NULL,
-            long_desc VARCHAR(5000) NOT NULL,
-            short_desc VARCHAR(75),
-            passcode CHAR(8)
-        )"""
-        users_events = """CREATE TABLE IF NOT EXISTS users_events(
-            uid CHAR(20) REFERENCES users(uid),
-            event_id CHAR(20) REFERENCES events(event_id)
-        )"""
-
-        await self.db.execute(query=users)
-        await self.db.execute(query=events)
-        await self.db.execute(query=users_events)
+        return self.db.transaction()
+
+    def record(self, query: str, seconds: float, params: Any) -> None:
+        """Records a query's latency, and logs it if it was slower than SLOW_QUERY_THRESHOLD."""
+        metrics.record_query(query, seconds)
+        if seconds >= self.slow_query_threshold:
+            logger.warning(
+                f"Slow query ({seconds * 1000:.1f}ms): {metrics.statement(query)} "
+                f"params={metrics.redact(params)}"
+            )
+
+    def stats(self) -> Dict[str, int]:
+        """Gauges exposed on /metrics."""
+        return {
+            "connected": int(self.is_connected),
+            "queries_in_flight": self.in_flight,
+        }
+
+    def unit_of_work(self) -> "UnitOfWork":
+        """
+        Queues writes, and runs them all in one transaction when the block exits
+        without an exception. If anything fails, none of them are applied.
+
+            async with app.ctx.db.unit_of_work() as work:
+                work.execute("INSERT INTO ...", ...)
+                work.execute("INSERT INTO ...", ...)
+        """
+        return UnitOfWork(self)
 
     @is_connected
+    @timed
     async def execute(self, query: str, **kwargs: Any) -> str:
         return await self.db.execute(query=query, values=kwargs)
 
     @is_connected
+    @timed
     async def executemany(self, query: str, *args: Any) -> None:
         return await self.db.execute_many(query=query, values=list(args))
 
     @is_connected
+    @timed
     async def fetch(self, query: str, **kwargs: Any) -> List[Mapping]:
         return await self.db.fetch_all(query=query, values=kwargs)
 
     @is_connected
+    @timed
     async def fetchrow(self, query: str, **kwargs: Any) -> Optional[Mapping]:
         return await self.db.fetch_one(query=query, values=kwargs)
 
     @is_connected
+    @timed
     async def fetchval(self, query: str, **kwargs: Any) -> Optional[Any]:
-        return await self.db.fetch_one(query=query, values=kwargs)
+        return await self.db.fetch_val(query=query, values=kwargs)
 
     @is_connected
+    @timed
     async def iterate(self, query: str, **kwargs: Any) -> AsyncGenerator[Mapping, None]:
         # to be used like a cursor, in case large amounts of data is to be retrieved
         async for record in self.db.iterate(query=query, values=kwargs):
             yield record
+
+
+class UnitOfWork:
+    """
+    Writes queued to be run together, returned by `Database.unit_of_work`.
+    Consecutive statements with the same query are sent with one `executemany`.
+    """
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+        # (query, values of every queued run of it)
+        self.statements: List[Tuple[str, List[Dict[str, Any]]]] = []
+        # started by the first read, otherwise by `flush`
+        self.transaction: Optional[AsyncContextManager] = None
+
+    def execute(self, query: str, **kwargs: Any) -> None:
+        if self.statements and self.statements[-1][0] == query:
+            self.statements[-1][1].append(kwargs)
+        else:
+            self.statements.append((query, [kwargs]))
+
+    def executemany(self, query: str, *args: Dict[str, Any]) -> None:
+        for values in args:
+            self.execute(query, **values)
+
+    async def fetch(self, query: str, **kwargs: Any) -> List[Mapping]:
+        """
+        Reads inside the transaction the writes will run in, so that they are based
+        on what was read. The transaction is started now instead of by `flush`, the
+        writes are still only run at the end.
+        """
+        if self.transaction is None:
+            self.transaction = self.db.transaction()
+            await self.transaction.__aenter__()
+        return await self.db.fetch(query, **kwargs)
+
+    async def flush(self) -> None:
+        """Runs the queued statements in one transaction, and empties the queue."""
+        statements, self.statements = self.statements, []
+        if self.transaction is None:
+            if not statements:
+                return
+            async with self.db.transaction():
+                await self._run(statements)
+            return
+
+        transaction, self.transaction = self.transaction, None
+        try:
+            await self._run(statements)
+        except BaseException as exc:
+            await transaction.__aexit__(type(exc), exc, exc.__traceback__)
+            raise
+        await transaction.__aexit__(None, None, None)
+
+    async def _run(self, statements: List[Tuple[str, List[Dict[str, Any]]]]) -> None:
+        for query, values in statements:
+            if len(values) == 1:
+                await self.db.execute(query, **values[0])
+            else:
+                await self.db.executemany(query, *values)
+
+    async def __aenter__(self) -> "UnitOfWork":
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        if exc_type is None:
+            await self.flush()
+        elif self.transaction is not None:
+            # rolls back the reads' transaction
+            transaction, self.transaction = self.transaction, None
+            await transaction.__aexit__(exc_type, exc, traceback)
+
+
+class PostgresDatabase(Database):
+    """
+    Fast path for Postgres, which talks to asyncpg directly instead of going through
+    `databases` and SQLAlchemy. Enabled with the DB_FAST_PATH env var.
+
+    Queries are written the same way as for `Database` (with `:name` parameters),
+    they are translated to asyncpg's `$n` parameters once and the translation is kept.
+    asyncpg prepares every statement on first use and keeps it in a per-connection
+    cache, so our fixed set of queries is only ever parsed and planned once per connection.
+    Rows are returned as asyncpg Records, which are tuples with a shared column
+    lookup, no dict is built for them.
+    """
+
+    def __init__(self, app: Sanic) -> None:
+        self.app = app
+        self.is_connected = False
+        self.dialect = "postgresql"
+        self.slow_query_threshold = app.config.get("SLOW_QUERY_THRESHOLD", 0.1)
+        # queries running right now
+        self.in_flight = 0
+        self.pool: Optional[asyncpg.pool.Pool] = None
+        # query -> (translated query, parameter names in order)
+        self.statements: Dict[str, Tuple[str, List[str]]] = {}
+        # connections handed out by `acquire`, and tasks waiting for one
+        self.connections_in_use = 0
+        self.connections_waiting = 0
+        # connection of the transaction running in the current task, if any
+        self.connection: ContextVar[Optional[asyncpg.Connection]] = ContextVar(
+            "connection", default=None
+        )
+
+    async def connect(self) -> None:
+        """Creates the connection pool."""
+        self.pool = await asyncpg.create_pool(
+            self.app.config.DB_URI,
+            min_size=self.app.config.DB_POOL_MIN_SIZE,
+            max_size=self.app.config.DB_POOL_MAX_SIZE,
+            statement_cache_size=self.app.config.DB_STATEMENT_CACHE_SIZE,
+        )
+        self.is_connected = True
+
+    @is_connected
+    async def disconnect(self) -> None:
+        """Closes every connection of the pool."""
+        await self.pool.close()
+        self.is_connected = False
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **super().stats(),
+            "pool_max_size": self.app.config.DB_POOL_MAX_SIZE,
+            "pool_in_use": self.connections_in_use,
+            "pool_waiting": self.connections_waiting,
+        }
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncGenerator[asyncpg.Connection, None]:
+        """Takes a connection from the pool, counting the connections in use."""
+        self.connections_waiting += 1
+        try:
+            connection = await self.pool.acquire()
+        finally:
+            self.connections_waiting -= 1
+
+        self.connections_in_use += 1
+        try:
+            yield connection
+        finally:
+            self.connections_in_use -= 1
+            await self.pool.release(connection)
+
+    def compile(self, query: str) -> Tuple[str, List[str]]:
+        """Translates `:name` parameters to `$n`, returns the query and the names in order."""
+        statement = self.statements.get(query)
+        if statement is None:
+            names: List[str] = []
+
+            def number(match: "re.Match") -> str:
+                name = match.group(1)
+                if name not in names:
+                    names.append(name)
+                return f"${names.index(name) + 1}"
+
+            statement = (PLACEHOLDER.sub(number, query), names)
+            self.statements[query] = statement
+        return statement
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncGenerator[None, None]:
+        connection = self.connection.get()
+        if connection is not None:
+            async with connection.transaction():
+                yield
+            return
+
+        async with self.acquire() as connection:
+            token = self.connection.set(connection)
+            try:
+                async with connection.transaction():
+                    yield
+            finally:
+                self.connection.reset(token)
+
+    async def run(self, method: str, query: str, kwargs: dict) -> Any:
+        query, names = self.compile(query)
+        args = [kwargs[name] for name in names]
+        connection = self.connection.get()
+        if connection is not None:
+            return await getattr(connection, method)(query, *args)
+        async with self.acquire() as connection:
+            return await getattr(connection, method)(query, *args)
+
+    @is_connected
+    @timed
+    async def execute(self, query: str, **kwargs: Any) -> str:
+        return await self.run("execute", query, kwargs)
+
+    @is_connected
+    @timed
+    async def executemany(self, query: str, *args: Any) -> None:
+        query, names = self.compile(query)
+        rows = [[values[name] for name in names] for values in args]
+        connection = self.connection.get()
+        if connection is not None:
+            return await connection.executemany(query, rows)
+        async with self.acquire() as connection:
+            return await connection.executemany(query, rows)
+
+    @is_connected
+    @timed
+    async def fetch(self, query: str, **kwargs: Any) -> List[Mapping]:
+        return await self.run("fetch", query, kwargs)
+
+    @is_connected
+    @timed
+    async def fetchrow(self, query: str, **kwargs: Any) -> Optional[Mapping]:
+        return await self.run("fetchrow", query, kwargs)
+
+    @is_connected
+    @timed
+    async def fetchval(self, query: str, **kwargs: Any) -> Optional[Any]:
+        return await self.run("fetchval", query, kwargs)
+
+    @is_connected
+    async def copy_records(
+        self, table: str, columns: List[str], records: List[Tuple]
+    ) -> None:
+        """Bulk inserts rows with COPY, much faster than `executemany` for large batches."""
+        connection = self.connection.get()
+        if connection is not None:
+            await connection.copy_records_to_table(
+                table, records=records, columns=columns
+            )
+            return
+        async with self.acquire() as connection:
+            await connection.copy_records_to_table(
+                table, records=records, columns=columns
+            )
+
+    @is_connected
+    @timed
+    async def iterate(self, query: str, **kwargs: Any) -> AsyncGenerator[Mapping, None]:
+        query, names = self.compile(query)
+        args = [kwargs[name] for name in names]
+        connection = self.connection.get()
+        if connection is not None:
+            async for record in connection.cursor(query, *args):
+                yield record
+            return
+
+        # server side cursors only live inside a transaction. the connection isn't
+        # put in `self.connection`: a stream that is dropped halfway is closed from
+        # another context, where resetting the ContextVar would raise
+        async with self.acquire() as connection:
+            async with connection.transaction():
+                async for record in connection.cursor(query, *args):
+                    yield record
+
+
+def make_database(app: Sanic) -> Database:
+    """Picks the database backend from the DB_URI and DB_FAST_PATH config."""
+    if app.config.DB_FAST_PATH and app.config.DB_URI.startswith("postgres"):
+        return PostgresDatabase(app)
+    return Database(app)
+
+
+def to_record(cls: Type[T], record: Optional[Mapping]) -> T:
+    """
+    Builds an instance of the dataclass `cls` from a row, positionally,
+    without building a dict of the row first.
+    The row must have the columns of `cls` in the same order as it's fields.
+
+    Raises ::
+        TypeError, if `record` is None (no row was found)
+    """
+    if record is None:
+        raise TypeError(f"No {cls.__name__} was found.")
+    return cls(*record.values())  # type: ignore
@@ -1,13 +1,75 @@
-from dataclasses import dataclass
+import csv
+from dataclasses import asdict, dataclass
 from datetime import datetime
-from typing import List, Mapping, Optional, TYPE_CHECKING
+import io
+import json
+import re
+from typing import AsyncGenerator, List, Mapping, Optional, Tuple, TYPE_CHECKING
 
 from sanic import Sanic
 
+from src.database import to_record
+from src.utils import Page, time_cursor
+
 if TYPE_CHECKING:
     from src.auth import User
 
 
+# columns of the events table, in the order of the fields of `Event`
+EVENT_COLUMNS = (
+    "event_id, event_name, event_owner, start_time, end_time, long_desc, "
+    "short_desc, passcode, member_count"
+)
+
+INSERT_EVENT = f"""INSERT INTO events({EVENT_COLUMNS}) VALUES(:event_id, :event_name,
+    :event_owner, :start_time, :end_time, :long_desc, :short_desc, :passcode,
+    :member_count)"""
+# `Event.create` in one statement on postgres, instead of a transaction of three
+CREATE_EVENT_POSTGRESQL = f"""WITH
+    e AS ({INSERT_EVENT} RETURNING event_id, event_owner),
+    m AS (INSERT INTO users_events(uid, event_id) SELECT event_owner, event_id FROM e)
+    UPDATE users SET memberships_updated_at = :now
+    WHERE uid = (SELECT event_owner FROM e)"""
+
+# columns returned by the listings of events, like `Event.search`
+LISTING_COLUMNS = "event_id, event_name, short_desc, start_time, end_time, member_count"
+# on sqlite, the events_fts search index has to be kept in sync with the events table
+FTS_INSERT = """INSERT INTO events_fts(rowid, event_name, short_desc, long_desc)
+    VALUES(:rowid, :event_name, :short_desc, :long_desc)"""
+FTS_DELETE = "DELETE FROM events_fts WHERE rowid = :rowid"
+# an event's members after a cursor (a uid), ordered by uid
+MEMBERS = """SELECT u.uid, u.username FROM users_events ue
+    JOIN users u ON u.uid = ue.uid
+    WHERE ue.event_id = :event_id AND ue.uid > :after
+    ORDER BY ue.uid"""
+# the calendar feeds of users are versioned by when their memberships last changed,
+# so every change to the events a user is a member of has to bump it, see src/ical.py
+TOUCH_USER = "UPDATE users SET memberships_updated_at = :now WHERE uid = :uid"
+TOUCH_MEMBERS = """UPDATE users SET memberships_updated_at = :now
+    WHERE uid IN (SELECT uid FROM users_events WHERE event_id = :event_id)"""
+# `Event.delete` in one statement on postgres. users_events would cascade, it's
+# deleted explicitly like on sqlite
+DELETE_EVENT_POSTGRESQL = f"""WITH
+    touched AS ({TOUCH_MEMBERS}),
+    members AS (DELETE FROM users_events WHERE event_id = :event_id),
+    messages AS (DELETE FROM chat_messages WHERE event_id = :event_id)
+    DELETE FROM events WHERE event_id = :event_id"""
+
+
+# formats members can be exported in, and their content types
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+# number of rows serialized into each chunk of an export
+EXPORT_CHUNK_ROWS = 500
+
+
+def members_topic(event_id: str) -> str:
+    """
+    The pub/sub topic of an event's live member list. Joins and leaves are published
+    to it as JSON, like {"action": "join", "uid": ..., "username": ...}.
+    """
+    return f"event:{event_id.strip()}:members"
+
+
 @dataclass
 class Event:
     """A dataclass representing an event."""
@@ -20,36 +82,110 @@ class Event:
     long_desc: str
     short_desc: str
     passcode: Optional[str] = None
+    member_count: int = 0
 
     async def create(self, app: Sanic) -> "Event":
-        """Inserts a record for the event in the database."""
-        await app.ctx.db.execute(
-            """INSERT INTO events
-                                    (event_id, event_name, event_owner, start_time, end_time, long_desc, short_desc, passcode)
-                                    VALUES(:event_id, :event_name, :event_owner, :start_time, :end_time, :long_desc, :short_desc, :passcode)""",
-            event_id=self.event_id,
-            event_name=self.event_name,
-            event_owner=self.event_owner,
-            start_time=self.start_time,
-            end_time=self.end_time,
-            long_desc=self.long_desc,
-            short_desc=self.short_desc,
-            passcode=self.passcode,
-        )
-        await app.ctx.db.execute(
-            "INSERT INTO users_events(uid, event_id) VALUES(:uid, :event_id)",
-            uid=self.event_owner,
-            event_id=self.event_id,
-        )
+        """Inserts a record for the event, and makes the owner it's first member."""
+        self.member_count = 1
+        values = asdict(self)
+        if app.ctx.db.dialect == "postgresql":
+            # one statement is atomic by itself, and one round trip
+            await app.ctx.db.execute(
+                CREATE_EVENT_POSTGRESQL, now=datetime.utcnow(), **values
+            )
+            return self
+
+        # sqlite has no writes in CTEs, it's round trips don't leave the process anyway
+        async with app.ctx.db.unit_of_work() as work:
+            work.execute(INSERT_EVENT, **values)
+            work.execute(
+                "INSERT INTO users_events(uid, event_id) VALUES(:uid, :event_id)",
+                uid=self.event_owner,
+                event_id=self.event_id,
+            )
+            work.execute(TOUCH_USER, now=datetime.utcnow(), uid=self.event_owner)
+            work.execute(
+                FTS_INSERT,
+                rowid=int(self.event_id),
+                event_name=self.event_name,
+                short_desc=self.short_desc or "",
+                long_desc=self.long_desc,
+            )
         return self
 
     @classmethod
     async def by_id(cls, app: Sanic, id: str) -> "Event":
-        """Retrieve an Event from the database by event ID."""
+        """Retrieve an Event from the database by event ID.
+        Raises a TypeError if there is no such event."""
         record = await app.ctx.db.fetchrow(
-            "SELECT * FROM events WHERE event_id = :event_id", event_id=id
+            f"SELECT {EVENT_COLUMNS} FROM events WHERE event_id = :event_id",
+            event_id=id,
         )
-        return cls(**record)
+        return to_record(cls, record)
+
+    @classmethod
+    async def iter_members(
+        cls, app: Sanic, id: str, *, after: Optional[str] = None
+    ) -> AsyncGenerator[Mapping, None]:
+        """
+        Streams the uid and username of an event's members, ordered by uid.
+        Rows are read through `Database.iterate`, so memory use stays flat
+        however big the event is.
+
+        Arguments ::
+            app: Sanic -> The running Sanic instance.
+            id: str -> The event ID.
+            after: Optional[str] -> Cursor (a uid), only members after it are returned.
+        """
+        async for record in app.ctx.db.iterate(MEMBERS, event_id=id, after=after or ""):
+            yield record
+
+    @classmethod
+    async def members_page(
+        cls, app: Sanic, id: str, *, limit: int, after: Optional[str] = None
+    ) -> Page:
+        """Retrieve one page of an event's members, see `Event.iter_members`."""
+        # a page is small, so it's fetched at once instead of through a cursor.
+        # one extra row to find out if there's a next page
+        items = await app.ctx.db.fetch(
+            MEMBERS + " LIMIT :limit", event_id=id, after=after or "", limit=limit + 1
+        )
+        page = Page(items=items[:limit])
+        if len(items) > limit:
+            page.next_cursor = page.items[-1]["uid"].strip()
+        return page
+
+    @classmethod
+    async def export_members(
+        cls, app: Sanic, id: str, *, format: str = "csv"
+    ) -> AsyncGenerator[str, None]:
+        """
+        Serializes an event's members as CSV or NDJSON (see `EXPORT_FORMATS`),
+        and yields the output in chunks of `EXPORT_CHUNK_ROWS` rows.
+        The rows are streamed from the database, the result set is never held in memory.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if format == "csv":
+            writer.writerow(("uid", "username"))
+
+        rows = 0
+        async for record in cls.iter_members(app, id):
+            uid = record["uid"].strip()
+            if format == "csv":
+                writer.writerow((uid, record["username"]))
+            else:
+                buffer.write(json.dumps({"uid": uid, "username": record["username"]}))
+                buffer.write("\n")
+
+            rows += 1
+            if rows % EXPORT_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        if buffer.tell():
+            yield buffer.getvalue()
 
     async def get_members(self, app: Sanic) -> List[Mapping]:
         """Retrieve all members of this particular Event."""
@@ -61,13 +197,98 @@ class Event:
 
     async def get_members_usernames(self, app: Sanic) -> List[str]:
         """Retrieve the usernames of all members of this particular Event."""
-        return [
-            i["username"]
-            for i in await app.ctx.db.fetch(
-                "SELECT username FROM users WHERE uid IN (SELECT uid FROM users_events WHERE event_id = :event_id)",
-                event_id=self.event_id,
-            )
-        ]
+        return [i["username"] async for i in self.iter_members(app, self.event_id)]
+
+    @classmethod
+    async def load_page(
+        cls,
+        app: Sanic,
+        id: str,
+        *,
+        viewer: Optional["User"] = None,
+        member_limit: Optional[int] = None,
+        members_after: Optional[str] = None,
+    ) -> Optional["EventPage"]:
+        """
+        Loads everything the event page needs in a single query:
+        the event, it's owner, and for logged in viewers the member list
+        and whether they have joined the event.
+
+        Arguments ::
+            app: Sanic -> The running Sanic instance.
+            id: str -> The event ID.
+            viewer: Optional[User] -> The logged in user, if any.
+            member_limit: Optional[int] -> Maximum number of members to load.
+            members_after: Optional[str] -> Cursor (a uid) to load the members after.
+
+        Returns ::
+            src.events.EventPage, or None if the event doesn't exist.
+        """
+        from src.auth import User
+
+        columns = ", ".join(f"e.{column}" for column in EVENT_COLUMNS.split(", "))
+        query = f"""SELECT {columns},
+            o.username AS owner_username, o.email AS owner_email,
+            o.tz AS owner_tz, o.discord_id AS owner_discord_id"""
+        values = {"event_id": id}
+
+        if viewer:
+            # one row per member, with the event and owner columns repeated on each
+            # the member cursor goes in the join condition, so that the event row
+            # is still returned when there are no members after it
+            query += """, ue.uid AS member_uid, m.username AS member_username,
+                EXISTS(
+                    SELECT 1 FROM users_events
+                    WHERE event_id = e.event_id AND uid = :viewer
+                ) AS is_member
+                FROM events e
+                LEFT JOIN users o ON o.uid = e.event_owner
+                LEFT JOIN users_events ue
+                    ON ue.event_id = e.event_id AND ue.uid > :members_after
+                LEFT JOIN users m ON m.uid = ue.uid
+                WHERE e.event_id = :event_id
+                ORDER BY ue.uid"""
+            values["viewer"] = viewer.uid
+            values["members_after"] = members_after or ""
+            if member_limit is not None:
+                # one extra row to find out if there's a next page
+                query += " LIMIT :limit"
+                values["limit"] = member_limit + 1
+        else:
+            query += """ FROM events e
+                LEFT JOIN users o ON o.uid = e.event_owner
+                WHERE e.event_id = :event_id"""
+
+        records = await app.ctx.db.fetch(query, **values)
+        if not records:
+            return None
+
+        first = records[0]
+        event = cls(**{column: first[column] for column in EVENT_COLUMNS.split(", ")})
+        owner = User(
+            uid=event.event_owner,
+            username=first["owner_username"],
+            email=first["owner_email"],
+            tz=first["owner_tz"],
+            discord_id=first["owner_discord_id"],
+        )
+
+        if not viewer:
+            return EventPage(event=event, owner=owner, members=None, is_member=False)
+
+        members = [i for i in records if i["member_uid"]]
+        members_cursor = None
+        if member_limit is not None and len(members) > member_limit:
+            members = members[:member_limit]
+            members_cursor = members[-1]["member_uid"].strip()
+
+        return EventPage(
+            event=event,
+            owner=owner,
+            members=[i["member_username"] for i in members],
+            is_member=bool(first["is_member"]),
+            members_cursor=members_cursor,
+        )
 
     def is_owner(self, user: "User") -> bool:
         return user.uid == self.event_owner
@@ -76,13 +297,195 @@ class Event:
         """
         Deletes the event.
         """
-        # the local sqlite db was not configured to ON DELETE CASCADE
-        # and testing this again will be a pain
-        # if we deploy, TODO: write a proper init.sql for postgres
-        # for now, just delete from both tables.
-        await app.ctx.db.execute(
-            "DELETE FROM users_events WHERE event_id = :id", id=self.event_id
+        now = datetime.utcnow()
+        if app.ctx.db.dialect == "postgresql":
+            # one statement is atomic by itself, and one round trip
+            await app.ctx.db.execute(
+                DELETE_EVENT_POSTGRESQL, now=now, event_id=self.event_id
+            )
+        else:
+            # users_events cascades on delete, but sqlite only enforces foreign keys
+            # when PRAGMA foreign_keys is set on the connection, which we can't rely
+            # on. so just delete from both tables.
+            async with app.ctx.db.unit_of_work() as work:
+                work.execute(TOUCH_MEMBERS, now=now, event_id=self.event_id)
+                work.execute(
+                    "DELETE FROM users_events WHERE event_id = :id", id=self.event_id
+                )
+                work.execute(
+                    "DELETE FROM events WHERE event_id = :id", id=self.event_id
+                )
+                work.execute(FTS_DELETE, rowid=int(self.event_id))
+                work.execute(
+                    "DELETE FROM chat_messages WHERE event_id = :id", id=self.event_id
+                )
+        app.ctx.page_cache.invalidate(int(self.event_id))
+        app.ctx.chat.forget(app, self.event_id)
+
+    @classmethod
+    async def search(
+        cls, app: Sanic, text: str, *, limit: int, offset: int = 0
+    ) -> Page:
+        """
+        Full text search over the name, short and long descriptions of events,
+        best matches first. Every word has to match, the last one as a prefix.
+
+        Arguments ::
+            text: str -> What the user typed, any search syntax in it is ignored.
+            limit: int -> Number of events per page.
+            offset: int -> Number of events to skip, the `next_cursor` of the last page.
+
+        Returns ::
+            A page of the raw records, with `LISTING_COLUMNS`.
+        """
+        terms = re.findall(r"[^\W_]+", text.lower())
+        if not terms:
+            return Page()
+
+        if app.ctx.db.dialect == "sqlite":
+            # quoted, so that the terms are never read as FTS5 operators
+            match = " ".join(f'"{term}"' for term in terms) + "*"
+            columns = ", ".join(f"e.{column}" for column in LISTING_COLUMNS.split(", "))
+            query = f"""SELECT {columns} FROM events_fts
+                JOIN events e ON e.event_id = CAST(events_fts.rowid AS TEXT)
+                WHERE events_fts MATCH :match
+                ORDER BY bm25(events_fts, 10.0, 5.0, 1.0)
+                LIMIT :limit OFFSET :offset"""
+        else:
+            match = " & ".join(terms) + ":*"
+            query = f"""SELECT {LISTING_COLUMNS}
+                FROM events, to_tsquery('english', :match) AS query
+                WHERE search @@ query
+                ORDER BY ts_rank(search, query) DESC, event_id
+                LIMIT :limit OFFSET :offset"""
+
+        # one extra row to find out if there's a next page
+        records = await app.ctx.db.fetch(
+            query, match=match, limit=limit + 1, offset=offset
         )
-        await app.ctx.db.execute(
-            "DELETE FROM events WHERE event_id = :id", id=self.event_id
+        page = Page(items=records[:limit])
+        if len(records) > limit:
+            page.next_cursor = str(offset + limit)
+        return page
+
+    @classmethod
+    async def starting_between(
+        cls,
+        app: Sanic,
+        start: datetime,
+        end: Optional[datetime],
+        *,
+        limit: int,
+        after: Optional[Tuple[datetime, str]] = None,
+    ) -> Page:
+        """
+        Retrieve one page of the events starting between `start` and `end`,
+        soonest first. Read as a range of the (start_time, event_id) index,
+        whatever the page.
+
+        Arguments ::
+            end: Optional[datetime] -> None for no end.
+            after: Optional[Tuple[datetime, str]] -> The `next_cursor` of the last page,
+                parsed by `parse_time_cursor`.
+
+        Returns ::
+            A page of the raw records, with `LISTING_COLUMNS`.
+        """
+        conditions = ["start_time >= :start"]
+        params = dict(start=start, limit=limit + 1)
+        if end is not None:
+            conditions.append("start_time < :end")
+            params["end"] = end
+        if after is not None:
+            conditions.append("(start_time, event_id) > (:after_time, :after_id)")
+            params.update(after_time=after[0], after_id=after[1])
+
+        records = await app.ctx.db.fetch(
+            f"""SELECT {LISTING_COLUMNS} FROM events
+                WHERE {" AND ".join(conditions)}
+                ORDER BY start_time, event_id
+                LIMIT :limit""",
+            **params,
         )
+        return cls._time_page(records, limit, "start_time")
+
+    @classmethod
+    async def ongoing(
+        cls,
+        app: Sanic,
+        now: datetime,
+        *,
+        limit: int,
+        after: Optional[Tuple[datetime, str]] = None,
+    ) -> Page:
+        """
+        Retrieve one page of the events that have started and not ended yet, the ones
+        ending soonest first. Read as a range of the (end_time, event_id) index, only
+        the events that haven't ended are looked at.
+
+        Arguments ::
+            after: Optional[Tuple[datetime, str]] -> The `next_cursor` of the last page,
+                parsed by `parse_time_cursor`.
+
+        Returns ::
+            A page of the raw records, with `LISTING_COLUMNS`.
+        """
+        conditions = ["end_time > :now", "start_time <= :started"]
+        params = dict(now=now, started=now, limit=limit + 1)
+        if after is not None:
+            conditions.append("(end_time, event_id) > (:after_time, :after_id)")
+            params.update(after_time=after[0], after_id=after[1])
+
+        records = await app.ctx.db.fetch(
+            f"""SELECT {LISTING_COLUMNS} FROM events
+                WHERE {" AND ".join(conditions)}
+                ORDER BY end_time, event_id
+                LIMIT :limit""",
+            **params,
+        )
+        return cls._time_page(records, limit, "end_time")
+
+    @staticmethod
+    def _time_page(records: List[Mapping], limit: int, column: str) -> Page:
+        # one extra row was fetched to find out if there's a next page
+        page = Page(items=records[:limit])
+        if len(records) > limit:
+            last = page.items[-1]
+            page.next_cursor = time_cursor(last[column], last["event_id"])
+        return page
+
+    @classmethod
+    async def reconcile_member_counts(cls, app: Sanic) -> int:
+        """
+        Recounts the members of the events whose `member_count` has drifted
+        from `users_events` (after manual edits, or a bug), and fixes them.
+
+        Returns ::
+            The number of events that were fixed.
+        """
+        count = """(SELECT COUNT(*) FROM users_events
+            WHERE users_events.event_id = events.event_id)"""
+        async with app.ctx.db.transaction():
+            drifted = await app.ctx.db.fetch(
+                f"SELECT event_id FROM events WHERE member_count != {count}"
+            )
+            if drifted:
+                await app.ctx.db.execute(
+                    f"UPDATE events SET member_count = {count} "
+                    f"WHERE member_count != {count}"
+                )
+
+        for record in drifted:
+            app.ctx.page_cache.invalidate(int(record["event_id"]))
+        return len(drifted)
+
+
+@dataclass
+class EventPage:
+    """Everything the event page needs. Returned by `Event.load_page`."""
+
+    event: Event
+    owner: "User"
+    members: Optional[List[str]]  # usernames, None if the viewer isn't logged in
+    is_member: bool
+    members_cursor: Optional[str] = None  # set if there are more members to list
@@ -0,0 +1,202 @@
+"""
+iCalendar (RFC 5545) feeds of the events a user is a member of, served at
+/user/<token>/calendar.ics for calendar apps to subscribe to.
+
+Calendar apps poll feeds often, so the feed is versioned by the user's
+`memberships_updated_at`, which changes whenever the events they are a member of do.
+An unchanged feed is answered with a 304 from that column alone. Events can't be
+edited, so the VEVENT of an event is rendered once and cached, and a changed feed
+only renders the events that are new to the cache. The rest is streamed as the rows
+come in.
+"""
+from datetime import datetime, time, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import os
+from typing import AsyncGenerator, Dict, Mapping, Optional, Tuple
+
+from sanic import Sanic
+
+from src.cache import TTLCache
+from src.utils import sign, snowflake_time, to_datetime, unsign
+
+
+CONTENT_TYPE = "text/calendar; charset=utf-8"
+# the columns of the events in a feed
+CALENDAR_COLUMNS = "e.event_id, e.event_name, e.start_time, e.end_time, e.short_desc"
+# number of events rendered into each chunk of a feed
+CALENDAR_CHUNK_EVENTS = 200
+# part of the ETag of every feed, bumped when the rendering changes
+FEED_FORMAT = 3
+
+# rendered VEVENTs, keyed by (base URL, event ID). they are the same in every feed
+VEVENT_CACHE_SIZE = int(os.environ.get("CALENDAR_VEVENT_CACHE_SIZE", 10000))
+vevents = TTLCache(maxsize=VEVENT_CACHE_SIZE, ttl=24 * 3600)
+
+
+def calendar_token(uid: str, secret: str) -> str:
+    """The token in the URL of a user's feed, anyone who has it can read the feed."""
+    return sign(uid.encode(), secret)
+
+
+def token_uid(token: str, secret: str) -> Optional[str]:
+    """The uid a feed token was made for, or None if the token isn't valid."""
+    data = unsign(token, secret)
+    return data.decode() if data is not None else None
+
+
+def escape(text: str) -> str:
+    return (
+        text.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def fold(line: str) -> str:
+    """Ends a content line, folded into lines of at most 75 octets like the RFC says."""
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + "\r\n"
+
+    parts = []
+    start = 0
+    limit = 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # never split a UTF-8 sequence, continuation bytes are 0b10xxxxxx
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode())
+        start = end
+        limit = 74  # continuation lines start with a space
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def timestamp(value: datetime) -> str:
+    # `value` is in UTC, like `snowflake_time` returns
+    return value.strftime("%Y%m%dT%H%M%SZ")
+
+
+def event_times(start: datetime, end: datetime) -> Tuple[str, str]:
+    """
+    The DTSTART and DTEND lines of an event. Events made on the site are whole
+    days, stored as midnight. Imported ones can have a time of day (see
+    src/importer.py), they are rendered as floating times, since no event time has
+    a timezone.
+    """
+    if start.time() == end.time() == time.min:
+        # the end of an all-day event is the day after it's last day
+        return (
+            f"DTSTART;VALUE=DATE:{start:%Y%m%d}",
+            f"DTEND;VALUE=DATE:{end + timedelta(days=1):%Y%m%d}",
+        )
+    return f"DTSTART:{start:%Y%m%dT%H%M%S}", f"DTEND:{end:%Y%m%dT%H%M%S}"
+
+
+def render_vevent(record: Mapping, base_url: str) -> str:
+    event_id = record["event_id"].strip()
+    start = to_datetime(record["start_time"])
+    end = to_datetime(record["end_time"])
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{event_id}@eventinator",
+        f"DTSTAMP:{timestamp(snowflake_time(int(event_id)))}",
+        *event_times(start, end),
+        f"SUMMARY:{escape(record['event_name'])}",
+    ]
+    if record["short_desc"]:
+        lines.append(f"DESCRIPTION:{escape(record['short_desc'])}")
+    lines.append(f"URL:{base_url}/event/{event_id}")
+    lines.append("END:VEVENT")
+    return "".join(fold(line) for line in lines)
+
+
+async def memberships_updated_at(app: Sanic, uid: str) -> Optional[datetime]:
+    """
+    When the events the user is a member of last changed, the version of their feed.
+
+    Raises ::
+        LookupError, if there's no such user.
+    """
+    record = await app.ctx.db.fetchrow(
+        "SELECT memberships_updated_at FROM users WHERE uid = :uid", uid=uid
+    )
+    if record is None:
+        raise LookupError(uid)
+    value = record["memberships_updated_at"]
+    return to_datetime(value) if value is not None else None
+
+
+def version_headers(updated_at: Optional[datetime]) -> Dict[str, str]:
+    """The ETag and Last-Modified of a feed, from `memberships_updated_at`."""
+    if updated_at is None:
+        # the user never had a membership
+        return {"ETag": f'"{FEED_FORMAT}-0"'}
+    return {
+        "ETag": f'"{FEED_FORMAT}-{updated_at:%Y%m%d%H%M%S%f}"',
+        "Last-Modified": format_datetime(
+            updated_at.replace(tzinfo=timezone.utc), usegmt=True
+        ),
+    }
+
+
+def not_modified(headers: Mapping, version: Dict[str, str]) -> bool:
+    """Whether the conditional headers of a request match the version of the feed."""
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is not None:
+        # when both are sent, If-Modified-Since is ignored
+        tags = {tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")}
+        return "*" in tags or version["ETag"] in tags
+
+    if_modified_since = headers.get("If-Modified-Since")
+    if if_modified_since is None or "Last-Modified" not in version:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    # Last-Modified is rounded down to the second
+    return parsedate_to_datetime(version["Last-Modified"]) <= since
+
+
+async def render_feed(
+    app: Sanic, uid: str, *, base_url: str
+) -> AsyncGenerator[str, None]:
+    """
+    Yields the feed of a user in chunks of `CALENDAR_CHUNK_EVENTS` events.
+    The rows are streamed from the database, the feed is never held in memory.
+
+    Arguments ::
+        base_url: str -> Scheme and host the event pages are linked on.
+    """
+    chunk = [
+        "BEGIN:VCALENDAR\r\n",
+        "VERSION:2.0\r\n",
+        "PRODID:-//Eventinator//Eventinator//EN\r\n",
+        "CALSCALE:GREGORIAN\r\n",
+        "X-WR-CALNAME:Eventinator\r\n",
+    ]
+    events = app.ctx.db.iterate(
+        f"""SELECT {CALENDAR_COLUMNS} FROM users_events ue
+            JOIN events e ON e.event_id = ue.event_id
+            WHERE ue.uid = :uid""",
+        uid=uid,
+    )
+    count = 0
+    async for record in events:
+        key = (base_url, record["event_id"].strip())
+        vevent = vevents.get(key)
+        if vevent is None:
+            vevent = render_vevent(record, base_url)
+            vevents.set(key, vevent)
+        chunk.append(vevent)
+
+        count += 1
+        if count % CALENDAR_CHUNK_EVENTS == 0:
+            yield "".join(chunk)
+            chunk = []
+
+    chunk.append("END:VCALENDAR\r\n")
+    yield "".join(chunk)
@@ -0,0 +1,291 @@
+"""
+Bulk import of events, and of their members, from CSV or JSON.
+
+Every event needs `event_name`, `start_time` and `end_time` (ISO 8601 dates or datetimes),
+and can have `long_desc`, `short_desc`, `passcode` and `members`.
+`members` are the email addresses of the attendees. In CSV they are separated by
+semicolons, in JSON they are a list. Attendees who don't have an account are skipped.
+
+    event_name,start_time,end_time,short_desc,members
+    Meetup,2021-05-01T18:00,2021-05-01T21:00,Monthly meetup,a@example.com;b@example.com
+
+The whole file is validated before anything is inserted, then the events are inserted
+in batches, each batch in it's own transaction.
+
+Owners can import through `POST /event/import`, or from the command line:
+    python -m src.importer events.csv --owner <uid>
+"""
+import csv
+from dataclasses import dataclass
+from datetime import datetime
+import io
+import json
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from sanic import Sanic
+from sanic.exceptions import SanicException
+
+from src.database import PostgresDatabase
+from src.events import (
+    EVENT_COLUMNS,
+    FTS_INSERT,
+    INSERT_EVENT,
+    TOUCH_MEMBERS,
+    TOUCH_USER,
+)
+
+
+# formats that can be imported, and their content types
+IMPORT_FORMATS = {"csv": "text/csv", "json": "application/json"}
+# number of events inserted per transaction
+IMPORT_BATCH_SIZE = 1000
+
+# maximum lengths, matching the columns of the events table
+FIELD_LENGTHS = {"event_name": 25, "long_desc": 5000, "short_desc": 75, "passcode": 8}
+
+INSERT_OWNER = "INSERT INTO users_events(event_id, uid) VALUES(:event_id, :uid)"
+# the owner, or the same attendee twice, can be in the members of an event
+INSERT_MEMBER = """INSERT INTO users_events(event_id, uid)
+    SELECT :event_id, uid FROM users WHERE email = :email
+    ON CONFLICT DO NOTHING"""
+# attendees without an account are skipped, so members are counted once inserted
+COUNT_MEMBERS = """UPDATE events SET member_count = (
+    SELECT COUNT(*) FROM users_events WHERE event_id = :event_id
+) WHERE event_id = :id"""
+
+
+class InvalidImportError(SanicException):
+    """Exception raised when an import file can't be read, or one of it's rows is invalid."""
+
+    status_code = 400
+
+
+@dataclass
+class ImportReport:
+    """Progress of an import, passed to the progress callback after every batch."""
+
+    total: int
+    events: int = 0
+    members: int = 0  # membership rows sent, attendees without an account are skipped
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        if not self.seconds:
+            return 0.0
+        return (self.events + self.members) / self.seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "total": self.total,
+            "events": self.events,
+            "members": self.members,
+            "seconds": round(self.seconds, 3),
+            "rows_per_second": round(self.rows_per_second),
+        }
+
+
+def parse_time(value: Any, field: str, row: int) -> datetime:
+    # plain dates are read as midnight
+    try:
+        return datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        raise InvalidImportError(f"Row {row}: {field} is not an ISO 8601 date.")
+
+
+def validate(raw: Dict[str, Any], row: int) -> Dict[str, Any]:
+    """Checks one event read from the file, returns the values to insert."""
+    for field in ("event_name", "start_time", "end_time"):
+        if not raw.get(field):
+            raise InvalidImportError(f"Row {row}: {field} is missing.")
+
+    event = {
+        "event_name": str(raw["event_name"]).strip(),
+        "start_time": parse_time(raw["start_time"], "start_time", row),
+        "end_time": parse_time(raw["end_time"], "end_time", row),
+        "long_desc": str(raw.get("long_desc") or ""),
+        "short_desc": str(raw.get("short_desc") or ""),
+        "passcode": str(raw["passcode"]) if raw.get("passcode") else None,
+    }
+    if event["end_time"] < event["start_time"]:
+        raise InvalidImportError(f"Row {row}: the event ends before it starts.")
+    for field, length in FIELD_LENGTHS.items():
+        if event[field] is not None and len(event[field]) > length:
+            raise InvalidImportError(
+                f"Row {row}: {field} is longer than {length} characters."
+            )
+
+    members = raw.get("members") or []
+    if isinstance(members, str):
+        members = members.split(";")
+    event["members"] = [email.strip() for email in members if email.strip()]
+    return event
+
+
+def parse_events(data: str, format: str) -> List[Dict[str, Any]]:
+    """
+    Reads and validates every event in `data`.
+
+    Raises ::
+        InvalidImportError, on the first invalid row.
+    """
+    if format == "csv":
+        rows: Iterable[Dict[str, Any]] = csv.DictReader(io.StringIO(data))
+    elif format == "json":
+        try:
+            rows = json.loads(data)
+        except ValueError:
+            raise InvalidImportError("The file is not valid JSON.")
+        if not isinstance(rows, list) or not all(isinstance(i, dict) for i in rows):
+            raise InvalidImportError("The file must be a JSON list of events.")
+    else:
+        raise InvalidImportError(f"Unknown import format {format}.")
+
+    return [validate(raw, row) for row, raw in enumerate(rows, start=1)]
+
+
+async def insert_batch(app: Sanic, owner: str, batch: List[Dict[str, Any]]) -> int:
+    """Inserts one batch of events with their members, returns the membership rows sent."""
+    db = app.ctx.db
+    ids = app.ctx.snowflake.take(len(batch))
+    events = [
+        {
+            "event_id": str(event_id),
+            "event_name": event["event_name"],
+            "event_owner": owner,
+            "start_time": event["start_time"],
+            "end_time": event["end_time"],
+            "long_desc": event["long_desc"],
+            "short_desc": event["short_desc"],
+            "passcode": event["passcode"],
+            "member_count": 1,  # the owner
+        }
+        for event_id, event in zip(ids, batch)
+    ]
+    owners = [{"event_id": event["event_id"], "uid": owner} for event in events]
+    members = [
+        {"event_id": event["event_id"], "email": email}
+        for event, raw in zip(events, batch)
+        for email in raw["members"]
+    ]
+
+    now = datetime.utcnow()
+    async with db.transaction():
+        if isinstance(db, PostgresDatabase):
+            columns = EVENT_COLUMNS.split(", ")
+            await db.copy_records(
+                "events",
+                columns,
+                [tuple(event[column] for column in columns) for event in events],
+            )
+        else:
+            await db.executemany(INSERT_EVENT, *events)
+        if db.dialect == "sqlite":
+            await db.executemany(
+                FTS_INSERT,
+                *(
+                    {
+                        "rowid": int(event["event_id"]),
+                        "event_name": event["event_name"],
+                        "short_desc": event["short_desc"],
+                        "long_desc": event["long_desc"],
+                    }
+                    for event in events
+                ),
+            )
+        await db.executemany(INSERT_OWNER, *owners)
+        await db.execute(TOUCH_USER, now=now, uid=owner)
+        if members:
+            imported = [
+                event["event_id"] for event, raw in zip(events, batch) if raw["members"]
+            ]
+            await db.executemany(INSERT_MEMBER, *members)
+            await db.executemany(
+                COUNT_MEMBERS, *({"event_id": id, "id": id} for id in imported)
+            )
+            await db.executemany(
+                TOUCH_MEMBERS, *({"now": now, "event_id": id} for id in imported)
+            )
+
+    return len(members)
+
+
+async def import_events(
+    app: Sanic,
+    owner: str,
+    events: List[Dict[str, Any]],
+    *,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    progress: Optional[Callable[[ImportReport], None]] = None,
+) -> ImportReport:
+    """
+    Inserts events returned by `parse_events`, owned by `owner`, in batches of `batch_size`.
+    The owner is made a member of every event, like `Event.create` does.
+
+    Arguments ::
+        progress: Callable -> Called with the report after every batch.
+    """
+    report = ImportReport(total=len(events))
+    start = perf_counter()
+
+    for offset in range(0, len(events), batch_size):
+        batch = events[offset : offset + batch_size]
+        report.members += await insert_batch(app, owner, batch)
+        report.events += len(batch)
+        report.seconds = perf_counter() - start
+        if progress is not None:
+            progress(report)
+
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import os
+
+    from src.server import app
+    from src.utils import MAX_WORKER_ID, IDGenerator
+
+    parser = argparse.ArgumentParser(description="Bulk imports events from a file.")
+    parser.add_argument("file")
+    parser.add_argument("--owner", required=True, help="uid of the owner of the events")
+    parser.add_argument("--format", choices=IMPORT_FORMATS)
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    # the servers claim worker IDs from SNOWFLAKE_WORKER_ID up, so imports
+    # use the last one by default to never generate the same IDs as them
+    parser.add_argument("--worker-id", type=int, default=MAX_WORKER_ID)
+    args = parser.parse_args()
+
+    format = args.format or os.path.splitext(args.file)[1].lstrip(".").lower()
+    with open(args.file, newline="") as f:
+        events = parse_events(f.read(), format)
+
+    def print_progress(report: ImportReport) -> None:
+        print(
+            f"{report.events}/{report.total} events, {report.members} members, "
+            f"{report.rows_per_second:.0f} rows/s"
+        )
+
+    async def main() -> None:
+        app.ctx.snowflake = IDGenerator(args.worker_id)
+        await app.ctx.db.connect()
+        await app.ctx.db.migrate()
+        try:
+            if not await app.ctx.db.fetchval(
+                "SELECT 1 FROM users WHERE uid = :uid", uid=args.owner
+            ):
+                raise SystemExit(f"There is no user with the uid {args.owner}.")
+            report = await import_events(
+                app,
+                args.owner,
+                events,
+                batch_size=args.batch_size,
+                progress=print_progress,
+            )
+        finally:
+            await app.ctx.db.disconnect()
+        print(f"Imported {report.events} events in {report.seconds:.2f}s")
+
+    asyncio.run(main())
@@ -0,0 +1,208 @@
+"""
+In-process metrics.
+
+Everything here is updated from the event loop only, so nothing is locked.
+With several workers, each worker keeps it's own numbers.
+"""
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from operator import itemgetter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Histogram:
+    """Counts of observed values per bucket, with their sum, like a Prometheus histogram."""
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: Sequence[float] = BUCKETS) -> None:
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+@dataclass
+class RouteStats:
+    """Requests handled by one route."""
+
+    latency: Histogram = field(default_factory=Histogram)
+    in_flight: int = 0
+    # (method, status) -> number of responses
+    responses: Dict[Tuple[str, int], int] = field(default_factory=dict)
+
+
+@dataclass
+class QueryStats:
+    """Queries run while handling one request."""
+
+    queries: int = 0
+    seconds: float = 0.0
+
+
+# route name -> stats of it's requests
+routes: Dict[str, RouteStats] = {}
+# statement -> latency of it's queries
+query_histograms: Dict[str, Histogram] = {}
+# query as written in the code -> statement, with the whitespace collapsed
+_statements: Dict[str, str] = {}
+
+# stats of the request being handled, set by `track_queries`
+_request_queries: ContextVar[Optional[QueryStats]] = ContextVar(
+    "request_queries", default=None
+)
+
+
+def statement(query: str) -> str:
+    """Returns the name a query is recorded under, which is the query on one line."""
+    name = _statements.get(query)
+    if name is None:
+        name = _statements[query] = " ".join(query.split())
+    return name
+
+
+def record_query(query: str, seconds: float) -> None:
+    """Records the latency of a query, and counts it against the current request."""
+    name = statement(query)
+    histogram = query_histograms.get(name)
+    if histogram is None:
+        histogram = query_histograms[name] = Histogram()
+    histogram.observe(seconds)
+
+    stats = _request_queries.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += seconds
+
+
+def track_queries() -> QueryStats:
+    """
+    Starts counting the queries of the current request.
+    To be called from a request middleware, the handler runs in the same context.
+    """
+    stats = QueryStats()
+    _request_queries.set(stats)
+    return stats
+
+
+def redact(params: Any) -> Any:
+    """Replaces the values of query parameters with their types, for logging."""
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        # executemany, the types of the first row are enough
+        return [redact(params[0]), f"... {len(params)} rows"] if params else []
+    return type(params).__name__
+
+
+def route_stats(name: str) -> RouteStats:
+    stats = routes.get(name)
+    if stats is None:
+        stats = routes[name] = RouteStats()
+    return stats
+
+
+def request_started(route: str) -> None:
+    route_stats(route).in_flight += 1
+
+
+def request_finished(route: str, method: str, status: int, seconds: float) -> None:
+    stats = route_stats(route)
+    stats.in_flight -= 1
+    stats.latency.observe(seconds)
+    key = (method, status)
+    stats.responses[key] = stats.responses.get(key, 0) + 1
+
+
+# a gauge or a counter, as (name, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in labels.values()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def _histogram(name: str, labels: Dict[str, str], histogram: Histogram) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+    lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+    return lines
+
+
+def _samples(kind: str, samples: Iterable[Sample]) -> List[str]:
+    lines = []
+    typed = set()
+    # the samples of a metric have to be next to each other
+    for name, labels, value in sorted(samples, key=itemgetter(0)):
+        if name not in typed:
+            lines.append(f"# TYPE {name} {kind}")
+            typed.add(name)
+        lines.append(f"{name}{_labels(labels)} {value}")
+    return lines
+
+
+def render(gauges: Iterable[Sample] = (), counters: Iterable[Sample] = ()) -> str:
+    """
+    Renders every metric in the Prometheus text format.
+
+    Arguments ::
+        gauges: Iterable[Sample] -> Values read at scrape time, like pool sizes.
+        counters: Iterable[Sample] -> Totals read at scrape time, that only go up
+            until the worker restarts, like cache hits. Named `..._total`.
+    """
+    lines = ["# TYPE eventinator_http_request_duration_seconds histogram"]
+    for route, stats in routes.items():
+        lines.extend(
+            _histogram(
+                "eventinator_http_request_duration_seconds",
+                {"route": route},
+                stats.latency,
+            )
+        )
+
+    lines.append("# TYPE eventinator_http_responses_total counter")
+    for route, stats in routes.items():
+        for (method, status), count in stats.responses.items():
+            labels = {"route": route, "method": method, "status": status}
+            lines.append(f"eventinator_http_responses_total{_labels(labels)} {count}")
+
+    lines.append("# TYPE eventinator_http_requests_in_flight gauge")
+    for route, stats in routes.items():
+        lines.append(
+            f"eventinator_http_requests_in_flight{_labels({'route': route})} "
+            f"{stats.in_flight}"
+        )
+
+    lines.append("# TYPE eventinator_db_query_duration_seconds histogram")
+    for name, histogram in query_histograms.items():
+        lines.extend(
+            _histogram(
+                "eventinator_db_query_duration_seconds", {"statement": name}, histogram
+            )
+        )
+
+    lines.extend(_samples("gauge", gauges))
+    lines.extend(_samples("counter", counters))
+    return "\n".join(lines) + "\n"
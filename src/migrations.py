@@ -0,0 +1,228 @@
+"""
+Versioned schema migrations, applied in order by `src.database.Database.migrate`.
+Applied versions are recorded in the `schema_migrations` table, so every migration runs exactly once.
+
+To change the schema, append a new `Migration` to `MIGRATIONS` with the next version number.
+Never edit a migration that has already been released.
+"""
+from dataclasses import dataclass
+from typing import List, Sequence
+
+
+@dataclass
+class Migration:
+    """A single schema change, with the statements to run for each supported dialect."""
+
+    version: int
+    name: str
+    sqlite: Sequence[str]
+    postgresql: Sequence[str]
+
+    def statements(self, dialect: str) -> List[str]:
+        return list(getattr(self, dialect))
+
+
+SCHEMA_MIGRATIONS = """CREATE TABLE IF NOT EXISTS schema_migrations(
+    version INTEGER PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    applied_at TIMESTAMP NOT NULL
+)"""
+
+
+INITIAL_TABLES = [
+    """CREATE TABLE IF NOT EXISTS users(
+        uid CHAR(20) PRIMARY KEY,
+        email TEXT UNIQUE,
+        username VARCHAR(25) NOT NULL,
+        tz VARCHAR(50),
+        discord_id CHAR(20) UNIQUE
+    )""",
+    """CREATE TABLE IF NOT EXISTS events(
+        event_id CHAR(20) PRIMARY KEY,
+        event_name VARCHAR(25) NOT NULL,
+        event_owner CHAR(20) REFERENCES users(uid),
+        start_time TIMESTAMP NOT NULL,
+        end_time TIMESTAMP NOT NULL,
+        long_desc VARCHAR(5000) NOT NULL,
+        short_desc VARCHAR(75),
+        passcode CHAR(8)
+    )""",
+    """CREATE TABLE IF NOT EXISTS users_events(
+        uid CHAR(20) REFERENCES users(uid),
+        event_id CHAR(20) REFERENCES events(event_id)
+    )""",
+]
+
+# users_events had no keys at all, so it is rebuilt without the duplicate
+# (and orphaned) rows that piled up. The primary key covers lookups by event,
+# the reverse index covers lookups by user.
+USERS_EVENTS_KEYS = [
+    """CREATE TABLE users_events_new(
+        event_id CHAR(20) NOT NULL REFERENCES events(event_id) ON DELETE CASCADE,
+        uid CHAR(20) NOT NULL REFERENCES users(uid) ON DELETE CASCADE,
+        PRIMARY KEY (event_id, uid)
+    )""",
+    """INSERT INTO users_events_new(event_id, uid)
+        SELECT DISTINCT event_id, uid FROM users_events
+        WHERE event_id IN (SELECT event_id FROM events)
+        AND uid IN (SELECT uid FROM users)""",
+    "DROP TABLE users_events",
+    "ALTER TABLE users_events_new RENAME TO users_events",
+    "CREATE INDEX users_events_uid_idx ON users_events(uid, event_id)",
+]
+
+EVENTS_INDEXES = [
+    "CREATE INDEX events_owner_idx ON events(event_owner)",
+    "CREATE INDEX events_start_time_idx ON events(start_time)",
+]
+
+# kept up to date by `User.join_event` and `User.leave_event`,
+# and repaired by `Event.reconcile_member_counts`
+MEMBER_COUNT = [
+    "ALTER TABLE events ADD COLUMN member_count INTEGER NOT NULL DEFAULT 0",
+    """UPDATE events SET member_count = (
+        SELECT COUNT(*) FROM users_events WHERE users_events.event_id = events.event_id
+    )""",
+]
+
+# full text search over the name and descriptions of events, see `Event.search`.
+# sqlite's index is a separate FTS5 table, kept in sync by the code that writes events.
+# the rowid is the snowflake, as FTS5 tables can only be keyed by an integer
+EVENT_SEARCH_SQLITE = [
+    """CREATE VIRTUAL TABLE events_fts USING fts5(
+        event_name, short_desc, long_desc, tokenize = 'porter unicode61'
+    )""",
+    """INSERT INTO events_fts(rowid, event_name, short_desc, long_desc)
+        SELECT CAST(event_id AS INTEGER), event_name,
+            COALESCE(short_desc, ''), long_desc
+        FROM events""",
+]
+# postgres keeps the search column up to date by itself
+EVENT_SEARCH_POSTGRESQL = [
+    """ALTER TABLE events ADD COLUMN search tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', event_name), 'A')
+        || setweight(to_tsvector('english', COALESCE(short_desc, '')), 'B')
+        || setweight(to_tsvector('english', long_desc), 'C')
+    ) STORED""",
+    "CREATE INDEX events_search_idx ON events USING GIN (search)",
+]
+
+# the listings of events by time are keyset paginated on (time, event_id),
+# see `Event.starting_between` and `Event.ongoing`
+EVENT_TIME_INDEXES = [
+    "DROP INDEX events_start_time_idx",
+    "CREATE INDEX events_start_time_idx ON events(start_time, event_id)",
+    "CREATE INDEX events_end_time_idx ON events(end_time, event_id)",
+]
+
+# bumped whenever the events a user is a member of change, it versions their
+# calendar feed, see src/ical.py
+MEMBERSHIPS_UPDATED_AT = [
+    "ALTER TABLE users ADD COLUMN memberships_updated_at TIMESTAMP",
+    "UPDATE users SET memberships_updated_at = CURRENT_TIMESTAMP",
+]
+
+# written in batches by src/chat.py, after the message was sent. there are no
+# foreign keys, so that a batch never fails because an event was deleted since;
+# deleting an event deletes it's messages itself
+CHAT_MESSAGES = [
+    """CREATE TABLE chat_messages(
+        message_id BIGINT PRIMARY KEY,
+        event_id CHAR(20) NOT NULL,
+        uid CHAR(20) NOT NULL,
+        username VARCHAR(25) NOT NULL,
+        body VARCHAR(1000) NOT NULL,
+        sent_at TIMESTAMP NOT NULL
+    )""",
+    # history is read newest first, by message_id, see `Chat.read_history`
+    "CREATE INDEX chat_messages_event_idx ON chat_messages(event_id, message_id)",
+]
+
+
+# the dashboard pages events newest first, by the numeric value of their snowflake.
+# event_id is text and snowflakes vary in length, so the ordering has to be on the
+# cast, which these indexes cover, see `User.get_dashboard`
+DASHBOARD_INDEXES = [
+    "DROP INDEX users_events_uid_idx",
+    """CREATE INDEX users_events_uid_idx
+        ON users_events(uid, (CAST(event_id AS BIGINT)))""",
+    "DROP INDEX events_owner_idx",
+    """CREATE INDEX events_owner_idx
+        ON events(event_owner, (CAST(event_id AS BIGINT)))""",
+]
+
+
+MIGRATIONS = [
+    Migration(
+        version=1,
+        name="initial tables",
+        sqlite=INITIAL_TABLES,
+        postgresql=INITIAL_TABLES,
+    ),
+    Migration(
+        version=2,
+        name="users_events keys",
+        sqlite=USERS_EVENTS_KEYS,
+        postgresql=USERS_EVENTS_KEYS,
+    ),
+    Migration(
+        version=3,
+        name="events owner cascade and indexes",
+        # sqlite can't alter a constraint, the table has to be rebuilt
+        sqlite=[
+            """CREATE TABLE events_new(
+                event_id CHAR(20) PRIMARY KEY,
+                event_name VARCHAR(25) NOT NULL,
+                event_owner CHAR(20) REFERENCES users(uid) ON DELETE CASCADE,
+                start_time TIMESTAMP NOT NULL,
+                end_time TIMESTAMP NOT NULL,
+                long_desc VARCHAR(5000) NOT NULL,
+                short_desc VARCHAR(75),
+                passcode CHAR(8)
+            )""",
+            "INSERT INTO events_new SELECT * FROM events",
+            "DROP TABLE events",
+            "ALTER TABLE events_new RENAME TO events",
+            *EVENTS_INDEXES,
+        ],
+        postgresql=[
+            "ALTER TABLE events DROP CONSTRAINT IF EXISTS events_event_owner_fkey",
+            """ALTER TABLE events ADD CONSTRAINT events_event_owner_fkey
+                FOREIGN KEY (event_owner) REFERENCES users(uid) ON DELETE CASCADE""",
+            *EVENTS_INDEXES,
+        ],
+    ),
+    Migration(
+        version=4,
+        name="events member_count",
+        sqlite=MEMBER_COUNT,
+        postgresql=MEMBER_COUNT,
+    ),
+    Migration(
+        version=5,
+        name="event search",
+        sqlite=EVENT_SEARCH_SQLITE,
+        postgresql=EVENT_SEARCH_POSTGRESQL,
+    ),
+    Migration(
+        version=6,
+        name="events time indexes",
+        sqlite=EVENT_TIME_INDEXES,
+        postgresql=EVENT_TIME_INDEXES,
+    ),
+    Migration(
+        version=7,
+        name="users memberships_updated_at",
+        sqlite=MEMBERSHIPS_UPDATED_AT,
+        postgresql=MEMBERSHIPS_UPDATED_AT,
+    ),
+    Migration(
+        version=8, name="chat messages", sqlite=CHAT_MESSAGES, postgresql=CHAT_MESSAGES
+    ),
+    Migration(
+        version=9,
+        name="dashboard indexes",
+        sqlite=DASHBOARD_INDEXES,
+        postgresql=DASHBOARD_INDEXES,
+    ),
+]
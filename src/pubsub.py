@@ -0,0 +1,127 @@
+"""
+In-process publish/subscribe, used to push live updates to open connections.
+
+Every subscriber gets a bounded queue. Publishing never waits: a subscriber whose
+queue is full is too slow to keep up, and is evicted instead of holding up everyone
+else or buffering without limit. Evicted subscribers get `EVICTED` as their last
+message, and have to catch up some other way (like reloading the page).
+
+The hub only reaches the connections of it's own worker process, with several
+workers a message is only delivered to the subscribers of the worker it was
+published on. The chat passes it's messages on to the other workers through Redis,
+see src/chat.py.
+"""
+import asyncio
+from typing import Any, Dict, Hashable, Set
+
+
+# the last message of an evicted subscriber
+EVICTED = object()
+
+
+class Subscription:
+    """One subscriber of a topic, read it with `get` or `async for`."""
+
+    __slots__ = ("hub", "topic", "queue", "evicted")
+
+    def __init__(self, hub: "Hub", topic: Hashable, max_queue: int) -> None:
+        self.hub = hub
+        self.topic = topic
+        self.queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self.evicted = False
+
+    async def get(self) -> Any:
+        """Waits for the next message, `EVICTED` if this subscriber was evicted."""
+        return await self.queue.get()
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> Any:
+        message = await self.queue.get()
+        if message is EVICTED:
+            raise StopAsyncIteration
+        return message
+
+    def close(self) -> None:
+        self.hub.unsubscribe(self)
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class Hub:
+    """
+    Topics and their subscribers.
+    This is NOT thread-safe, it is meant to be used from the event loop only.
+    """
+
+    def __init__(self, max_queue: int = 64) -> None:
+        self.max_queue = max_queue
+        self.topics: Dict[Hashable, Set[Subscription]] = {}
+        self.published = 0
+        self.delivered = 0
+        self.evictions = 0
+
+    def subscribe(self, topic: Hashable) -> Subscription:
+        """Subscribes to `topic`, close the subscription once done with it."""
+        subscription = Subscription(self, topic, self.max_queue)
+        self.topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self.topics.get(subscription.topic)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self.topics[subscription.topic]
+
+    def publish(self, topic: Hashable, message: Any) -> int:
+        """
+        Queues `message` for every subscriber of `topic`, without waiting.
+        Messages are shared between the subscribers, so they shouldn't be mutated.
+
+        Returns ::
+            The number of subscribers the message was queued for.
+        """
+        subscribers = self.topics.get(topic)
+        self.published += 1
+        if not subscribers:
+            return 0
+
+        delivered = 0
+        slow = []
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+                delivered += 1
+            except asyncio.QueueFull:
+                slow.append(subscription)
+        for subscription in slow:
+            self.evict(subscription)
+
+        self.delivered += delivered
+        return delivered
+
+    def evict(self, subscription: Subscription) -> None:
+        """Drops a subscriber, whatever it had queued is replaced by `EVICTED`."""
+        self.unsubscribe(subscription)
+        subscription.evicted = True
+        queue = subscription.queue
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(EVICTED)
+        self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "topics": len(self.topics),
+            "subscribers": sum(len(i) for i in self.topics.values()),
+            "published": self.published,
+            "delivered": self.delivered,
+            "evictions": self.evictions,
+        }
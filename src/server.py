@@ -1,51 +1,167 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import os
+from time import perf_counter
 
+import aiohttp
 import firebase_admin
 from dotenv import find_dotenv, load_dotenv
 from firebase_admin import credentials
-from jinja2 import Environment, PackageLoader, select_autoescape
 from sanic import Sanic
 from sanic import exceptions
+from sanic.log import logger
 from sanic.request import Request
 from sanic.response import html, HTTPResponse
-from sanic_session import Session, InMemorySessionInterface
+from sanic_session import Session
 
-from src.database import Database
-from src.utils import IDGenerator, render_page
+from src.assets import asset_url, load_manifest
+from src import metrics
+from src.cache import ResponseCache
+from src.chat import Chat
+from src.database import make_database
+from src.events import Event
+from src.pubsub import Hub
+from src.sessions import RedisSessionInterface, make_session_interface
+from src.utils import (
+    IDGenerator,
+    claim_worker_id,
+    make_environment,
+    preload_templates,
+    render_page,
+)
 
 
 load_dotenv(find_dotenv())
 
+# if debug env var is not set, assume it is True
+DEBUG = False if os.environ.get("DEBUG") else True
+
 
 app = Sanic("eventinator")
 
 app.config.DB_URI = os.environ.get("DB_URI", "sqlite:///data.db")
-app.ctx.db = Database(app)
+# on postgres, DB_FAST_PATH uses asyncpg directly, see `src.database.PostgresDatabase`
+app.config.DB_FAST_PATH = bool(os.environ.get("DB_FAST_PATH"))
+app.config.DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 2))
+app.config.DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+app.config.DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 256))
+# queries slower than this many seconds are logged
+app.config.SLOW_QUERY_THRESHOLD = float(os.environ.get("SLOW_QUERY_THRESHOLD", 0.1))
+# requests running more queries than this are logged, it usually means an N+1 query
+app.config.QUERY_COUNT_WARNING = int(os.environ.get("QUERY_COUNT_WARNING", 10))
+app.ctx.db = make_database(app)
 
 # initializing firebase app
 cred = credentials.Certificate("admin-sdk.json")
 app.ctx.firebase = firebase_admin.initialize_app(cred)
 app.config.FIREBASE_API_KEY = os.environ.get("FIREBASE_WEB_API_KEY")
+# verified session cookies are cached, and revocation is checked once per interval per user
+app.config.SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+app.config.SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 300))
+app.config.FIREBASE_REVOCATION_INTERVAL = float(
+    os.environ.get("FIREBASE_REVOCATION_INTERVAL", 60)
+)
 
 # initializing jinja2 templates
-app.ctx.env = Environment(
-    loader=PackageLoader("src", "templates"),
-    autoescape=select_autoescape(["html"]),
-    enable_async=True,
+app.config.TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", ".jinja_cache")
+app.ctx.env = make_environment(debug=DEBUG, cache_dir=app.config.TEMPLATE_CACHE_DIR)
+
+# content-hashed static files, built with `python -m src.assets`
+app.ctx.assets = load_manifest()
+app.ctx.env.globals["asset_url"] = partial(asset_url, app.ctx.assets)
+
+# snowflake worker IDs of this node start at SNOWFLAKE_WORKER_ID,
+# every worker process claims one of them when it starts
+app.config.SNOWFLAKE_WORKER_ID = int(os.environ.get("SNOWFLAKE_WORKER_ID", 0))
+app.config.WORKERS = int(os.environ.get("WORKERS", 1))
+
+# initialize sessions, see src/sessions.py for the available backends
+app.config.SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+app.config.SESSION_EXPIRY = int(os.environ.get("SESSION_EXPIRY", 3600))
+app.config.SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL", "redis://localhost")
+app.config.SESSION_SECRET = os.environ.get("SESSION_SECRET")
+app.ctx.session_interface = make_session_interface(app)
+Session(app, interface=app.ctx.session_interface)
+
+# outbound http client (Firebase, Discord) settings
+app.config.HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 100))
+app.config.HTTP_POOL_SIZE_PER_HOST = int(os.environ.get("HTTP_POOL_SIZE_PER_HOST", 20))
+app.config.HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 30))
+app.config.HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3))
+app.config.HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 10))
+
+# maximum number of members listed on an event page
+app.config.EVENT_PAGE_MEMBERS = int(os.environ.get("EVENT_PAGE_MEMBERS", 100))
+# rendered event pages for guests are cached, bounded by their total size in bytes
+app.config.EVENT_PAGE_CACHE_BYTES = int(
+    os.environ.get("EVENT_PAGE_CACHE_BYTES", 32 * 2 ** 20)
+)
+app.config.EVENT_PAGE_CACHE_TTL = float(os.environ.get("EVENT_PAGE_CACHE_TTL", 30))
+app.ctx.page_cache = ResponseCache(
+    max_bytes=app.config.EVENT_PAGE_CACHE_BYTES, ttl=app.config.EVENT_PAGE_CACHE_TTL
+)
+# maximum page size of the member listing endpoint
+app.config.EVENT_MEMBERS_MAX_PAGE_SIZE = int(
+    os.environ.get("EVENT_MEMBERS_MAX_PAGE_SIZE", 1000)
 )
 
-# make snowflake generator instance
-app.ctx.snowflake = IDGenerator()
+# live member lists, see src/pubsub.py. a connection that falls LIVE_QUEUE_SIZE
+# messages behind is dropped
+app.config.LIVE_QUEUE_SIZE = int(os.environ.get("LIVE_QUEUE_SIZE", 64))
+# idle live connections get a comment this often, it has to stay below
+# RESPONSE_TIMEOUT or Sanic closes them
+app.config.LIVE_KEEPALIVE = float(os.environ.get("LIVE_KEEPALIVE", 15))
+app.ctx.hub = Hub(max_queue=app.config.LIVE_QUEUE_SIZE)
 
-# initialize sessions
-Session(
-    app,
-    interface=InMemorySessionInterface(
-        sessioncookie=True, cookie_name="plantech", expiry=3600
-    ),
+# event chat, see src/chat.py. every room keeps it's latest CHAT_RECENT messages
+# in memory, for CHAT_MAX_ROOMS rooms at most (rooms with connections are kept)
+app.config.CHAT_RECENT = int(os.environ.get("CHAT_RECENT", 100))
+app.config.CHAT_MAX_ROOMS = int(os.environ.get("CHAT_MAX_ROOMS", 1000))
+# messages are written in batches, every CHAT_FLUSH_INTERVAL seconds or as soon as
+# CHAT_FLUSH_SIZE of them are waiting
+app.config.CHAT_FLUSH_SIZE = int(os.environ.get("CHAT_FLUSH_SIZE", 500))
+app.config.CHAT_FLUSH_INTERVAL = float(os.environ.get("CHAT_FLUSH_INTERVAL", 1))
+# every connection can send CHAT_RATE_LIMIT messages per CHAT_RATE_PERIOD seconds
+app.config.CHAT_RATE_LIMIT = int(os.environ.get("CHAT_RATE_LIMIT", 5))
+app.config.CHAT_RATE_PERIOD = float(os.environ.get("CHAT_RATE_PERIOD", 5))
+# the chat is the only WebSocket, and it's messages are small
+app.config.WEBSOCKET_MAX_SIZE = int(os.environ.get("WEBSOCKET_MAX_SIZE", 2 ** 14))
+# rooms are per worker, with more than one worker (or node) they are kept in sync
+# through Redis pub/sub
+app.config.CHAT_REDIS_URL = os.environ.get("CHAT_REDIS_URL")
+if app.config.WORKERS > 1 and not app.config.CHAT_REDIS_URL:
+    raise RuntimeError("CHAT_REDIS_URL must be set to run more than one worker.")
+app.ctx.chat = Chat(
+    recent=app.config.CHAT_RECENT,
+    max_rooms=app.config.CHAT_MAX_ROOMS,
+    flush_size=app.config.CHAT_FLUSH_SIZE,
+    flush_interval=app.config.CHAT_FLUSH_INTERVAL,
+    redis_url=app.config.CHAT_REDIS_URL,
 )
 
+# default and maximum page size of the listings of events, like search results
+app.config.LISTING_PAGE_SIZE = int(os.environ.get("LISTING_PAGE_SIZE", 20))
+app.config.LISTING_MAX_PAGE_SIZE = int(os.environ.get("LISTING_MAX_PAGE_SIZE", 100))
+# ranked results are paginated by offset, so deep pages are cut off
+app.config.SEARCH_MAX_OFFSET = int(os.environ.get("SEARCH_MAX_OFFSET", 1000))
+
+# number of events inserted per transaction by bulk imports, see src/importer.py
+app.config.IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 1000))
+
+# how often `member_count` is checked against `users_events`, in seconds. 0 disables it
+app.config.RECONCILE_INTERVAL = float(os.environ.get("RECONCILE_INTERVAL", 3600))
+
+# number of events per page on the dashboard
+app.config.DASHBOARD_PAGE_SIZE = int(os.environ.get("DASHBOARD_PAGE_SIZE", 30))
+
+# threads for the blocking calls (the Firebase Admin SDK), run with `loop.run_in_executor`
+app.config.EXECUTOR_WORKERS = int(os.environ.get("EXECUTOR_WORKERS", 16))
+# signs the tokens in the URLs of calendar feeds, the feeds are disabled if unset
+app.config.CALENDAR_SECRET = os.environ.get("CALENDAR_SECRET")
+# if set, /metrics requires an `Authorization: Bearer <METRICS_TOKEN>` header
+app.config.METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
 # csrf config
 app.config["WTF_CSRF_SECRET_KEY"] = os.environ.get("CSRF_TOKEN")
 
@@ -53,10 +169,79 @@ app.config["WTF_CSRF_SECRET_KEY"] = os.environ.get("CSRF_TOKEN")
 app.static("/static", "./src/static")
 
 
+@app.before_server_start
+async def make_snowflake_generator(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    worker_id = claim_worker_id(app.config.SNOWFLAKE_WORKER_ID, app.config.WORKERS)
+    app.ctx.snowflake = IDGenerator(worker_id)
+
+
+@app.before_server_start
+async def create_executor(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    # made explicitly, instead of the loop's default one, to expose it's stats
+    app.ctx.executor = ThreadPoolExecutor(max_workers=app.config.EXECUTOR_WORKERS)
+    loop.set_default_executor(app.ctx.executor)
+
+
+@app.before_server_start
+async def compile_templates(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    preload_templates(app.ctx.env)
+
+
 @app.before_server_start
 async def connect_db(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
     await app.ctx.db.connect()
-    await app.ctx.db.initialize_tables()
+    await app.ctx.db.migrate()
+
+
+@app.before_server_start
+async def create_http_client(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    # one pooled client for the lifetime of the app, so that connections
+    # to Firebase and Discord are kept alive and reused between requests
+    connector = aiohttp.TCPConnector(
+        limit=app.config.HTTP_POOL_SIZE,
+        limit_per_host=app.config.HTTP_POOL_SIZE_PER_HOST,
+        keepalive_timeout=app.config.HTTP_KEEPALIVE_TIMEOUT,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=app.config.HTTP_TIMEOUT, connect=app.config.HTTP_CONNECT_TIMEOUT
+    )
+    app.ctx.http = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+@app.before_server_start
+async def connect_sessions(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    if isinstance(app.ctx.session_interface, RedisSessionInterface):
+        await app.ctx.session_interface.connect()
+
+
+@app.before_server_start
+async def connect_chat(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    await app.ctx.chat.connect()
+
+
+@app.after_server_start
+async def start_reconcile_job(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    if app.config.RECONCILE_INTERVAL > 0:
+        app.add_task(reconcile_member_counts(app))
+
+
+@app.after_server_start
+async def start_chat_flusher(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    app.add_task(app.ctx.chat.run_flusher(app))
+    if app.ctx.chat.redis_url:
+        app.add_task(app.ctx.chat.run_receiver(app))
+
+
+async def reconcile_member_counts(app: Sanic) -> None:
+    while True:
+        await asyncio.sleep(app.config.RECONCILE_INTERVAL)
+        try:
+            fixed = await Event.reconcile_member_counts(app)
+        except Exception:
+            logger.exception("Reconciling member counts failed")
+            continue
+        if fixed:
+            logger.warning(f"Fixed the member count of {fixed} events")
 
 
 @app.after_server_stop
@@ -64,6 +249,75 @@ async def disconnect_db(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
     await app.ctx.db.disconnect()
 
 
+# after_server_stop listeners run in reverse, so this runs before `disconnect_db`
+@app.after_server_stop
+async def flush_chat(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    try:
+        await app.ctx.chat.flush(app)
+    except Exception:
+        logger.exception(f"Lost {len(app.ctx.chat.pending)} chat messages")
+
+
+@app.after_server_stop
+async def close_http_client(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    await app.ctx.http.close()
+
+
+@app.after_server_stop
+async def disconnect_sessions(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    if isinstance(app.ctx.session_interface, RedisSessionInterface):
+        await app.ctx.session_interface.disconnect()
+
+
+@app.after_server_stop
+async def disconnect_chat(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+    await app.ctx.chat.disconnect()
+
+
+def route_name(request: Request) -> str:
+    # route names are prefixed with the app's name, like eventinator.event.event_by_id
+    name = request.endpoint or "eventinator.unmatched"
+    return name.partition(".")[2] or name
+
+
+@app.middleware("request")
+async def start_request_metrics(request: Request) -> None:
+    request.ctx.route = route_name(request)
+    request.ctx.started = perf_counter()
+    metrics.request_started(request.ctx.route)
+
+
+@app.middleware("response")
+async def record_request_metrics(request: Request, response: HTTPResponse) -> None:
+    started = getattr(request.ctx, "started", None)
+    if started is None:
+        # the request failed before the request middleware ran
+        return
+    metrics.request_finished(
+        request.ctx.route, request.method, response.status, perf_counter() - started
+    )
+
+
+@app.middleware("request")
+async def start_query_tracking(request: Request) -> None:
+    request.ctx.queries = metrics.track_queries()
+
+
+@app.middleware("response")
+async def add_query_stats(request: Request, response: HTTPResponse) -> None:
+    stats = getattr(request.ctx, "queries", None)
+    if stats is None:
+        return
+
+    timing = f'db;dur={stats.seconds * 1000:.1f};desc="{stats.queries} queries"'
+    response.headers["Server-Timing"] = timing
+    if stats.queries > app.config.QUERY_COUNT_WARNING:
+        logger.warning(
+            f"{request.method} {request.path} ran {stats.queries} queries "
+            f"({stats.seconds * 1000:.1f}ms)"
+        )
+
+
 IGNORED = (exceptions.NotFound,)
 
 
@@ -0,0 +1,146 @@
+"""
+Session backends, picked with the `SESSION_BACKEND` config value:
+    memory -> sessions are kept in the worker's memory. Only works with a single worker.
+    redis -> sessions are kept in Redis (or any server speaking the Redis protocol),
+        and shared between every worker and node.
+    cookie -> the whole session is kept in a signed cookie, no server-side lookup at all.
+Whichever backend is used, only store the values that are actually read back in the session.
+"""
+
+import json
+from time import time
+from typing import Optional
+
+import aioredis
+from sanic import Sanic
+from sanic.log import logger
+from sanic_session import InMemorySessionInterface
+from sanic_session.base import BaseSessionInterface, SessionDict, get_request_container
+
+from src.utils import sign, unsign
+
+# browsers drop cookies bigger than this
+MAX_COOKIE_SIZE = 4096
+
+
+class RedisSessionInterface(BaseSessionInterface):
+    """
+    Stores sessions in Redis. Anything that speaks the Redis protocol works,
+    so a local redis-server (or KeyDB etc.) can stand in for it while testing.
+    The connection pool is only created once the server starts, see `connect`.
+    """
+
+    def __init__(self, url: str, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.url = url
+        self.redis: Optional[aioredis.Redis] = None
+
+    async def connect(self) -> None:
+        self.redis = await aioredis.create_redis_pool(self.url)
+
+    async def disconnect(self) -> None:
+        self.redis.close()
+        await self.redis.wait_closed()
+
+    async def _get_value(self, prefix: str, sid: str) -> Optional[bytes]:
+        return await self.redis.get(prefix + sid)
+
+    async def _delete_key(self, key: str) -> None:
+        await self.redis.delete(key)
+
+    async def _set_value(self, key: str, data: str) -> None:
+        await self.redis.setex(key, self.expiry, data)
+
+    async def save(self, request, response) -> None:
+        # unlike the base interface, don't write the session back on every request.
+        # unmodified sessions only get their expiry pushed back
+        req = get_request_container(request)
+        session = req.get(self.session_name)
+        if session is None or session.modified or not session:
+            return await super().save(request, response)
+
+        await self.redis.expire(self.prefix + session.sid, self.expiry)
+        self._set_cookie_props(request, response)
+
+
+class CookieSessionInterface(BaseSessionInterface):
+    """
+    Stores the whole session in a signed cookie, so no server-side lookup is needed.
+    The data is signed (not encrypted!), the user can read it but not modify it.
+    """
+
+    def __init__(self, secret: str, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.secret = secret
+
+    async def open(self, request) -> SessionDict:
+        session = SessionDict(sid=None)
+        value = request.cookies.get(self.cookie_name)
+        data = unsign(value, self.secret) if value else None
+
+        if data is not None:
+            payload = json.loads(data)
+            if payload["e"] > time():
+                session = SessionDict(payload["d"], sid=value)
+
+        req = get_request_container(request)
+        req[self.session_name] = session
+        return session
+
+    async def save(self, request, response) -> None:
+        req = get_request_container(request)
+        session = req.get(self.session_name)
+        if session is None or not session.modified:
+            return
+
+        if not session:
+            self._delete_cookie(request, response)
+            return
+
+        payload = {"e": int(time() + self.expiry), "d": dict(session)}
+        session.sid = sign(
+            json.dumps(payload, separators=(",", ":")).encode(), self.secret
+        )
+        if len(session.sid) > MAX_COOKIE_SIZE:
+            logger.warning(
+                f"Session cookie is {len(session.sid)} bytes, browsers will drop it."
+            )
+        self._set_cookie_props(request, response)
+
+    # the cookie is the store, these are never used
+    async def _get_value(self, prefix: str, sid: str) -> None:
+        return None
+
+    async def _delete_key(self, key: str) -> None:
+        pass
+
+    async def _set_value(self, key: str, data: SessionDict) -> None:
+        pass
+
+
+def make_session_interface(app: Sanic) -> BaseSessionInterface:
+    """Creates the session interface configured with `SESSION_BACKEND`."""
+    options = dict(
+        expiry=app.config.SESSION_EXPIRY,
+        prefix="session:",
+        cookie_name="plantech",
+        domain=None,
+        httponly=True,
+        sessioncookie=True,
+        samesite=None,
+        session_name="session",
+        secure=False,
+    )
+    backend = app.config.SESSION_BACKEND
+
+    if backend == "redis":
+        return RedisSessionInterface(app.config.SESSION_REDIS_URL, **options)
+    elif backend == "cookie":
+        if not app.config.SESSION_SECRET:
+            raise RuntimeError("SESSION_SECRET must be set to use cookie sessions.")
+        return CookieSessionInterface(app.config.SESSION_SECRET, **options)
+    elif backend == "memory":
+        return InMemorySessionInterface(
+            sessioncookie=True, cookie_name="plantech", expiry=app.config.SESSION_EXPIRY
+        )
+    raise RuntimeError(f"Unknown session backend {backend!r}.")
@@ -1,7 +1,47 @@
-from typing import Any
+import base64
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+import hashlib
+import hmac
+import os
+import re
+import tempfile
+import threading
+from typing import Any, List, Optional, Tuple
 from time import time
 
-from jinja2 import Environment
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    PackageLoader,
+    select_autoescape,
+)
+
+
+def make_environment(*, debug: bool, cache_dir: Optional[str] = None) -> Environment:
+    """
+    Makes the jinja2 environment for the templates in src/templates.
+    Outside of debug mode, templates are not checked for changes on every render,
+    and compiled templates are cached on disk in `cache_dir` (if given).
+    """
+    bytecode_cache = None
+    if cache_dir and not debug:
+        os.makedirs(cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    return Environment(
+        loader=PackageLoader("src", "templates"),
+        autoescape=select_autoescape(["html"]),
+        enable_async=True,
+        auto_reload=debug,
+        bytecode_cache=bytecode_cache,
+    )
+
+
+def preload_templates(environment: Environment) -> None:
+    """Compiles every template up front, so that the first requests don't have to."""
+    for name in environment.list_templates():
+        environment.get_template(name)
 
 
 async def render_page(environment: Environment, *, file: str, **context: Any) -> str:
@@ -19,15 +59,225 @@ def transform_tz(initial: str) -> str:
     return final
 
 
+# time windows of the upcoming events listing, see `time_window`
+TIME_WINDOWS = ("upcoming", "today", "week", "ongoing")
+
+
+def utc_offset(tz: Optional[str]) -> timedelta:
+    """
+    Returns the UTC offset of a timezone stored by `transform_tz`, or no offset if
+    the user never set one.
+    `transform_tz` keeps the sign of the offset picked in the form, so "Etc/GMT+5"
+    is read as UTC+5, the opposite of what the Etc/GMT names mean.
+    """
+    match = re.fullmatch(r"Etc/GMT([+-]?)(\d+):?", tz or "")
+    if match is None:
+        return timedelta()
+    hours = int(match.group(2))
+    return timedelta(hours=-hours if match.group(1) == "-" else hours)
+
+
+def time_window(
+    window: str, tz: Optional[str], now: datetime
+) -> Tuple[datetime, Optional[datetime]]:
+    """
+    Returns the (start, end) of a window in `TIME_WINDOWS`, to compare with the
+    start times of events.
+    Events are whole days, stored as the midnight of their date without a timezone
+    (see `new_event` in src/views/event.py). So "today" and "week" start at midnight
+    of the user's current date, the timezone is only used to find out which date that
+    is. "week" is 7 days long.
+    "upcoming" starts now and has no end. "ongoing" is not a window of start times,
+    see `Event.ongoing`.
+
+    Arguments ::
+        tz: Optional[str] -> Timezone of the user, as stored by `transform_tz`.
+        now: datetime -> The current time, in UTC.
+    """
+    if window == "upcoming":
+        return now, None
+
+    midnight = (now + utc_offset(tz)).replace(hour=0, minute=0, second=0, microsecond=0)
+    days = 7 if window == "week" else 1
+    return midnight, midnight + timedelta(days=days)
+
+
+def sign(data: bytes, secret: str) -> str:
+    """Returns `data` and it's HMAC-SHA256 signature, as a URL and cookie safe string."""
+    signature = hmac.new(secret.encode(), data, hashlib.sha256).digest()
+    return f"{_b64encode(data)}.{_b64encode(signature)}"
+
+
+def unsign(value: str, secret: str) -> Optional[bytes]:
+    """Returns the data signed with `sign`, or None if the signature doesn't match."""
+    try:
+        data, signature = value.split(".", 1)
+        data_bytes = _b64decode(data)
+        signature_bytes = _b64decode(signature)
+    except ValueError:
+        return None
+
+    expected = hmac.new(secret.encode(), data_bytes, hashlib.sha256).digest()
+    if not hmac.compare_digest(signature_bytes, expected):
+        return None
+    return data_bytes
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    # binascii.Error is a subclass of ValueError
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def to_datetime(value: Any) -> datetime:
+    """Reads a TIMESTAMP column, which SQLite returns as a string."""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def time_cursor(time: Any, id: str) -> str:
+    """
+    Makes a pagination cursor for results ordered by a time and then by ID.
+    `time` is a TIMESTAMP column, see `to_datetime`.
+    """
+    return f"{to_datetime(time).isoformat()}_{id.strip()}"
+
+
+def parse_time_cursor(value: Optional[str]) -> Optional[Tuple[datetime, str]]:
+    """Parses a cursor made by `time_cursor`.
+    Returns None if there's no (valid) cursor."""
+    try:
+        time, id = (value or "").split("_", 1)
+        return datetime.fromisoformat(time), id
+    except ValueError:
+        return None
+
+
+def parse_cursor(value: Optional[str]) -> Optional[int]:
+    """Parses a snowflake pagination cursor from a query string argument.
+    Returns None if there's no (valid) cursor."""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+@dataclass
+class Page:
+    """One page of keyset-paginated results.
+    `next_cursor` is None on the last page."""
+
+    items: List[Any] = field(default_factory=list)
+    next_cursor: Optional[str] = None
+
+
+# snowflake layout: milliseconds since EPOCH | 8 bits worker ID | 6 bits sequence
+EPOCH = 1609459200000  # 2021-01-01, in milliseconds
+WORKER_BITS = 8
+SEQUENCE_BITS = 6
+MAX_WORKER_ID = 2 ** WORKER_BITS - 1
+MAX_SEQUENCE = 2 ** SEQUENCE_BITS - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+def snowflake_time(snowflake: int) -> datetime:
+    """When a snowflake was made, in UTC."""
+    return datetime.utcfromtimestamp(((snowflake >> TIMESTAMP_SHIFT) + EPOCH) / 1000)
+
+
 class IDGenerator:
     """Snowflake generator.
-    Used for making both user and event IDs."""
+    Used for making both user and event IDs.
 
-    def __init__(self):
-        self.wid = 0
-        self.inc = 0
+    Every process generating IDs must use a different worker ID, see `claim_worker_id`.
+    Up to 64 IDs are made per millisecond. When that runs out, the generator borrows
+    the next millisecond instead of waiting for it, and if the clock goes backwards it
+    keeps counting from the last timestamp it used. Either way IDs never repeat."""
+
+    def __init__(self, worker_id: int = 0) -> None:
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"Worker ID must be between 0 and {MAX_WORKER_ID}.")
+        self.wid = worker_id
+        self.last = -1  # timestamp of the last ID made
+        self.inc = MAX_SEQUENCE
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> "IDGenerator":
+        return self
 
     def __next__(self) -> int:
-        t = round(time() * 1000) - 1609459200000
-        self.inc += 1
-        return (t << 14) | (self.wid << 6) | (self.inc % 2 ** 6)
+        with self._lock:
+            t = max(round(time() * 1000) - EPOCH, self.last)
+            if t == self.last:
+                if self.inc == MAX_SEQUENCE:
+                    t += 1
+                    self.inc = 0
+                else:
+                    self.inc += 1
+            else:
+                self.inc = 0
+            self.last = t
+            return (t << TIMESTAMP_SHIFT) | (self.wid << SEQUENCE_BITS) | self.inc
+
+    def take(self, count: int) -> List[int]:
+        """Allocates a block of `count` IDs at once, meant for bulk inserts."""
+        ids: List[int] = []
+        worker = self.wid << SEQUENCE_BITS
+
+        with self._lock:
+            t = max(round(time() * 1000) - EPOCH, self.last)
+            inc = self.inc + 1 if t == self.last else 0
+            while len(ids) < count:
+                if inc > MAX_SEQUENCE:
+                    t += 1
+                    inc = 0
+                # the rest of this millisecond in one go
+                end = min(MAX_SEQUENCE + 1, inc + count - len(ids))
+                prefix = (t << TIMESTAMP_SHIFT) | worker
+                ids.extend(prefix | i for i in range(inc, end))
+                inc = end
+            self.last = t
+            self.inc = inc - 1
+        return ids
+
+
+# lock files of the claimed worker IDs, see `claim_worker_id`
+_claimed_worker_locks: List[Any] = []
+
+
+def claim_worker_id(first: int, count: int) -> int:
+    """
+    Claims a snowflake worker ID for this process,
+    out of the `count` IDs starting at `first`.
+    The worker processes of one node all call this, each of them gets a different ID.
+    The claim is an exclusive lock on a file, held until the process exits.
+
+    Raises ::
+        RuntimeError, if all `count` IDs are claimed already.
+    """
+    if count == 1:
+        return first
+
+    import fcntl  # not available on windows, where only one worker can run anyway
+
+    for worker_id in range(first, first + count):
+        path = os.path.join(
+            tempfile.gettempdir(), f"eventinator-worker-{worker_id}.lock"
+        )
+        handle = open(path, "w")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            continue
+        # keep the file open, closing it would release the lock
+        _claimed_worker_locks.append(handle)
+        return worker_id
+
+    raise RuntimeError(
+        f"All snowflake worker IDs from {first} to {first + count - 1} are taken."
+    )
@@ -6,3 +6,5 @@ import src.views.index
 import src.views.user
 import src.views.discord
 import src.views.event
+import src.views.assets
+import src.views.metrics
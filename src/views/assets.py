@@ -0,0 +1,38 @@
+import mimetypes
+import os
+
+from sanic.exceptions import NotFound
+from sanic.request import Request
+from sanic.response import HTTPResponse, file
+
+from src.assets import DIST_DIR, ENCODINGS, accepted_encodings
+from src.server import app
+
+
+# hashed files never change, browsers can keep them forever
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# only files from the manifest are served, which also rules out path traversal
+HASHED_FILES = set(app.ctx.assets["files"].values())
+
+
+@app.get("/assets/<path:path>")
+async def serve_asset(request: Request, path: str) -> HTTPResponse:
+    """Serves the files built by `src.assets`, precompressed if the browser accepts it."""
+    if path not in HASHED_FILES:
+        raise NotFound("No such asset.")
+
+    location = os.path.join(DIST_DIR, path)
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {"Cache-Control": CACHE_CONTROL}
+
+    encodings = app.ctx.assets["encodings"].get(path, [])
+    if encodings:
+        headers["Vary"] = "Accept-Encoding"
+        accepted = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        for encoding, suffix in ENCODINGS.items():
+            if encoding in encodings and encoding in accepted:
+                headers["Content-Encoding"] = encoding
+                location += suffix
+                break
+
+    return await file(location, headers=headers, mime_type=mime_type)
@@ -1,15 +1,29 @@
+import asyncio
+from datetime import datetime, time
+from json import dumps
 from typing import Optional, Union
 
 from sanic import Blueprint
-from sanic.exceptions import ServerError
+from sanic.exceptions import InvalidUsage, NotFound, ServerError
+from sanic.log import logger
 from sanic.request import Request
-from sanic.response import html, HTTPResponse, redirect
+from sanic.response import html, HTTPResponse, json, redirect, stream, text
 
 from src.auth import authorized, guest_or_authorized, User, OwnerOnlyActionError
-from src.events import Event
+from src.cache import CachedResponse
+from src.chat import CHAT_MESSAGE_LENGTH, RateLimit, chat_topic, history_json
+from src.events import EXPORT_FORMATS, Event, members_topic
 from src.forms import EventCreationForm, EventActionForm
+from src.importer import (
+    IMPORT_FORMATS,
+    ImportReport,
+    InvalidImportError,
+    import_events,
+    parse_events,
+)
+from src.pubsub import EVICTED
 from src.server import app
-from src.utils import render_page
+from src.utils import Page, TIME_WINDOWS, parse_time_cursor, render_page, time_window
 
 
 event = Blueprint("event", url_prefix="/event")
@@ -20,32 +34,357 @@ event = Blueprint("event", url_prefix="/event")
 async def event_by_id(
     request: Request, event_id: int, user: Union[User, str], platform: Optional[str]
 ) -> HTTPResponse:
-    event = await Event.by_id(app, str(event_id))
-    owner = await User.from_db(app, _id=event.event_owner)
+    guest = not isinstance(user, User)
+    if guest:
+        # guests all get the same page, which is cached until the event changes
+        cached = app.ctx.page_cache.get(event_id)
+        if cached is not None:
+            return cached_page(request, cached)
 
-    join_form, leave_form, delete_form = [EventActionForm(request)] * 3
+    # the event, owner and member list all come from one query
+    page = await Event.load_page(
+        app,
+        str(event_id),
+        viewer=None if guest else user,
+        member_limit=app.config.EVENT_PAGE_MEMBERS,
+        members_after=request.args.get("members"),
+    )
+    if page is None:
+        raise NotFound("This event does not exist.")
 
-    if isinstance(user, User):
-        # the user is logged in, display all the details
-        event_members_names = await event.get_members_usernames(app)
-    else:
-        # not logged in, show only minimal info
-        event_members_names = None
+    join_form, leave_form, delete_form = [EventActionForm(request)] * 3
 
     output = await render_page(
         app.ctx.env,
         file="event-display.html",
-        event=event,
-        event_members=event_members_names,
+        event=page.event,
+        # usernames if the user is logged in, else None to show only minimal info
+        event_members=page.members,
+        members_cursor=page.members_cursor,
+        is_member=page.is_member,
         user=user,  # can be either a User object, or a string saying "guest"
-        owner=owner,
+        owner=page.owner,
         leave_form=leave_form,
         join_form=join_form,
     )
 
+    if guest:
+        return cached_page(request, app.ctx.page_cache.set(event_id, output.encode()))
     return html(output)
 
 
+def cached_page(request: Request, cached: CachedResponse) -> HTTPResponse:
+    """Responds with a cached page, or with a 304 if the browser already has it."""
+    # no-cache lets browsers keep the page, as long as they revalidate it every time
+    headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == cached.etag:
+        return HTTPResponse(status=304, headers=headers)
+    return html(cached.body, headers=headers)
+
+
+@event.get("/<event_id:int>/members")
+@authorized()
+async def event_members(
+    request: Request, event_id: int, user: User, platform: str
+) -> HTTPResponse:
+    """JSON listing of an event's members, paginated with the `after` cursor."""
+    try:
+        limit = int(request.args.get("limit", app.config.EVENT_PAGE_MEMBERS))
+    except ValueError:
+        limit = app.config.EVENT_PAGE_MEMBERS
+    limit = max(1, min(limit, app.config.EVENT_MEMBERS_MAX_PAGE_SIZE))
+
+    page = await Event.members_page(
+        app, str(event_id), limit=limit, after=request.args.get("after")
+    )
+    return json(
+        {
+            "members": [
+                {"uid": i["uid"].strip(), "username": i["username"]} for i in page.items
+            ],
+            "next": page.next_cursor,
+        }
+    )
+
+
+@event.get("/search")
+@guest_or_authorized()
+async def search_events(
+    request: Request, user: Union[User, str], platform: Optional[str]
+) -> HTTPResponse:
+    """
+    JSON full text search of events (`?q=`), best matches first.
+    Paginated with the `offset` cursor, up to `SEARCH_MAX_OFFSET` results deep.
+    """
+    limit = listing_limit(request)
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+    except ValueError:
+        raise InvalidUsage("offset must be a number.")
+    if offset >= app.config.SEARCH_MAX_OFFSET:
+        return json({"events": [], "next": None})
+
+    query = request.args.get("q", "")
+    page = await Event.search(app, query, limit=limit, offset=offset)
+    if page.next_cursor and int(page.next_cursor) >= app.config.SEARCH_MAX_OFFSET:
+        page.next_cursor = None
+    return listing(page)
+
+
+@event.get("/upcoming")
+@guest_or_authorized()
+async def upcoming_events(
+    request: Request, user: Union[User, str], platform: Optional[str]
+) -> HTTPResponse:
+    """
+    JSON listing of the events in a time window (`?window=`, see `TIME_WINDOWS`),
+    paginated with the `after` cursor. "today" and "this week" are in the timezone
+    of the user, guests get UTC.
+    """
+    window = request.args.get("window", "upcoming")
+    if window not in TIME_WINDOWS:
+        raise InvalidUsage(f"window must be one of {', '.join(TIME_WINDOWS)}.")
+    limit = listing_limit(request)
+    after = parse_time_cursor(request.args.get("after"))
+
+    now = datetime.utcnow()
+    if window == "ongoing":
+        page = await Event.ongoing(app, now, limit=limit, after=after)
+    else:
+        tz = user.tz if isinstance(user, User) else None
+        start, end = time_window(window, tz, now)
+        page = await Event.starting_between(app, start, end, limit=limit, after=after)
+    return listing(page)
+
+
+def listing_limit(request: Request) -> int:
+    """Page size of listings, like the ones of events, from the `limit` argument."""
+    try:
+        limit = int(request.args.get("limit", app.config.LISTING_PAGE_SIZE))
+    except ValueError:
+        limit = app.config.LISTING_PAGE_SIZE
+    return max(1, min(limit, app.config.LISTING_MAX_PAGE_SIZE))
+
+
+def listing(page: Page) -> HTTPResponse:
+    """Responds with a page of events, with `LISTING_COLUMNS`."""
+    return json(
+        {
+            "events": [
+                {
+                    "event_id": i["event_id"].strip(),
+                    "event_name": i["event_name"],
+                    "short_desc": i["short_desc"],
+                    "start_time": str(i["start_time"]),
+                    "end_time": str(i["end_time"]),
+                    "member_count": i["member_count"],
+                }
+                for i in page.items
+            ],
+            "next": page.next_cursor,
+        }
+    )
+
+
+@event.get("/<event_id:int>/live")
+@authorized()
+async def live_members(
+    request: Request, event_id: int, user: User, platform: str
+) -> HTTPResponse:
+    """
+    Streams the joins and leaves of an event as server-sent events, see
+    `members_topic`. A connection that falls too far behind gets an "evicted" event,
+    and is closed.
+    """
+    try:
+        event = await Event.by_id(app, str(event_id))
+    except TypeError:
+        raise NotFound("This event does not exist.")
+
+    async def write(response) -> None:
+        with app.ctx.hub.subscribe(members_topic(event.event_id)) as subscription:
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        subscription.get(), app.config.LIVE_KEEPALIVE
+                    )
+                except asyncio.TimeoutError:
+                    await response.write(": keepalive\n\n")
+                    continue
+                if message is EVICTED:
+                    await response.write("event: evicted\ndata: {}\n\n")
+                    return
+                await response.write(f"event: members\ndata: {message}\n\n")
+
+    return stream(
+        write,
+        content_type="text/event-stream",
+        # proxies like nginx would buffer the stream otherwise
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@event.websocket("/<event_id:int>/chat")
+@authorized()
+async def event_chat(
+    request: Request, ws, event_id: int, user: User, platform: str
+) -> None:
+    """
+    Chat of the members of an event, see src/chat.py. Every text frame the client
+    sends is a message, the server sends JSON: the recent history when connecting,
+    then the messages as they are posted, and errors about the client's own messages.
+    Older history is paginated at /event/<event_id>/chat/history.
+    """
+    # the session cookie is sent cross-site (samesite=None), so any other site
+    # could open this socket as the user. browsers send the page's origin, which
+    # is http(s), not ws(s)
+    scheme = {"ws": "http", "wss": "https"}.get(request.scheme, request.scheme)
+    if request.headers.get("origin") != f"{scheme}://{request.host}":
+        await ws.close(code=4003, reason="Chat is only open to this site's pages.")
+        return
+    if not await user.is_member(app, str(event_id)):
+        await ws.close(code=4003, reason="Only members of the event can chat.")
+        return
+    chat = app.ctx.chat
+    room = await chat.room(app, str(event_id))
+
+    uid = user.uid.strip()
+    room.connect(uid, ws)
+    # subscribed before the snapshot, and without awaiting in between,
+    # so that no message is missed or sent twice
+    subscription = app.ctx.hub.subscribe(chat_topic(room.event_id))
+    snapshot = history_json(*chat.snapshot(room))
+
+    async def receive() -> None:
+        limit = RateLimit(app.config.CHAT_RATE_LIMIT, app.config.CHAT_RATE_PERIOD)
+        while True:
+            data = await ws.recv()
+            body = data.strip() if isinstance(data, str) else ""
+            if not body or len(body) > CHAT_MESSAGE_LENGTH:
+                error = f"Messages are 1 to {CHAT_MESSAGE_LENGTH} characters of text."
+            elif not limit.allow():
+                error = "You are sending messages too fast."
+            else:
+                chat.post(app, room, uid, user.username, body)
+                continue
+            await ws.send(dumps({"type": "error", "message": error}))
+
+    async def send() -> None:
+        await ws.send(snapshot)
+        async for message in subscription:
+            await ws.send(message)
+        # evicted, the client reconnects to get the recent history again
+        await ws.close(code=4000, reason="Too far behind.")
+
+    tasks = [asyncio.ensure_future(receive()), asyncio.ensure_future(send())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        subscription.close()
+        room.disconnect(uid, ws)
+
+
+@event.get("/<event_id:int>/chat/history")
+@authorized()
+async def chat_history(
+    request: Request, event_id: int, user: User, platform: str
+) -> HTTPResponse:
+    """
+    Members-only route, pages of chat messages newest first. Paginated with the
+    `before` cursor, served from memory when the room has the page.
+    """
+    if not await user.is_member(app, str(event_id)):
+        raise NotFound("This event does not exist, or you are not a member of it.")
+    limit = listing_limit(request)
+    before = request.args.get("before")
+    try:
+        before = int(before) if before is not None else None
+    except ValueError:
+        raise InvalidUsage("Invalid cursor.")
+
+    chat = app.ctx.chat
+    page = chat.history(chat.rooms.get(str(event_id)), before, limit)
+    if page is None:
+        page = await chat.read_history(app, str(event_id), before, limit)
+    return text(history_json(*page), content_type="application/json")
+
+
+@event.get("/<event_id:int>/export")
+@authorized()
+async def export_members(
+    request: Request, event_id: int, user: User, platform: str
+) -> HTTPResponse:
+    """Owner-only route, streams the member list as CSV or NDJSON (`?format=ndjson`)."""
+    format = request.args.get("format", "csv")
+    if format not in EXPORT_FORMATS:
+        raise ServerError("Unknown export format.", status_code=400)
+
+    try:
+        event = await Event.by_id(app, str(event_id))
+    except TypeError:
+        raise NotFound("This event does not exist.")
+
+    if not event.is_owner(user):
+        raise OwnerOnlyActionError(
+            message="Only the event owner can export the members.", status_code=401
+        )
+
+    async def write(response) -> None:
+        async for chunk in Event.export_members(app, event.event_id, format=format):
+            await response.write(chunk)
+
+    filename = f"event-{event_id}-members.{format}"
+    return stream(
+        write,
+        content_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@event.post("/import")
+@authorized()
+async def import_event_file(
+    request: Request, user: User, platform: str
+) -> HTTPResponse:
+    """
+    Bulk imports events owned by the user, see `src.importer` for the file format.
+    The file is the request body, with a text/csv or application/json content type.
+    """
+    # those content types can't be sent cross-site without a CORS preflight,
+    # which is what protects this route from CSRF, as it has no form token
+    content_type = request.content_type.split(";")[0].strip().lower()
+    formats = {value: key for key, value in IMPORT_FORMATS.items()}
+    if content_type not in formats:
+        raise ServerError(
+            "Send the file as text/csv or application/json.", status_code=415
+        )
+
+    try:
+        data = request.body.decode("utf-8")
+    except UnicodeDecodeError:
+        raise InvalidImportError("The file must be UTF-8 encoded.")
+    events = parse_events(data, formats[content_type])
+
+    def log_progress(report: ImportReport) -> None:
+        logger.info(
+            f"Import by {user.uid}: {report.events}/{report.total} events, "
+            f"{report.rows_per_second:.0f} rows/s"
+        )
+
+    report = await import_events(
+        app,
+        user.uid,
+        events,
+        batch_size=app.config.IMPORT_BATCH_SIZE,
+        progress=log_progress,
+    )
+    return json(report.to_dict(), status=201)
+
+
 @event.post("/leave")
 @authorized()
 async def leave_event(request: Request, user: User, platform: str) -> HTTPResponse:
@@ -83,8 +422,9 @@ async def new_event(request: Request, user: User, platform: str) -> HTTPResponse
                 event_id=event_id,
                 event_name=form.eventname.data,
                 event_owner=user.uid,
-                start_time=form.starttime.data,
-                end_time=form.endtime.data,
+                # the columns are TIMESTAMPs, asyncpg won't take plain dates for them
+                start_time=datetime.combine(form.starttime.data, time.min),
+                end_time=datetime.combine(form.endtime.data, time.min),
                 long_desc=form.longdescription.data,
                 short_desc=form.shortdescription.data,
             )
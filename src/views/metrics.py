@@ -0,0 +1,73 @@
+import hmac
+from typing import Dict, List, Optional
+
+from sanic.exceptions import Forbidden
+from sanic.request import Request
+from sanic.response import HTTPResponse, text
+
+from src import ical, metrics
+from src.auth import discord, firebase
+from src.server import app
+
+
+# values of the stats dicts that are running totals, exported as counters
+COUNTERS = {
+    "hits",
+    "misses",
+    "published",
+    "delivered",
+    "evictions",
+    "flushed",
+    "dropped",
+}
+
+
+def add_stats(
+    gauges: List[metrics.Sample],
+    counters: List[metrics.Sample],
+    prefix: str,
+    stats: Dict[str, int],
+    labels: Optional[Dict[str, str]] = None,
+) -> None:
+    """Adds the values of a `stats()` dict to the gauges, or to the counters."""
+    for name, value in stats.items():
+        if name in COUNTERS:
+            counters.append((f"{prefix}_{name}_total", labels or {}, value))
+        else:
+            gauges.append((f"{prefix}_{name}", labels or {}, value))
+
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request) -> HTTPResponse:
+    """Metrics of this worker, in the Prometheus text format."""
+    token = app.config.METRICS_TOKEN
+    if token and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        raise Forbidden("A valid metrics token is required.")
+
+    gauges: List[metrics.Sample] = []
+    counters: List[metrics.Sample] = []
+    add_stats(gauges, counters, "eventinator_db", app.ctx.db.stats())
+
+    # ThreadPoolExecutor has no public API for these
+    executor = app.ctx.executor
+    gauges.append(("eventinator_executor_threads", {}, len(executor._threads)))
+    gauges.append(("eventinator_executor_max_threads", {}, executor._max_workers))
+    gauges.append(("eventinator_executor_queued", {}, executor._work_queue.qsize()))
+
+    add_stats(gauges, counters, "eventinator_pubsub", app.ctx.hub.stats())
+    add_stats(gauges, counters, "eventinator_chat", app.ctx.chat.stats())
+
+    caches = {
+        **firebase.session_cache_stats(),
+        "discord_identities": discord.identities.stats(),
+        "event_pages": app.ctx.page_cache.stats(),
+        "calendar_vevents": ical.vevents.stats(),
+    }
+    for cache, stats in caches.items():
+        add_stats(gauges, counters, "eventinator_cache", stats, {"cache": cache})
+
+    return text(
+        metrics.render(gauges, counters), content_type="text/plain; version=0.0.4"
+    )
@@ -1,12 +1,21 @@
 from sanic import Blueprint
-from sanic.exceptions import ServerError
+from sanic.exceptions import NotFound, ServerError
 from sanic.request import Request
-from sanic.response import html, HTTPResponse, redirect
+from sanic.response import html, HTTPResponse, redirect, stream
 
 from src.forms import DashboardForm, LoginForm, SignUpForm, EventActionForm
 from src.auth import authorized, firebase, User, UnauthenticatedError
+from src.ical import (
+    CONTENT_TYPE,
+    calendar_token,
+    memberships_updated_at,
+    not_modified,
+    render_feed,
+    token_uid,
+    version_headers,
+)
 from src.server import app
-from src.utils import render_page, transform_tz
+from src.utils import parse_cursor, render_page, transform_tz
 
 
 user = Blueprint("user", url_prefix="/user")
@@ -26,8 +35,6 @@ async def email_login(request: Request) -> HTTPResponse:
         if not auth_data:
             raise ServerError("-- `auth_data` returned None: L27 user.py --")
 
-        request.ctx.session["firebase_auth_data"] = auth_data
-
         valid = await firebase.create_session_cookie(app, request, auth_data)
 
         if valid:
@@ -63,8 +70,6 @@ async def email_signup(request: Request) -> HTTPResponse:
         if not auth_data:
             raise ServerError("-- `auth_data` is None L62 user.py --")
 
-        request.ctx.session["firebase_auth_data"] = auth_data
-
         valid = await firebase.create_session_cookie(app, request, auth_data)
 
         if not valid:
@@ -88,7 +93,6 @@ async def user_logout(request: Request, user: User, platform: str) -> HTTPRespon
     response = redirect(url)
 
     if platform == "firebase":
-        del request.ctx.session["firebase_auth_data"]
         await firebase.delete_session_cookie(app, request)
     elif platform == "discord":
         del response.cookies["session"]
@@ -102,9 +106,19 @@ async def user_dashboard(request: Request, user: User, platform: str) -> HTTPRes
     dashboard_form = DashboardForm(request)
     delete_form = EventActionForm(request)
 
-    all_events = await user.get_events(app)
-    owned_events = await user.get_owned_events(app)
+    joined_cursor = parse_cursor(request.args.get("joined"))
+    owned_cursor = parse_cursor(request.args.get("owned"))
+    all_events, owned_events = await user.get_dashboard(
+        app,
+        limit=app.config.DASHBOARD_PAGE_SIZE,
+        joined_before=joined_cursor,
+        owned_before=owned_cursor,
+    )
     from_discord = True if platform == "discord" else False
+    calendar_url = None
+    if app.config.CALENDAR_SECRET:
+        token = calendar_token(user.uid, app.config.CALENDAR_SECRET)
+        calendar_url = request.url_for("user.calendar_feed", token=token)
 
     output = await render_page(
         app.ctx.env,
@@ -114,12 +128,44 @@ async def user_dashboard(request: Request, user: User, platform: str) -> HTTPRes
         from_discord=from_discord,
         all_events=all_events,
         owned_events=owned_events,
+        joined_cursor=joined_cursor,
+        owned_cursor=owned_cursor,
         username=user.username,
         tz=user.tz,
+        calendar_url=calendar_url,
     )
     return html(output)
 
 
+@user.get("/<token>/calendar.ics")
+async def calendar_feed(request: Request, token: str) -> HTTPResponse:
+    """
+    iCalendar feed of the events the user is a member of, see src/ical.py.
+    There's no login, calendar apps are authorized by the token in the URL.
+    """
+    secret = app.config.CALENDAR_SECRET
+    uid = token_uid(token, secret) if secret else None
+    if uid is None:
+        raise NotFound("This calendar does not exist.")
+    try:
+        updated_at = await memberships_updated_at(app, uid)
+    except LookupError:
+        raise NotFound("This calendar does not exist.")
+
+    # no-cache lets calendar apps keep the feed, as long as they revalidate it
+    headers = {**version_headers(updated_at), "Cache-Control": "no-cache"}
+    if not_modified(request.headers, headers):
+        return HTTPResponse(status=304, headers=headers)
+
+    base_url = f"{request.scheme}://{request.host}"
+
+    async def write(response) -> None:
+        async for chunk in render_feed(app, uid, base_url=base_url):
+            await response.write(chunk)
+
+    return stream(write, content_type=CONTENT_TYPE, headers=headers)
+
+
 @user.route("/tz", methods=["POST"])
 @authorized()
 async def set_user_tz(request: Request, user: User, platform: str) -> HTTPResponse:
@@ -0,0 +1,223 @@
+"""
+Tests of the chat rooms in src/chat.py, shared by two workers.
+Redis is replaced by a fake pub/sub broker, so these run without a server.
+
+    python -m pytest tests
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+from typing import Dict, List
+from unittest import mock
+
+from src.chat import Chat, chat_topic
+from src.pubsub import Hub
+from src.utils import IDGenerator
+
+
+EVENT_ID = "event"
+
+
+class FakeChannel:
+    def __init__(self) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def iter(self, encoding: str):
+        while True:
+            yield (await self.queue.get()).decode(encoding)
+
+
+class FakeBroker:
+    """Delivers what is published on a channel to every fake connection subscribed."""
+
+    def __init__(self) -> None:
+        self.channels: Dict[str, List[FakeChannel]] = {}
+
+    async def create_redis(self, url: str) -> "FakeRedis":
+        return FakeRedis(self)
+
+
+class FakeRedis:
+    """The commands `Chat` uses, on one connection."""
+
+    def __init__(self, broker: FakeBroker) -> None:
+        self.broker = broker
+        self.subscribed: List[FakeChannel] = []
+
+    async def publish(self, name: str, message: str) -> int:
+        channels = self.broker.channels.get(name, [])
+        for channel in channels:
+            channel.queue.put_nowait(message.encode())
+        return len(channels)
+
+    async def subscribe(self, name: str) -> List[FakeChannel]:
+        channel = FakeChannel()
+        self.broker.channels.setdefault(name, []).append(channel)
+        self.subscribed.append(channel)
+        return [channel]
+
+    def close(self) -> None:
+        for channels in self.broker.channels.values():
+            for channel in self.subscribed:
+                if channel in channels:
+                    channels.remove(channel)
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+def make_worker(worker_id: int) -> SimpleNamespace:
+    """The parts of the app the chat uses, with an empty chat_messages table."""
+    db = SimpleNamespace(fetch=mock.AsyncMock(return_value=[]))
+    ctx = SimpleNamespace(
+        db=db,
+        hub=Hub(),
+        chat=Chat(recent=5, redis_url="redis://fake"),
+        snowflake=IDGenerator(worker_id),
+    )
+    return SimpleNamespace(ctx=ctx)
+
+
+async def start_workers(count: int = 2) -> List[SimpleNamespace]:
+    workers = [make_worker(i) for i in range(count)]
+    for app in workers:
+        await app.ctx.chat.connect()
+        app.ctx.receiver = asyncio.ensure_future(app.ctx.chat.run_receiver(app))
+    await settle()
+    return workers
+
+
+async def stop_workers(workers: List[SimpleNamespace]) -> None:
+    for app in workers:
+        app.ctx.receiver.cancel()
+        await app.ctx.chat.disconnect()
+
+
+async def settle() -> None:
+    """Lets the changes sent so far reach every worker."""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def bodies(payloads: List[str]) -> List[str]:
+    return [json.loads(i)["body"] for i in payloads]
+
+
+def received(subscription) -> List[str]:
+    messages = []
+    while not subscription.queue.empty():
+        frame = json.loads(subscription.queue.get_nowait())
+        messages.extend(i["body"] for i in frame["messages"])
+    return messages
+
+
+def test_messages_reach_every_worker():
+    async def main():
+        with mock.patch("aioredis.create_redis", FakeBroker().create_redis):
+            first, second = await start_workers()
+            rooms = [await app.ctx.chat.room(app, EVENT_ID) for app in (first, second)]
+            subscriptions = [
+                app.ctx.hub.subscribe(chat_topic(EVENT_ID)) for app in (first, second)
+            ]
+
+            first.ctx.chat.post(first, rooms[0], "a", "Alice", "hello")
+            second.ctx.chat.post(second, rooms[1], "b", "Bob", "hi")
+            await settle()
+
+            for subscription in subscriptions:
+                assert sorted(received(subscription)) == ["hello", "hi"]
+            # both rooms hold the same messages, in the order of their IDs
+            for room in rooms:
+                ids = [i.message_id for i in room.recent]
+                assert ids == sorted(ids) and len(ids) == 2
+            workers = (first, second)
+            first_snapshot, second_snapshot = [
+                app.ctx.chat.snapshot(room) for app, room in zip(workers, rooms)
+            ]
+            assert first_snapshot == second_snapshot
+            # only the worker it was posted on writes a message
+            assert [len(app.ctx.chat.pending) for app in (first, second)] == [1, 1]
+            await stop_workers([first, second])
+
+    asyncio.run(main())
+
+
+def test_rooms_loaded_later_get_unwritten_messages():
+    async def main():
+        with mock.patch("aioredis.create_redis", FakeBroker().create_redis):
+            first, second = await start_workers()
+            room = await first.ctx.chat.room(first, EVENT_ID)
+            for i in range(3):
+                first.ctx.chat.post(first, room, "a", "Alice", f"message {i}")
+            await settle()
+
+            # the second worker had no room yet, and the messages aren't written
+            assert EVENT_ID not in second.ctx.chat.rooms
+            later = await second.ctx.chat.room(second, EVENT_ID)
+            messages, cursor = second.ctx.chat.snapshot(later)
+            assert bodies(messages) == ["message 2", "message 1", "message 0"]
+            assert cursor is None
+
+            messages, cursor = await second.ctx.chat.read_history(
+                second, EVENT_ID, None, 2
+            )
+            assert bodies(messages) == ["message 2", "message 1"]
+            messages, _ = await second.ctx.chat.read_history(
+                second, EVENT_ID, int(cursor), 2
+            )
+            assert bodies(messages) == ["message 0"]
+            await stop_workers([first, second])
+
+    asyncio.run(main())
+
+
+def test_room_changes_reach_every_worker():
+    async def main():
+        with mock.patch("aioredis.create_redis", FakeBroker().create_redis):
+            first, second = await start_workers()
+            room = await second.ctx.chat.room(second, EVENT_ID)
+            sockets = {uid: mock.AsyncMock() for uid in ("a", "b", "c")}
+            for uid, ws in sockets.items():
+                room.connect(uid, ws)
+            first.ctx.chat.post(
+                first, await first.ctx.chat.room(first, EVENT_ID), "a", "Alice", "hi"
+            )
+            await settle()
+
+            first.ctx.chat.remove_member(first, EVENT_ID, "a ")
+            first.ctx.chat.remove_user(first, "b")
+            await settle()
+            assert set(room.connections) == {"c"}
+            sockets["a"].close.assert_awaited_once_with(
+                code=4003, reason="You left this event."
+            )
+            sockets["b"].close.assert_awaited_once_with(
+                code=4003, reason="Your account was deleted."
+            )
+
+            first.ctx.chat.forget(first, EVENT_ID)
+            await settle()
+            sockets["c"].close.assert_awaited_once_with(
+                code=4003, reason="This event was deleted."
+            )
+            for app in (first, second):
+                assert EVENT_ID not in app.ctx.chat.rooms
+                assert not app.ctx.chat.pending and not app.ctx.chat.received
+            await stop_workers([first, second])
+
+    asyncio.run(main())
+
+
+def test_without_redis_everything_stays_in_the_worker():
+    async def main():
+        app = make_worker(0)
+        app.ctx.chat = Chat(recent=5)
+        await app.ctx.chat.connect()
+        room = await app.ctx.chat.room(app, EVENT_ID)
+        subscription = app.ctx.hub.subscribe(chat_topic(EVENT_ID))
+        app.ctx.chat.post(app, room, "a", "Alice", "hello")
+        await settle()
+        assert received(subscription) == ["hello"]
+        assert app.ctx.chat.redis is None and not app.ctx.chat.outgoing
+
+    asyncio.run(main())
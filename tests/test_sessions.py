@@ -0,0 +1,168 @@
+"""
+Tests of the session backends in src/sessions.py.
+Redis is replaced by a fake pool, so these run without a server.
+
+    python -m pytest tests
+"""
+import asyncio
+import base64
+import json
+from types import SimpleNamespace
+from typing import Dict, Optional, Tuple
+from unittest import mock
+
+from sanic.response import HTTPResponse
+
+from src.sessions import CookieSessionInterface, RedisSessionInterface
+
+
+OPTIONS = dict(
+    expiry=60,
+    prefix="session:",
+    cookie_name="plantech",
+    domain=None,
+    httponly=True,
+    sessioncookie=True,
+    samesite=None,
+    session_name="session",
+    secure=False,
+)
+
+
+class FakeRedis:
+    """The commands `RedisSessionInterface` uses, with expiry on a fake clock."""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        # key -> (value, expires at)
+        self.data: Dict[str, Tuple[bytes, float]] = {}
+
+    def ttl(self, key: str) -> float:
+        return self.data[key][1] - self.now
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value, expires = self.data.get(key, (None, 0))
+        return value if expires > self.now else None
+
+    async def setex(self, key: str, seconds: int, value: str) -> None:
+        self.data[key] = (value.encode(), self.now + seconds)
+
+    async def expire(self, key: str, seconds: int) -> int:
+        if await self.get(key) is None:
+            return 0
+        self.data[key] = (self.data[key][0], self.now + seconds)
+        return 1
+
+    async def delete(self, key: str) -> None:
+        self.data.pop(key, None)
+
+    def close(self) -> None:
+        pass
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+def make_request(cookie: Optional[str] = None) -> SimpleNamespace:
+    cookies = {"plantech": cookie} if cookie else {}
+    return SimpleNamespace(cookies=cookies, ctx=SimpleNamespace())
+
+
+async def request_cycle(interface, cookie: Optional[str], update=None) -> Tuple:
+    """Opens a session, changes it with `update`, saves it. Returns (session, cookie)."""
+    request = make_request(cookie)
+    session = await interface.open(request)
+    if update is not None:
+        update(session)
+    response = HTTPResponse()
+    await interface.save(request, response)
+    sent = response.cookies.get("plantech")
+    return session, sent.value if sent is not None else cookie
+
+
+async def connected_redis() -> Tuple[RedisSessionInterface, FakeRedis]:
+    redis = FakeRedis()
+    interface = RedisSessionInterface("redis://localhost", **OPTIONS)
+    with mock.patch("aioredis.create_redis_pool", mock.AsyncMock(return_value=redis)):
+        await interface.connect()
+    return interface, redis
+
+
+def test_redis_round_trip():
+    async def run():
+        interface, redis = await connected_redis()
+        _, cookie = await request_cycle(
+            interface, None, lambda session: session.update(token="abc")
+        )
+        session, _ = await request_cycle(interface, cookie)
+        assert dict(session) == {"token": "abc"}
+
+        # emptying the session deletes it
+        await request_cycle(interface, cookie, lambda session: session.clear())
+        assert redis.data == {}
+        await interface.disconnect()
+
+    asyncio.run(run())
+
+
+def test_redis_expiry_and_refresh():
+    async def run():
+        interface, redis = await connected_redis()
+        _, cookie = await request_cycle(
+            interface, None, lambda session: session.update(token="abc")
+        )
+        key = "session:" + cookie
+        value = redis.data[key][0]
+
+        # an unmodified session isn't written again, it's expiry is pushed back
+        redis.now += 50
+        with mock.patch.object(redis, "setex") as setex:
+            session, _ = await request_cycle(interface, cookie)
+        setex.assert_not_called()
+        assert dict(session) == {"token": "abc"}
+        assert redis.data[key][0] == value
+        assert redis.ttl(key) == 60
+
+        # and a session left alone for longer than the expiry is gone
+        redis.now += 61
+        session, _ = await request_cycle(interface, cookie)
+        assert dict(session) == {}
+
+    asyncio.run(run())
+
+
+def test_cookie_round_trip_and_expiry():
+    async def run():
+        interface = CookieSessionInterface("secret", **OPTIONS)
+        with mock.patch("src.sessions.time", return_value=1000):
+            _, cookie = await request_cycle(
+                interface, None, lambda session: session.update(token="abc")
+            )
+            session, _ = await request_cycle(interface, cookie)
+        assert dict(session) == {"token": "abc"}
+
+        with mock.patch("src.sessions.time", return_value=1000 + 61):
+            session, _ = await request_cycle(interface, cookie)
+        assert dict(session) == {}
+
+    asyncio.run(run())
+
+
+def test_cookie_tampered():
+    async def run():
+        interface = CookieSessionInterface("secret", **OPTIONS)
+        _, cookie = await request_cycle(
+            interface, None, lambda session: session.update(uid="1")
+        )
+
+        data, signature = cookie.split(".")
+        payload = json.loads(base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)))
+        payload["d"]["uid"] = "2"
+        forged = base64.urlsafe_b64encode(json.dumps(payload).encode()).rstrip(b"=")
+        session, _ = await request_cycle(interface, f"{forged.decode()}.{signature}")
+        assert dict(session) == {}
+
+        session, _ = await request_cycle(interface, "not a signed value")
+        assert dict(session) == {}
+
+    asyncio.run(run())
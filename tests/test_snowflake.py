@@ -0,0 +1,123 @@
+"""
+Tests of the snowflake generator and worker ID claims in src/utils.py.
+
+    python -m pytest tests
+"""
+import multiprocessing
+from typing import List
+from unittest import mock
+
+from src.utils import (
+    EPOCH,
+    MAX_SEQUENCE,
+    MAX_WORKER_ID,
+    SEQUENCE_BITS,
+    TIMESTAMP_SHIFT,
+    IDGenerator,
+    claim_worker_id,
+)
+
+
+# far from the worker IDs a server on this machine would claim
+FIRST_WORKER_ID = 200
+PROCESSES = 4
+IDS_PER_PROCESS = 20000
+
+
+def split(snowflake: int):
+    """(timestamp, worker ID, sequence) of a snowflake."""
+    return (
+        snowflake >> TIMESTAMP_SHIFT,
+        (snowflake >> SEQUENCE_BITS) & MAX_WORKER_ID,
+        snowflake & MAX_SEQUENCE,
+    )
+
+
+def frozen_clock(milliseconds: int):
+    """Patches the clock of the generator to `milliseconds` after EPOCH."""
+    return mock.patch("src.utils.time", return_value=(EPOCH + milliseconds) / 1000)
+
+
+def generate(barrier, queue) -> None:
+    generator = IDGenerator(claim_worker_id(FIRST_WORKER_ID, PROCESSES))
+    barrier.wait()
+    ids = [next(generator) for _ in range(IDS_PER_PROCESS // 2)]
+    ids.extend(generator.take(IDS_PER_PROCESS // 2))
+    queue.put((generator.wid, ids))
+
+
+def test_unique_across_processes():
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(PROCESSES)
+    queue = context.Queue()
+    processes = [
+        context.Process(target=generate, args=(barrier, queue))
+        for _ in range(PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    # read before joining, a process doesn't exit while it's queue is full
+    results = [queue.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    worker_ids = {wid for wid, _ in results}
+    assert len(worker_ids) == PROCESSES
+    ids = [i for _, result in results for i in result]
+    assert len(ids) == len(set(ids)) == PROCESSES * IDS_PER_PROCESS
+
+
+def test_sequence_overflow_borrows_next_millisecond():
+    generator = IDGenerator(3)
+    with frozen_clock(1000):
+        ids = [next(generator) for _ in range(MAX_SEQUENCE + 3)]
+
+    assert ids == sorted(ids) and len(set(ids)) == len(ids)
+    assert [split(i) for i in ids[: MAX_SEQUENCE + 1]] == [
+        (1000, 3, sequence) for sequence in range(MAX_SEQUENCE + 1)
+    ]
+    assert [split(i) for i in ids[MAX_SEQUENCE + 1 :]] == [(1001, 3, 0), (1001, 3, 1)]
+
+    # once the clock catches up, the borrowed millisecond is carried on
+    with frozen_clock(1001):
+        assert split(next(generator)) == (1001, 3, 2)
+    with frozen_clock(1002):
+        assert split(next(generator)) == (1002, 3, 0)
+
+
+def test_clock_going_backwards():
+    generator = IDGenerator(1)
+    with frozen_clock(5000):
+        first = next(generator)
+    with frozen_clock(4000):
+        ids = [next(generator) for _ in range(MAX_SEQUENCE + 1)]
+        block = generator.take(10)
+
+    assert [split(i)[0] for i in ids[:MAX_SEQUENCE]] == [5000] * MAX_SEQUENCE
+    assert split(ids[-1]) == (5001, 1, 0)
+    every = [first] + ids + block
+    assert every == sorted(every) and len(set(every)) == len(every)
+
+
+def test_take_across_milliseconds():
+    generator = IDGenerator(7)
+    with frozen_clock(2000):
+        before = [next(generator) for _ in range(10)]
+        block: List[int] = generator.take(2 * (MAX_SEQUENCE + 1) + 5)
+        after = next(generator)
+
+    assert len(block) == 2 * (MAX_SEQUENCE + 1) + 5
+    assert [split(i)[0] for i in block] == (
+        [2000] * (MAX_SEQUENCE + 1 - 10) + [2001] * (MAX_SEQUENCE + 1) + [2002] * 15
+    )
+    assert split(block[0]) == (2000, 7, 10)
+    assert split(after) == (2002, 7, 15)
+    every = before + block + [after]
+    assert every == sorted(every) and len(set(every)) == len(every)
+
+    # a new millisecond starts at sequence 0
+    with frozen_clock(3000):
+        assert generator.take(2) == [
+            (3000 << TIMESTAMP_SHIFT) | (7 << SEQUENCE_BITS) | i for i in range(2)
+        ]